@@ -4,13 +4,28 @@
 -------------------------------------------------------------------------------
 local ReqlessAPI = {}
 
+-- Responses are encoded as JSON unless the command name is suffixed with the
+-- name of another encoding, like 'queue.pop:msgpack'. Only responses which are
+-- otherwise JSON are affected.
+local ReqlessEncodings = {
+  json = {
+    encode = cjson.encode,
+    encode_array = cjsonArrayDegenerationWorkaround
+  },
+  msgpack = {
+    encode = msgpackEncode,
+    encode_array = msgpackEncodeArray
+  }
+}
+local encoding = ReqlessEncodings.json
+
 ReqlessAPI['config.get'] = function(now, key)
   assert(key, "config.get(): Argument 'key' missing")
   return Reqless.config.get(key)
 end
 
 ReqlessAPI['config.getAll'] = function(now)
-  return cjson.encode(Reqless.config.get(nil))
+  return encoding.encode(Reqless.config.get(nil))
 end
 
 ReqlessAPI['config.set'] = function(now, key, value)
@@ -23,7 +38,11 @@ ReqlessAPI['config.unset'] = function(now, key)
 end
 
 ReqlessAPI['failureGroups.counts'] = function(now, start, limit)
-  return cjson.encode(Reqless.failed(nil, start, limit))
+  return encoding.encode(Reqless.failed(nil, start, limit))
+end
+
+ReqlessAPI['failureGroups.migrate'] = function(now, budget)
+  return encoding.encode(Reqless.failure_groups.migrate(now, budget))
 end
 
 ReqlessAPI['job.addDependency'] = function(now, jid, ...)
@@ -32,7 +51,7 @@ end
 
 ReqlessAPI['job.addTag'] = function(now, jid, ...)
   local result = Reqless.tag(now, 'add', jid, unpack(arg))
-  return cjsonArrayDegenerationWorkaround(result)
+  return encoding.encode_array(result)
 end
 
 ReqlessAPI['job.cancel'] = function(now, ...)
@@ -47,16 +66,26 @@ ReqlessAPI['job.completeAndRequeue'] = function(now, jid, worker, queue, data, n
   return Reqless.job(jid):complete(now, worker, queue, data, 'next', next_queue, unpack(arg))
 end
 
+ReqlessAPI['job.completeMulti'] = function(now, worker, jobs)
+  return encoding.encode_array(
+    ReqlessJob.completeMulti(now, worker, jobs))
+end
+
 ReqlessAPI['job.fail'] = function(now, jid, worker, group, message, data)
   return Reqless.job(jid):fail(now, worker, group, message, data)
 end
 
+ReqlessAPI['job.failMulti'] = function(now, jids, worker, group, message)
+  return encoding.encode_array(
+    ReqlessJob.failMulti(now, jids, worker, group, message))
+end
+
 -- Return json for the job identified by the provided jid. If the job is not
 -- present, then `nil` is returned
 ReqlessAPI['job.get'] = function(now, jid)
   local data = Reqless.job(jid):data()
   if data then
-    return cjson.encode(data)
+    return encoding.encode(data)
   end
 end
 
@@ -66,7 +95,16 @@ ReqlessAPI['job.getMulti'] = function(now, ...)
   for _, jid in ipairs(arg) do
     table.insert(results, Reqless.job(jid):data())
   end
-  return cjsonArrayDegenerationWorkaround(results)
+  return encoding.encode_array(results)
+end
+
+-- Like job.getMulti, but each job only includes the requested fields. `fields`
+-- is either the name of a field profile, like 'lite', or a JSON array of field
+-- names.
+ReqlessAPI['job.getMultiFields'] = function(now, fields, ...)
+  fields = assert(ReqlessJob.parse_fields(fields),
+    'job.getMultiFields(): Arg "fields" missing')
+  return encoding.encode_array(ReqlessJob.multi_fields(arg, fields))
 end
 
 ReqlessAPI['job.heartbeat'] = function(now, jid, worker, data)
@@ -83,8 +121,9 @@ ReqlessAPI['job.log'] = function(now, jid, message, data)
   end
 
   local job = Reqless.job(jid)
-  assert(job:exists(), 'Log(): Job ' .. jid .. ' does not exist')
-  job:history(now, message, data)
+  local queue = job:hmget('queue')[1]
+  assert(queue, 'Log(): Job ' .. jid .. ' does not exist')
+  job:history(now, message, data, queue)
 end
 
 ReqlessAPI['job.removeDependency'] = function(now, jid, ...)
@@ -93,7 +132,7 @@ end
 
 ReqlessAPI['job.removeTag'] = function(now, jid, ...)
   local result = Reqless.tag(now, 'remove', jid, unpack(arg))
-  return cjsonArrayDegenerationWorkaround(result)
+  return encoding.encode_array(result)
 end
 
 ReqlessAPI['job.requeue'] = function(now, worker, queue, jid, klass, data, delay, ...)
@@ -106,6 +145,11 @@ ReqlessAPI['job.retry'] = function(now, jid, queue, worker, delay, group, messag
   return Reqless.job(jid):retry(now, queue, worker, delay, group, message)
 end
 
+ReqlessAPI['job.retryMulti'] = function(now, jids, queue, worker, delay, group, message)
+  return encoding.encode_array(
+    ReqlessJob.retryMulti(now, jids, queue, worker, delay, group, message))
+end
+
 ReqlessAPI['job.setPriority'] = function(now, jid, priority)
   return Reqless.job(jid):priority(priority)
 end
@@ -117,32 +161,39 @@ ReqlessAPI['job.timeout'] = function(now, ...)
 end
 
 ReqlessAPI['job.track'] = function(now, jid)
-  return cjson.encode(Reqless.track(now, 'track', jid))
+  return encoding.encode(Reqless.track(now, 'track', jid))
 end
 
 ReqlessAPI['job.untrack'] = function(now, jid)
-  return cjson.encode(Reqless.track(now, 'untrack', jid))
+  return encoding.encode(Reqless.track(now, 'untrack', jid))
 end
 
 ReqlessAPI["jobs.completed"] = function(now, offset, limit)
   local result = Reqless.jobs(now, 'complete', offset, limit)
-  return cjsonArrayDegenerationWorkaround(result)
+  return encoding.encode_array(result)
 end
 
-ReqlessAPI['jobs.failedByGroup'] = function(now, group, start, limit)
-  return cjson.encode(Reqless.failed(group, start, limit))
+ReqlessAPI['jobs.expire'] = function(now, budget)
+  return encoding.encode(ReqlessJob.expire_completed(now, budget))
+end
+
+ReqlessAPI['jobs.failedByGroup'] = function(now, group, start, limit, from, to)
+  return encoding.encode(Reqless.failed(group, start, limit, from, to))
 end
 
 ReqlessAPI['jobs.tagged'] = function(now, tag, ...)
-  return cjson.encode(Reqless.tag(now, 'get', tag, unpack(arg)))
+  return encoding.encode(Reqless.tag(now, 'get', tag, unpack(arg)))
 end
 
-ReqlessAPI['jobs.tracked'] = function(now)
-  return cjson.encode(Reqless.track(now))
+-- The optional `fields` argument is the field profile or JSON array of field
+-- names to return for each job, and defaults to the `listing` profile.
+ReqlessAPI['jobs.tracked'] = function(now, fields)
+  return encoding.encode(
+    Reqless.track(now, nil, nil, ReqlessJob.parse_fields(fields, 'listing')))
 end
 
 ReqlessAPI['queue.counts'] = function(now, queue)
-  return cjson.encode(ReqlessQueue.counts(now, queue))
+  return encoding.encode(ReqlessQueue.counts(now, queue))
 end
 
 ReqlessAPI['queue.forget'] = function(now, ...)
@@ -151,7 +202,7 @@ end
 
 ReqlessAPI["queue.jobsByState"] = function(now, state, ...)
   local result = Reqless.jobs(now, state, unpack(arg))
-  return cjsonArrayDegenerationWorkaround(result)
+  return encoding.encode_array(result)
 end
 
 ReqlessAPI['queue.length'] = function(now, queue)
@@ -162,34 +213,42 @@ ReqlessAPI['queue.pause'] = function(now, ...)
   ReqlessQueue.pause(now, unpack(arg))
 end
 
-ReqlessAPI['queue.peek'] = function(now, queue, offset, limit)
+-- The optional `fields` argument is the field profile or JSON array of field
+-- names to return for each job, and defaults to the `listing` profile.
+ReqlessAPI['queue.peek'] = function(now, queue, offset, limit, fields)
+  fields = ReqlessJob.parse_fields(fields, 'listing')
   local jids = Reqless.queue(queue):peek(now, offset, limit)
-  local response = {}
-  for _, jid in ipairs(jids) do
-    table.insert(response, Reqless.job(jid):data())
-  end
-  return cjsonArrayDegenerationWorkaround(response)
+  return encoding.encode_array(ReqlessJob.multi_fields(jids, fields))
 end
 
-ReqlessAPI['queue.pop'] = function(now, queue, worker, limit)
+ReqlessAPI['queue.percentiles'] = function(now, queue, date, quantiles, span)
+  return encoding.encode(
+    Reqless.queue(queue):percentiles(now, date, quantiles, span))
+end
+
+-- The optional `fields` argument limits the data returned for each job to the
+-- given field profile or JSON array of field names.
+ReqlessAPI['queue.pop'] = function(now, queue, worker, limit, fields)
+  fields = ReqlessJob.parse_fields(fields)
   local jids = Reqless.queue(queue):pop(now, worker, limit)
-  local response = {}
-  for _, jid in ipairs(jids) do
-    table.insert(response, Reqless.job(jid):data())
-  end
-  return cjsonArrayDegenerationWorkaround(response)
+  return encoding.encode_array(ReqlessJob.multi_fields(jids, fields))
 end
 
 ReqlessAPI['queue.put'] = function(now, worker, queue, jid, klass, data, delay, ...)
   return Reqless.queue(queue):put(now, worker, jid, klass, data, delay, unpack(arg))
 end
 
+ReqlessAPI['queue.putMulti'] = function(now, worker, queue, jobs)
+  return encoding.encode_array(
+    Reqless.queue(queue):putMulti(now, worker, jobs))
+end
+
 ReqlessAPI['queue.recurAtInterval'] = function(now, queue, jid, klass, data, interval, offset, ...)
   return Reqless.queue(queue):recurAtInterval(now, jid, klass, data, interval, offset, unpack(arg))
 end
 
 ReqlessAPI['queue.stats'] = function(now, queue, date)
-  return cjson.encode(Reqless.queue(queue):stats(now, date))
+  return encoding.encode(Reqless.queue(queue):stats(now, date))
 end
 
 ReqlessAPI['queue.throttle.get'] = function(now, queue)
@@ -210,7 +269,7 @@ ReqlessAPI['queue.unpause'] = function(now, ...)
 end
 
 ReqlessAPI['queueIdentifierPatterns.getAll'] = function(now)
-  return cjson.encode(ReqlessQueuePatterns.getIdentifierPatterns(now))
+  return encoding.encode(ReqlessQueuePatterns.getIdentifierPatterns(now))
 end
 
 ReqlessAPI['queueIdentifierPatterns.setAll'] = function(now, ...)
@@ -218,19 +277,59 @@ ReqlessAPI['queueIdentifierPatterns.setAll'] = function(now, ...)
 end
 
 ReqlessAPI['queuePriorityPatterns.getAll'] = function(now)
-  return cjsonArrayDegenerationWorkaround(ReqlessQueuePatterns.getPriorityPatterns(now))
+  return encoding.encode_array(ReqlessQueuePatterns.getPriorityPatterns(now))
 end
 
 ReqlessAPI['queuePriorityPatterns.setAll'] = function(now, ...)
   ReqlessQueuePatterns.setPriorityPatterns(now, unpack(arg))
 end
 
-ReqlessAPI['queues.counts'] = function(now)
-  return cjsonArrayDegenerationWorkaround(ReqlessQueue.counts(now, nil))
+ReqlessAPI['queues.counts'] = function(now, mode)
+  if mode == 'cached' then
+    return encoding.encode_array(ReqlessQueue.cached_counts(now))
+  end
+  assert(mode == nil, 'Counts(): Unknown mode ' .. tostring(mode))
+  return encoding.encode_array(ReqlessQueue.counts(now, nil))
 end
 
 ReqlessAPI['queues.names'] = function(now)
-  return cjsonArrayDegenerationWorkaround(ReqlessQueue.names(now, nil))
+  return encoding.encode_array(ReqlessQueue.names(now, nil))
+end
+
+-- The optional `fields` argument limits the data returned for each job to the
+-- given field profile or JSON array of field names.
+ReqlessAPI['queues.pop'] = function(now, worker, identifier, limit, fields)
+  fields = ReqlessJob.parse_fields(fields)
+  local jids = ReqlessQueuePatterns.pop(now, worker, identifier, limit)
+  return encoding.encode_array(ReqlessJob.multi_fields(jids, fields))
+end
+
+ReqlessAPI['queues.reap'] = function(now, budget)
+  return encoding.encode(ReqlessQueue.reap(now, budget))
+end
+
+ReqlessAPI['queues.rebuildCounts'] = function(now, ...)
+  return ReqlessQueue.rebuild_counts(now, unpack(arg))
+end
+
+-- `queues` is a JSON array of queue names and patterns, as accepted by
+-- `queueIdentifierPatterns.setAll`, matched against the known queues
+ReqlessAPI['queues.statsRange'] = function(now, queues, from, to, resolution)
+  local patterns = assert(cjson.decode(queues or 'null'),
+    'queues.statsRange(): Arg "queues" missing')
+  assert(type(patterns) == 'table',
+    'queues.statsRange(): Arg "queues" not a JSON array: ' .. tostring(queues))
+
+  -- Queues that are named outright match even once they're forgotten
+  local names = ReqlessQueue.names(now)
+  for _, pattern in ipairs(patterns) do
+    if not string.match(pattern, '[%*!@]') then
+      table.insert(names, pattern)
+    end
+  end
+
+  return encoding.encode(ReqlessQueue.stats_range(now,
+    ReqlessQueuePatterns.expandQueues(now, patterns, names), from, to, resolution))
 end
 
 ReqlessAPI['recurringJob.cancel'] = function(now, jid)
@@ -240,7 +339,7 @@ end
 ReqlessAPI['recurringJob.get'] = function(now, jid)
   local data = Reqless.recurring(jid):data()
   if data then
-    return cjson.encode(data)
+    return encoding.encode(data)
   end
 end
 
@@ -256,9 +355,13 @@ ReqlessAPI['recurringJob.update'] = function(now, jid, ...)
   return Reqless.recurring(jid):update(now, unpack(arg))
 end
 
+ReqlessAPI['scheduler.tick'] = function(now, budget)
+  return encoding.encode(ReqlessQueue.tick(now, budget))
+end
+
 ReqlessAPI['tags.top'] = function(now, offset, limit)
   local result = Reqless.tag(now, 'top', offset, limit)
-  return cjsonArrayDegenerationWorkaround(result)
+  return encoding.encode_array(result)
 end
 
 ReqlessAPI['throttle.delete'] = function(now, tid)
@@ -266,17 +369,17 @@ ReqlessAPI['throttle.delete'] = function(now, tid)
 end
 
 ReqlessAPI['throttle.get'] = function(now, tid)
-  return cjson.encode(Reqless.throttle(tid):dataWithTtl())
+  return encoding.encode(Reqless.throttle(tid):dataWithTtl())
 end
 
 ReqlessAPI['throttle.locks'] = function(now, tid)
-  local result = Reqless.throttle(tid).locks.members()
-  return cjsonArrayDegenerationWorkaround(result)
+  local result = Reqless.throttle(tid).locks:members()
+  return encoding.encode_array(result)
 end
 
 ReqlessAPI['throttle.pending'] = function(now, tid)
-  local result = Reqless.throttle(tid).pending.members()
-  return cjsonArrayDegenerationWorkaround(result)
+  local result = Reqless.throttle(tid).pending:members()
+  return encoding.encode_array(result)
 end
 
 -- releases the set of jids from the specified throttle.
@@ -300,26 +403,82 @@ ReqlessAPI['worker.forget'] = function(now, ...)
   ReqlessWorker.deregister(unpack(arg))
 end
 
+ReqlessAPI['worker.heartbeat'] = function(now, worker, ...)
+  return encoding.encode_array(
+    ReqlessWorker.heartbeat(now, worker, unpack(arg)))
+end
+
 ReqlessAPI['worker.jobs'] = function(now, worker)
-  return cjson.encode(ReqlessWorker.counts(now, worker))
+  return encoding.encode(ReqlessWorker.counts(now, worker))
 end
 
 ReqlessAPI['workers.counts'] = function(now)
-  return cjsonArrayDegenerationWorkaround(ReqlessWorker.counts(now, nil))
-end
+  return encoding.encode_array(ReqlessWorker.counts(now, nil))
+end
+
+-- The commands that never write, at least when run by the read-only build of
+-- the script, and so can be run with EVAL_RO and against replicas. These are
+-- also listed in `manifest.json`, for clients to route by.
+local ReqlessReadOnlyAPI = {
+  ['config.get']                     = true,
+  ['config.getAll']                  = true,
+  ['failureGroups.counts']           = true,
+  ['job.get']                        = true,
+  ['job.getMulti']                   = true,
+  ['job.getMultiFields']             = true,
+  ['jobs.completed']                 = true,
+  ['jobs.failedByGroup']             = true,
+  ['jobs.tagged']                    = true,
+  ['jobs.tracked']                   = true,
+  ['queue.counts']                   = true,
+  ['queue.jobsByState']              = true,
+  ['queue.length']                   = true,
+  ['queue.peek']                     = true,
+  ['queue.percentiles']              = true,
+  ['queue.stats']                    = true,
+  ['queue.throttle.get']             = true,
+  ['queueIdentifierPatterns.getAll'] = true,
+  ['queuePriorityPatterns.getAll']   = true,
+  ['queues.counts']                  = true,
+  ['queues.names']                   = true,
+  ['queues.statsRange']              = true,
+  ['recurringJob.get']               = true,
+  ['tags.top']                       = true,
+  ['throttle.get']                   = true,
+  ['throttle.locks']                 = true,
+  ['throttle.pending']               = true,
+  ['worker.jobs']                    = true,
+  ['workers.counts']                 = true,
+}
 
 -------------------------------------------------------------------------------
 -- Function lookup
 -------------------------------------------------------------------------------
 
--- None of the function calls accept keys
-if #KEYS > 0 then error('No Keys should be provided') end
+-- The only key that may be provided is the namespace that all the keys used
+-- are kept under. It must have a hash tag, so that they all share its slot,
+-- and the script can run on a cluster.
+if #KEYS > 1 then error('Only the namespace may be provided as a key') end
+if #KEYS == 1 then
+  assert(string.find(KEYS[1], '^[^{]*{[^}]+}'),
+    'Namespace must contain a hash tag: ' .. KEYS[1])
+  Reqless.set_namespace(KEYS[1])
+end
 
 -- The first argument must be the function that we intend to call, and it must
 -- exist
-local command_name = assert(table.remove(ARGV, 1), 'Must provide a command')
+local command_name, encoding_name = string.match(
+  assert(table.remove(ARGV, 1), 'Must provide a command'), '^([^:]*):?(.*)$')
 local command      = assert(
   ReqlessAPI[command_name], 'Unknown command ' .. command_name)
+if Reqless.read_only then
+  assert(ReqlessReadOnlyAPI[command_name],
+    'Command ' .. command_name .. ' is not read-only')
+end
+if encoding_name ~= '' then
+  encoding = assert(
+    ReqlessEncodings[encoding_name], 'Unknown encoding ' .. encoding_name)
+end
 
 -- The second argument should be the current time from the requesting client
 local now          = tonumber(table.remove(ARGV, 1))
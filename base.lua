@@ -2,7 +2,10 @@
 -- Forward declarations to make everything happy
 -------------------------------------------------------------------------------
 local Reqless = {
-  ns = 'ql:'
+  ns = 'ql:',
+  -- Set in the read-only build of the script, in which the commands that only
+  -- read skip the upkeep they would otherwise do along the way
+  read_only = false
 }
 
 -- Queue forward delcaration
@@ -43,12 +46,35 @@ local function table_extend(self, other)
   end
 end
 
+-- Keep all the keys under the namespace `ns`, rather than `ql:`. With a hash
+-- tag in the namespace, every key lands in the same cluster slot.
+function Reqless.set_namespace(ns)
+  Reqless.ns          = ns
+  ReqlessQueue.ns     = ns .. 'q:'
+  ReqlessWorker.ns    = ns .. 'w:'
+  ReqlessJob.ns       = ns .. 'j:'
+  ReqlessThrottle.ns  = ns .. 'th:'
+end
+
 -- This is essentially the same as redis' publish, but it prefixes the channel
 -- with the Reqless namespace
 function Reqless.publish(channel, message)
   redis.call('publish', Reqless.ns .. channel, message)
 end
 
+-- Whether or not jobs are tracked, memoized for the rest of the invocation
+Reqless.tracked_cache = {}
+
+-- Return true if the job with the provided jid is being tracked
+function Reqless.tracked(jid)
+  local tracked = Reqless.tracked_cache[jid]
+  if tracked == nil then
+    tracked = redis.call('zscore', Reqless.ns .. 'tracked', jid) ~= false
+    Reqless.tracked_cache[jid] = tracked
+  end
+  return tracked
+end
+
 -- Return a job object given its job id
 function Reqless.job(jid)
   assert(jid, 'Job(): no jid provided')
@@ -67,61 +93,14 @@ function Reqless.recurring(jid)
   return job
 end
 
--- Return a throttle object
--- throttle objects are used for arbitrary throttling of jobs.
-function Reqless.throttle(tid)
-  assert(tid, 'Throttle(): no tid provided')
-  local throttle = ReqlessThrottle.data({id = tid})
-  setmetatable(throttle, ReqlessThrottle)
-
-  -- set of jids which have acquired a lock on this throttle.
-  throttle.locks = {
-    length = function()
-      return (redis.call('zcard', ReqlessThrottle.ns .. tid .. '-locks') or 0)
-    end, members = function()
-      return redis.call('zrange', ReqlessThrottle.ns .. tid .. '-locks', 0, -1)
-    end, add = function(...)
-      if #arg > 0 then
-        redis.call('zadd', ReqlessThrottle.ns .. tid .. '-locks', unpack(arg))
-      end
-    end, remove = function(...)
-      if #arg > 0 then
-        return redis.call('zrem', ReqlessThrottle.ns .. tid .. '-locks', unpack(arg))
-      end
-    end, pop = function(min, max)
-      return redis.call('zremrangebyrank', ReqlessThrottle.ns .. tid .. '-locks', min, max)
-    end, peek = function(min, max)
-      return redis.call('zrange', ReqlessThrottle.ns .. tid .. '-locks', min, max)
-    end
-  }
-
-  -- set of jids which are waiting for the throttle to become available.
-  throttle.pending = {
-    length = function()
-      return (redis.call('zcard', ReqlessThrottle.ns .. tid .. '-pending') or 0)
-    end, members = function()
-        return redis.call('zrange', ReqlessThrottle.ns .. tid .. '-pending', 0, -1)
-    end, add = function(now, jid)
-      redis.call('zadd', ReqlessThrottle.ns .. tid .. '-pending', now, jid)
-    end, remove = function(...)
-      if #arg > 0 then
-        return redis.call('zrem', ReqlessThrottle.ns .. tid .. '-pending', unpack(arg))
-      end
-    end, pop = function(min, max)
-      return redis.call('zremrangebyrank', ReqlessThrottle.ns .. tid .. '-pending', min, max)
-    end, peek = function(min, max)
-      return redis.call('zrange', ReqlessThrottle.ns .. tid .. '-pending', min, max)
-    end
-  }
-
-  return throttle
-end
-
--- Failed([group, [start, [limit]]])
--- ------------------------------------
+-- Failed([group, [start, [limit, [from, [to]]]]])
+-- ------------------------------------------------
 -- If no group is provided, this returns a JSON blob of the counts of the
--- various groups of failures known. If a group is provided, it will report up
--- to `limit` from `start` of the jobs affected by that issue.
+-- various groups of failures known, or of the `limit` largest groups from
+-- `start` if a limit is provided. If a group is provided, it will report up
+-- to `limit` from `start` of the jobs affected by that issue, most recent
+-- failures first. If `from` or `to` is provided, only the jobs that failed in
+-- that time range are reported.
 --
 --  # If no group, then...
 --  {
@@ -145,29 +124,351 @@ end
 --      ]
 --  }
 --
-function Reqless.failed(group, start, limit)
+function Reqless.failed(group, start, limit, from, to)
+  -- If no group was provided, we should just list the failure groups we have
+  if not group then
+    return Reqless.failure_groups.counts(start, limit)
+  end
+
   start = assert(tonumber(start or 0),
     'Failed(): Arg "start" is not a number: ' .. (start or 'nil'))
   limit = assert(tonumber(limit or 25),
     'Failed(): Arg "limit" is not a number: ' .. (limit or 'nil'))
 
-  if group then
-    -- If a group was provided, then we should do paginated lookup
-    return {
-      total = redis.call('llen', 'ql:f:' .. group),
-      jobs  = redis.call('lrange', 'ql:f:' .. group, start, start + limit - 1)
-    }
+  local key = Reqless.failure_groups.key(group)
+  local legacy_key = Reqless.failure_groups.legacy_key(group)
+  local total, jids, first, last
+  if from or to then
+    -- Page through the jobs that failed in the time range
+    from = from and assert(tonumber(from),
+      'Failed(): Arg "from" is not a number: ' .. from) or -math.huge
+    to = to and assert(tonumber(to),
+      'Failed(): Arg "to" is not a number: ' .. to) or math.huge
+    total = redis.call('zcount', key, from, to)
+    jids = redis.call(
+      'zrevrangebyscore', key, to, from, 'LIMIT', start, limit)
+    first, last = Reqless.failure_groups.legacy_range(group, from, to)
+  else
+    -- Otherwise, we should do paginated lookup
+    total = redis.call('zcard', key)
+    jids = redis.call('zrevrange', key, start, start + limit - 1)
+    first, last = 0, Reqless.failure_groups.legacy_length(group) - 1
+  end
+
+  -- Jobs still kept as a list by earlier versions failed before any of those
+  -- in the sorted set, so they follow them
+  local offset = math.max(start - total, 0) + first
+  if #jids < limit and offset <= last then
+    local legacy = redis.call('lrange', legacy_key,
+      offset, math.min(offset + limit - #jids - 1, last))
+    for _, jid in ipairs(legacy) do
+      table.insert(jids, jid)
+    end
+  end
+  return {total = total + math.max(last - first + 1, 0), jobs = jids}
+end
+
+-- The jobs in each failure group are kept in a sorted set, scored by when
+-- they failed, and `ql:failures` holds the groups that have any. The number of
+-- jobs in each group is kept in the `ql:failures:counts` sorted set, so that
+-- they can be read without visiting every group.
+--
+-- Groups used to be kept as lists at `ql:f:<group>`, most recent failures
+-- first. `migrate` moves them into their sorted sets a few jobs at a time,
+-- and then sets `ql:failures:migrated`. Until then, a group may be kept in
+-- both, and the jobs in its list, which failed before any in its sorted set,
+-- are read and removed from there, and aren't in its count.
+Reqless.failure_groups = {}
+
+-- Whether every group kept by earlier versions is known to have been moved,
+-- once it's been read in this invocation
+Reqless.failure_groups.done = nil
+
+-- The key of the sorted set of the jobs in the group
+function Reqless.failure_groups.key(group)
+  return Reqless.ns .. 'failed:' .. group
+end
+
+-- The key of the list the group's jobs were kept in by earlier versions
+function Reqless.failure_groups.legacy_key(group)
+  return Reqless.ns .. 'f:' .. group
+end
+
+-- Whether every group kept by earlier versions has been moved
+function Reqless.failure_groups.migrated()
+  if Reqless.failure_groups.done == nil then
+    Reqless.failure_groups.done = redis.call(
+      'exists', Reqless.ns .. 'failures:migrated') == 1
+  end
+  return Reqless.failure_groups.done
+end
+
+-- The number of the group's jobs still kept in its list
+function Reqless.failure_groups.legacy_length(group)
+  if Reqless.failure_groups.migrated() then
+    return 0
+  end
+  return redis.call('llen', Reqless.failure_groups.legacy_key(group))
+end
+
+-- When the job in the group's list at `index` failed
+function Reqless.failure_groups.legacy_when(group, index)
+  local jid = redis.call(
+    'lindex', Reqless.failure_groups.legacy_key(group), index)
+  local failure = redis.call('hget', ReqlessJob.ns .. jid, 'failure')
+  return failure and cjson.decode(failure).when or 0
+end
+
+-- The first and last indexes of the jobs in the group's list that failed
+-- between `from` and `to`. The list is most recent failures first, so they're
+-- found with a binary search.
+function Reqless.failure_groups.legacy_range(group, from, to)
+  local length = Reqless.failure_groups.legacy_length(group)
+
+  -- The first index at or after which every job failed before `when`
+  local function before(when, inclusive)
+    local low, high = 0, length
+    while low < high do
+      local middle = math.floor((low + high) / 2)
+      local failed = Reqless.failure_groups.legacy_when(group, middle)
+      if failed < when or (inclusive and failed == when) then
+        high = middle
+      else
+        low = middle + 1
+      end
+    end
+    return low
+  end
+
+  return before(to, true), before(from, false) - 1
+end
+
+-- Add the jobs to the group, as having failed at `now`
+function Reqless.failure_groups.add(now, group, ...)
+  redis.call('sadd', Reqless.ns .. 'failures', group)
+  local added = 0
+  for index = 1, #arg, 1000 do
+    local members = {}
+    for position = index, math.min(index + 999, #arg) do
+      table.insert(members, now)
+      table.insert(members, arg[position])
+    end
+    added = added + redis.call(
+      'zadd', Reqless.failure_groups.key(group), unpack(members))
+  end
+  if added > 0 then
+    redis.call('zincrby', Reqless.ns .. 'failures:counts', added, group)
+  end
+end
+
+-- Remove the job from the group
+function Reqless.failure_groups.remove(group, jid)
+  local removed = redis.call('zrem', Reqless.failure_groups.key(group), jid)
+  if removed > 0 then
+    redis.call('zincrby', Reqless.ns .. 'failures:counts', -removed, group)
+  elseif not Reqless.failure_groups.migrated() then
+    -- Otherwise it may still be kept in the group's list
+    removed = redis.call(
+      'lrem', Reqless.failure_groups.legacy_key(group), 0, jid)
+  end
+  if removed > 0 then
+    Reqless.failure_groups.forget_empty(group)
+  end
+end
+
+-- The `count` jobs that failed first in the group, those that failed first
+-- first
+function Reqless.failure_groups.oldest(group, count)
+  local jids = {}
+  local length = Reqless.failure_groups.legacy_length(group)
+  if length > 0 then
+    local legacy = redis.call('lrange',
+      Reqless.failure_groups.legacy_key(group), -math.min(count, length), -1)
+    for index = #legacy, 1, -1 do
+      table.insert(jids, legacy[index])
+    end
+  end
+  if #jids < count then
+    local newer = redis.call('zrange',
+      Reqless.failure_groups.key(group), 0, count - #jids - 1)
+    for _, jid in ipairs(newer) do
+      table.insert(jids, jid)
+    end
+  end
+  return jids
+end
+
+-- Remove the `count` jobs that failed first from the group
+function Reqless.failure_groups.remove_oldest(group, count)
+  local length = Reqless.failure_groups.legacy_length(group)
+  if length > count then
+    redis.call('ltrim', Reqless.failure_groups.legacy_key(group),
+      0, length - count - 1)
+  elseif length > 0 then
+    redis.call('del', Reqless.failure_groups.legacy_key(group))
+  end
+  local removed = 0
+  if count > length then
+    removed = redis.call('zremrangebyrank',
+      Reqless.failure_groups.key(group), 0, count - length - 1)
+    if removed > 0 then
+      redis.call('zincrby', Reqless.ns .. 'failures:counts', -removed, group)
+    end
+  end
+  if length > 0 or removed > 0 then
+    Reqless.failure_groups.forget_empty(group)
+  end
+end
+
+-- Forget the group if it has no jobs left
+function Reqless.failure_groups.forget_empty(group)
+  if redis.call('zcard', Reqless.failure_groups.key(group)) == 0 and
+    Reqless.failure_groups.legacy_length(group) == 0 then
+    redis.call('srem', Reqless.ns .. 'failures', group)
+    redis.call('zrem', Reqless.ns .. 'failures:counts', group)
+  end
+end
+
+-- Return the number of jobs in each failure group. If `limit` is provided,
+-- only the `limit` largest groups from `start` are returned:
+--
+--  {
+--      'group1': 1,
+--      'group2': 5,
+--      ...
+--  }
+function Reqless.failure_groups.counts(start, limit)
+  start = assert(tonumber(start or 0),
+    'Failed(): Arg "start" is not a number: ' .. (start or 'nil'))
+  local stop = -1
+  if limit then
+    limit = assert(tonumber(limit),
+      'Failed(): Arg "limit" is not a number: ' .. limit)
+    stop = start + limit - 1
   end
 
-  -- Otherwise, we should just list all the known failure groups we have
   local response = {}
-  local groups = redis.call('smembers', 'ql:failures')
-  for _, group in ipairs(groups) do
-    response[group] = redis.call('llen', 'ql:f:' .. group)
+  if Reqless.failure_groups.migrated() then
+    local counts = redis.call(
+      'zrevrange', Reqless.ns .. 'failures:counts', start, stop, 'WITHSCORES')
+    for i = 1, #counts, 2 do
+      response[counts[i]] = tonumber(counts[i + 1])
+    end
+    return response
+  end
+
+  -- The jobs still kept in the lists of groups aren't in their counts, so
+  -- count those too
+  local groups = {}
+  local counts = redis.call(
+    'zrange', Reqless.ns .. 'failures:counts', 0, -1, 'WITHSCORES')
+  for i = 1, #counts, 2 do
+    groups[counts[i]] = tonumber(counts[i + 1])
+  end
+  for _, group in ipairs(redis.call('smembers', Reqless.ns .. 'failures')) do
+    groups[group] = (groups[group] or 0) + redis.call(
+      'llen', Reqless.failure_groups.legacy_key(group))
+    table.insert(groups, group)
+  end
+
+  -- The largest groups first, as they're kept in the sorted set
+  table.sort(groups, function(a, b)
+    if groups[a] ~= groups[b] then
+      return groups[a] > groups[b]
+    end
+    return a > b
+  end)
+  if stop < 0 then
+    stop = #groups - 1
+  end
+  for index = start + 1, math.min(stop + 1, #groups) do
+    response[groups[index]] = groups[groups[index]]
   end
   return response
 end
 
+-- Move up to `count` of the most recently failed jobs still kept in the
+-- group's list to its sorted set, scored by when they failed, and count them.
+-- Returns the number of jobs moved, and whether any are left in the list.
+function Reqless.failure_groups.migrate_chunk(group, count)
+  local legacy_key = Reqless.failure_groups.legacy_key(group)
+  local jids = redis.call('lrange', legacy_key, 0, count - 1)
+  if #jids == 0 then
+    return 0, false
+  end
+
+  local members = {}
+  for _, jid in ipairs(jids) do
+    local failure = redis.call('hget', ReqlessJob.ns .. jid, 'failure')
+    table.insert(members, failure and cjson.decode(failure).when or 0)
+    table.insert(members, jid)
+  end
+  for index = 1, #members, 1000 do
+    local added = redis.call('zadd', Reqless.failure_groups.key(group),
+      unpack(members, index, math.min(index + 999, #members)))
+    if added > 0 then
+      redis.call('zincrby', Reqless.ns .. 'failures:counts', added, group)
+    end
+  end
+  redis.call('ltrim', legacy_key, #jids, -1)
+  return #jids, #jids == count and redis.call('exists', legacy_key) == 1
+end
+
+-- Move the jobs kept in the lists of earlier versions into their groups'
+-- sorted sets, going through the groups with a cursor kept in
+-- `ql:failures:migrating`, and moving no more than `budget` jobs. Returns how
+-- many jobs were moved, and whether every group has now been moved:
+--
+--  {
+--      'migrated': 100,
+--      'done': false
+--  }
+function Reqless.failure_groups.migrate(now, budget)
+  budget = assert(tonumber(budget or 1000),
+    'Migrate(): Arg "budget" is not a number: ' .. tostring(budget))
+
+  if Reqless.failure_groups.migrated() then
+    return {migrated = 0, done = true}
+  end
+
+  local cursor_key = Reqless.ns .. 'failures:migrating'
+  local cursor = redis.call('get', cursor_key) or '0'
+  local migrated, done = 0, false
+  repeat
+    local reply = redis.call(
+      'sscan', Reqless.ns .. 'failures', cursor, 'COUNT', 100)
+    -- If the budget runs out before every group of this step is moved, the
+    -- cursor stays put so that the step is taken again next time
+    local spent = false
+    for _, group in ipairs(reply[2]) do
+      spent = migrated >= budget
+      if spent then
+        break
+      end
+      local moved, left = Reqless.failure_groups.migrate_chunk(
+        group, budget - migrated)
+      migrated = migrated + moved
+      spent = left
+      if spent then
+        break
+      end
+    end
+    if not spent then
+      cursor = reply[1]
+      done = cursor == '0'
+    end
+  until done or migrated >= budget
+
+  if done then
+    redis.call('del', cursor_key)
+    redis.call('set', Reqless.ns .. 'failures:migrated', 1)
+    Reqless.failure_groups.done = true
+  else
+    redis.call('set', cursor_key, cursor)
+  end
+  return {migrated = migrated, done = done}
+end
+
 -- Jobs(now, 'complete', [offset, [limit]])
 -- Jobs(now, (
 --          'stalled' | 'running' | 'scheduled' | 'depends', 'recurring'
@@ -188,7 +489,7 @@ function Reqless.jobs(now, state, ...)
       'Jobs(): Arg "offset" not a number: ' .. tostring(arg[1]))
     local limit  = assert(tonumber(arg[2] or 25),
       'Jobs(): Arg "limit" not a number: ' .. tostring(arg[2]))
-    return redis.call('zrevrange', 'ql:completed', offset,
+    return redis.call('zrevrange', Reqless.ns .. 'completed', offset,
       offset + limit - 1)
   end
 
@@ -200,28 +501,30 @@ function Reqless.jobs(now, state, ...)
 
   local queue = Reqless.queue(queue_name)
   if state == 'running' then
-    return queue.locks.peek(now, offset, limit)
+    return queue.locks:peek(now, offset, limit)
   elseif state == 'stalled' then
-    return queue.locks.expired(now, offset, limit)
+    return queue.locks:expired(now, offset, limit)
   elseif state == 'throttled' then
-    return queue.throttled.peek(now, offset, limit)
+    return queue.throttled:peek(now, offset, limit)
   elseif state == 'scheduled' then
-    queue:check_scheduled(now, queue.scheduled.length())
-    return queue.scheduled.peek(now, offset, limit)
+    if ReqlessQueue.inline_promotion() then
+      queue:check_scheduled(now, queue.scheduled:length())
+    end
+    return queue.scheduled:peek(now, offset, limit)
   elseif state == 'depends' then
-    return queue.depends.peek(now, offset, limit)
+    return queue.depends:peek(now, offset, limit)
   elseif state == 'recurring' then
-    return queue.recurring.peek(math.huge, offset, limit)
+    return queue.recurring:peek(math.huge, offset, limit)
   end
 
   error('Jobs(): Unknown type "' .. state .. '"')
 end
 
--- Track()
+-- Track(now, nil, nil, [fields])
 -- Track(now, ('track' | 'untrack'), jid)
 -- ------------------------------------------
--- If no arguments are provided, it returns details of all currently-tracked
--- jobs. If the first argument is 'track', then it will start tracking the job
+-- If no command is provided, it returns details of all currently-tracked
+-- jobs, limited to the list of `fields` if one is given. If the first argument is 'track', then it will start tracking the job
 -- associated with that id, and 'untrack' stops tracking it. In this context,
 -- tracking is nothing more than saving the job to a list of jobs that are
 -- considered special.
@@ -230,7 +533,7 @@ end
 --      'jobs': [
 --          {
 --              'jid': ...,
---              # All the other details you'd get from 'job.get'
+--              # The fields asked for, as from 'job.getMultiFields'
 --          }, {
 --              ...
 --          }
@@ -242,17 +545,19 @@ end
 --      ]
 --  }
 --
-function Reqless.track(now, command, jid)
+function Reqless.track(now, command, jid, fields)
   if command ~= nil then
     assert(jid, 'Track(): Arg "jid" missing')
     -- Verify that job exists
     assert(Reqless.job(jid):exists(), 'Track(): Job does not exist')
     if string.lower(command) == 'track' then
       Reqless.publish('track', jid)
-      return redis.call('zadd', 'ql:tracked', now, jid)
+      Reqless.tracked_cache[jid] = true
+      return redis.call('zadd', Reqless.ns .. 'tracked', now, jid)
     elseif string.lower(command) == 'untrack' then
       Reqless.publish('untrack', jid)
-      return redis.call('zrem', 'ql:tracked', jid)
+      Reqless.tracked_cache[jid] = false
+      return redis.call('zrem', Reqless.ns .. 'tracked', jid)
     end
     error('Track(): Unknown action "' .. command .. '"')
   end
@@ -261,9 +566,9 @@ function Reqless.track(now, command, jid)
     jobs = {},
     expired = {},
   }
-  local jids = redis.call('zrange', 'ql:tracked', 0, -1)
+  local jids = redis.call('zrange', Reqless.ns .. 'tracked', 0, -1)
   for _, jid in ipairs(jids) do
-    local data = Reqless.job(jid):data()
+    local data = Reqless.job(jid):fields(fields)
     if data then
       table.insert(response.jobs, data)
     else
@@ -306,20 +611,25 @@ function Reqless.tag(now, command, ...)
       'Tag(): Arg "offset" not a number: ' .. tostring(arg[2]))
     local limit  = assert(tonumber(arg[3] or 25),
       'Tag(): Arg "limit" not a number: ' .. tostring(arg[3]))
+    -- Forget about any jobs with this tag that redis has expired
+    if not Reqless.read_only then
+      ReqlessJob.expire_tag(now, tag)
+    end
     return {
-      total = redis.call('zcard', 'ql:t:' .. tag),
-      jobs  = redis.call('zrange', 'ql:t:' .. tag, offset, offset + limit - 1)
+      total = redis.call('zcard', Reqless.ns .. 't:' .. tag),
+      jobs  = redis.call('zrange', Reqless.ns .. 't:' .. tag, offset, offset + limit - 1)
     }
   elseif command == 'top' then
     local offset = assert(tonumber(arg[1] or 0) , 'Tag(): Arg "offset" not a number: ' .. tostring(arg[1]))
     local limit  = assert(tonumber(arg[2] or 25), 'Tag(): Arg "limit" not a number: ' .. tostring(arg[2]))
-    return redis.call('zrevrangebyscore', 'ql:tags', '+inf', 2, 'limit', offset, limit)
+    return redis.call('zrevrangebyscore', Reqless.ns .. 'tags', '+inf', 2, 'limit', offset, limit)
   elseif command ~= 'add' and command ~= 'remove' then
     error('Tag(): First argument must be "add", "remove", "get", or "top"')
   end
 
   local jid  = assert(arg[1], 'Tag(): Arg "jid" missing')
-  local tags = redis.call('hget', ReqlessJob.ns .. jid, 'tags')
+  local job  = Reqless.job(jid)
+  local tags = job:hmget('tags')[1]
   -- If the job has been canceled / deleted, raise an error
   if not tags then
     error('Tag(): Job ' .. jid .. ' does not exist')
@@ -338,10 +648,10 @@ function Reqless.tag(now, command, ...)
         _tags[tag] = true
         table.insert(tags, tag)
       end
-      Reqless.job(jid):insert_tag(now, tag)
+      job:insert_tag(now, tag)
     end
 
-    redis.call('hset', ReqlessJob.ns .. jid, 'tags', cjson.encode(tags))
+    job:hmset('tags', cjson.encode(tags))
     return tags
   end
 
@@ -349,7 +659,7 @@ function Reqless.tag(now, command, ...)
   for i=2, #arg do
     local tag = arg[i]
     _tags[tag] = nil
-    Reqless.job(jid):remove_tag(tag)
+    job:remove_tag(tag)
   end
 
   local results = {}
@@ -359,7 +669,7 @@ function Reqless.tag(now, command, ...)
     end
   end
 
-  redis.call('hset', ReqlessJob.ns .. jid, 'tags', cjson.encode(results))
+  job:hmset('tags', cjson.encode(results))
   return results
 end
 
@@ -406,7 +716,7 @@ function Reqless.cancel(now, ...)
 
       -- Remove this job from whatever worker has it, if any
       if worker and (worker ~= '') then
-        redis.call('zrem', 'ql:w:' .. worker .. ':jobs', jid)
+        redis.call('zrem', Reqless.ns .. 'w:' .. worker .. ':jobs', jid)
         -- If necessary, send a message to the appropriate worker, too
         Reqless.publish('w:' .. worker, encoded)
       end
@@ -432,23 +742,20 @@ function Reqless.cancel(now, ...)
       if state == 'failed' then
         failure = cjson.decode(failure)
         -- We need to make this remove it from the failed queues
-        redis.call('lrem', 'ql:f:' .. failure.group, 0, jid)
-        if redis.call('llen', 'ql:f:' .. failure.group) == 0 then
-          redis.call('srem', 'ql:failures', failure.group)
-        end
+        Reqless.failure_groups.remove(failure.group, jid)
         -- Remove one count from the failed count of the particular
         -- queue
         local bin = failure.when - (failure.when % 86400)
         local failed = redis.call(
-          'hget', 'ql:s:stats:' .. bin .. ':' .. queue, 'failed')
+          'hget', Reqless.ns .. 's:stats:' .. bin .. ':' .. queue, 'failed')
         redis.call('hset',
-          'ql:s:stats:' .. bin .. ':' .. queue, 'failed', failed - 1)
+          Reqless.ns .. 's:stats:' .. bin .. ':' .. queue, 'failed', failed - 1)
       end
 
       job:delete()
 
       -- If the job was being tracked, we should notify
-      if redis.call('zscore', 'ql:tracked', jid) ~= false then
+      if Reqless.tracked(jid) then
         Reqless.publish('canceled', jid)
       end
     end
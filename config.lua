@@ -5,29 +5,60 @@
 -- This represents our default configuration settings. Redis hash values are
 -- strings, so use strings for the defaults for more consistent typing.
 Reqless.config.defaults = {
-  ['application']        = 'reqless',
-  ['grace-period']       = '10',
-  ['heartbeat']          = '60',
-  ['jobs-history']       = '604800',
-  ['jobs-history-count'] = '50000',
-  ['max-job-history']    = '100',
-  ['max-pop-retry']      = '1',
-  ['max-worker-age']     = '86400',
+  ['application']           = 'reqless',
+  ['grace-period']          = '10',
+  ['heartbeat']             = '60',
+  ['history-mode']          = 'capped',
+  ['history-sample-rate']   = '10',
+  ['inline-promotion']      = '1',
+  ['job-layout']            = 'hash',
+  ['jobs-history']          = '604800',
+  ['jobs-history-budget']   = '10',
+  ['jobs-history-count']    = '50000',
+  ['jobs-retention']        = 'sweep',
+  ['max-inline-data']       = '0',
+  ['max-job-history']       = '100',
+  ['max-pop-retry']         = '1',
+  ['max-put-multi']         = '1000',
+  ['max-wake-tokens']       = '0',
+  ['max-worker-age']        = '86400',
+  ['pop-invalidates-locks'] = '1',
+  ['stats-precision']       = '0',
 }
 
+-- The explicitly-set configuration values, read with a single HGETALL the first
+-- time they're needed in an invocation and kept current by `set` and `unset`
+Reqless.config.cache = nil
+
+-- Return the explicitly-set configuration values
+Reqless.config.stored = function()
+  if not Reqless.config.cache then
+    -- Inspired by redis-lua https://github.com/nrk/redis-lua/blob/version-2.0/src/redis.lua
+    local cache = {}
+    local reply = redis.call('hgetall', Reqless.ns .. 'config')
+    for i = 1, #reply, 2 do
+      cache[reply[i]] = reply[i + 1]
+    end
+    Reqless.config.cache = cache
+  end
+  return Reqless.config.cache
+end
+
 -- Get one or more of the keys
 Reqless.config.get = function(key, default)
+  local stored = Reqless.config.stored()
   if key then
-    return redis.call('hget', 'ql:config', key) or
-      Reqless.config.defaults[key] or default
+    return stored[key] or Reqless.config.defaults[key] or default
   end
 
-  -- Inspired by redis-lua https://github.com/nrk/redis-lua/blob/version-2.0/src/redis.lua
-  local reply = redis.call('hgetall', 'ql:config')
-  for i = 1, #reply, 2 do
-    Reqless.config.defaults[reply[i]] = reply[i + 1]
+  local config = {}
+  for option, value in pairs(Reqless.config.defaults) do
+    config[option] = value
   end
-  return Reqless.config.defaults
+  for option, value in pairs(stored) do
+    config[option] = value
+  end
+  return config
 end
 
 -- Set a configuration variable
@@ -41,7 +72,10 @@ Reqless.config.set = function(option, value)
     value  = value
   }))
 
-  redis.call('hset', 'ql:config', option, value)
+  redis.call('hset', Reqless.ns .. 'config', option, value)
+  if Reqless.config.cache then
+    Reqless.config.cache[option] = tostring(value)
+  end
 end
 
 -- Unset a configuration option
@@ -53,5 +87,8 @@ Reqless.config.unset = function(option)
     option = option
   }))
 
-  redis.call('hdel', 'ql:config', option)
+  redis.call('hdel', Reqless.ns .. 'config', option)
+  if Reqless.config.cache then
+    Reqless.config.cache[option] = nil
+  end
 end
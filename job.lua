@@ -4,44 +4,260 @@
 -- It returns an object that represents the job with the provided JID
 -------------------------------------------------------------------------------
 
--- This gets all the data associated with the job with the provided id. If the
--- job is not found, it returns nil. If found, it returns an object with the
--- appropriate properties
-function ReqlessJob:data(...)
-  local job = redis.call(
-      'hmget', ReqlessJob.ns .. self.jid, 'jid', 'klass', 'state', 'queue',
-      'worker', 'priority', 'expires', 'retries', 'remaining', 'data',
-      'tags', 'failure', 'throttles', 'spawned_from_jid')
+-- Fields of the job data that are stored in the job's hash, along with how to
+-- convert the stored value into the value returned in the job data
+ReqlessJob.hash_fields = {
+  jid = function(value) return value end,
+  klass = function(value) return value end,
+  state = function(value) return value end,
+  queue = function(value) return value end,
+  worker = function(value) return value or '' end,
+  priority = function(value) return tonumber(value) end,
+  expires = function(value) return tonumber(value) or 0 end,
+  retries = function(value) return tonumber(value) end,
+  remaining = function(value) return math.floor(tonumber(value)) end,
+  data = function(value) return value end,
+  tags = function(value) return cjson.decode(value) end,
+  failure = function(value) return cjson.decode(value or '{}') end,
+  throttles = function(value) return cjson.decode(value or '[]') end,
+  spawned_from_jid = function(value) return value end,
+  data_size = function(value) return tonumber(value) end,
+}
+
+-- Fields of the job's hash which rarely change once the job is put. When the
+-- `job-layout` config is 'packed', jobs keep these together as one msgpack
+-- array in their 'packed' field, rather than each in its own field, to save
+-- the overhead of each field. Jobs that are stored either way may be read and
+-- written through `hmget` and `hmset`.
+ReqlessJob.packed_fields = {
+  'jid', 'klass', 'data', 'tags', 'throttles', 'spawned_from_jid',
+}
+
+-- The position of each packed field in the packed array
+ReqlessJob.packed_index = {}
+for index, field in ipairs(ReqlessJob.packed_fields) do
+  ReqlessJob.packed_index[field] = index
+end
 
-  -- Return nil if we haven't found it
-  if not job[1] then
-    return nil
+-- Return the packed fields of the job, as read by the last `hmget` or written
+-- by the last `hmset`, or false if the job isn't packed
+function ReqlessJob:packed()
+  if self._packed == nil then
+    local packed = redis.call('hget', ReqlessJob.ns .. self.jid, 'packed')
+    self._packed = packed and cmsgpack.unpack(packed)
   end
+  return self._packed
+end
 
-  local data = {
-    jid = job[1],
-    klass = job[2],
-    state = job[3],
-    queue = job[4],
-    worker = job[5] or '',
-    tracked = redis.call('zscore', 'ql:tracked', self.jid) ~= false,
-    priority = tonumber(job[6]),
-    expires = tonumber(job[7]) or 0,
-    retries = tonumber(job[8]),
-    remaining = math.floor(tonumber(job[9])),
-    data = job[10],
-    tags = cjson.decode(job[11]),
-    history = self:history(),
-    failure = cjson.decode(job[12] or '{}'),
-    throttles = cjson.decode(job[13] or '[]'),
-    spawned_from_jid = job[14],
-    dependents = redis.call('smembers', ReqlessJob.ns .. self.jid .. '-dependents'),
-    dependencies = redis.call('smembers', ReqlessJob.ns .. self.jid .. '-dependencies'),
-  }
+-- Like HMGET of the job's hash, whether or not the job is packed. Fields which
+-- aren't set are false, as they are in the reply of HMGET. The packed fields
+-- are only read, and unpacked, when some of them are asked for.
+function ReqlessJob:hmget(...)
+  local cold = false
+  for _, field in ipairs(arg) do
+    if ReqlessJob.packed_index[field] then
+      cold = true
+      break
+    end
+  end
+  if not cold then
+    return redis.call('hmget', ReqlessJob.ns .. self.jid, unpack(arg))
+  end
+
+  local values = redis.call(
+    'hmget', ReqlessJob.ns .. self.jid, 'packed', unpack(arg))
+  self._packed = values[1] and cmsgpack.unpack(values[1])
+
+  local result = {}
+  for i, field in ipairs(arg) do
+    local index = ReqlessJob.packed_index[field]
+    if self._packed and index then
+      result[i] = self._packed[index]
+    else
+      result[i] = values[i + 1]
+    end
+  end
+  return result
+end
+
+-- Like HMSET of the job's hash, whether or not the job is packed. Setting a
+-- packed field of a packed job rewrites all of its packed fields, and setting
+-- a field to false removes it.
+function ReqlessJob:hmset(...)
+  local packed = false
+  for i = 1, #arg, 2 do
+    if ReqlessJob.packed_index[arg[i]] then
+      packed = self:packed()
+      break
+    end
+  end
+  self:write(true, packed, self:offload_data(true, arg))
+end
+
+-- Save all the fields of a job that's being put, in the layout chosen by the
+-- `job-layout` config. If the job existed before, any fields left over from
+-- it being stored in the other layout are removed.
+function ReqlessJob:store(existed, fields)
+  local packed = false
+  if Reqless.config.get('job-layout') == 'packed' then
+    packed = {}
+    for index = 1, #ReqlessJob.packed_fields do
+      packed[index] = false
+    end
+  end
+
+  local removed = {}
+  if existed then
+    removed = packed and {unpack(ReqlessJob.packed_fields)} or {'packed'}
+  end
+  self._packed = packed
+  self:write(existed, packed, self:offload_data(existed, fields), removed)
+end
+
+-- Write the fields to the job's hash, keeping the packed fields in `packed`
+-- if it isn't false. If the job `existed`, fields set to false are removed,
+-- along with any `removed` fields.
+function ReqlessJob:write(existed, packed, fields, removed)
+  local set = {}
+  removed = removed or {}
+  for i = 1, #fields, 2 do
+    local index = ReqlessJob.packed_index[fields[i]]
+    if packed and index then
+      packed[index] = fields[i + 1]
+    elseif fields[i + 1] then
+      table.insert(set, fields[i])
+      table.insert(set, fields[i + 1])
+    else
+      table.insert(removed, fields[i])
+    end
+  end
+
+  local key = ReqlessJob.ns .. self.jid
+  if existed and #removed > 0 then
+    redis.call('hdel', key, unpack(removed))
+  end
+  if packed then
+    table.insert(set, 'packed')
+    table.insert(set, cmsgpack.pack(packed))
+  end
+  if #set > 0 then
+    redis.call('hmset', key, unpack(set))
+  end
+end
+
+-- Data larger than the `max-inline-data` config is kept in its own key rather
+-- than in the job's hash, so that it's only read when it's needed, with its
+-- size kept in the `data_size` field. Replace any data among the fields to be
+-- written with its size if it's that large. If it isn't, then any data that
+-- was kept in its own key before is removed, unless the job is new.
+function ReqlessJob:offload_data(existed, fields)
+  local limit = tonumber(Reqless.config.get('max-inline-data'))
+  if limit <= 0 then
+    return fields
+  end
+
+  for i = 1, #fields, 2 do
+    if fields[i] == 'data' then
+      local data = fields[i + 1]
+      if #data > limit then
+        redis.call('set', ReqlessJob.ns .. self.jid .. '-data', data)
+        if existed then
+          self:retain_key(ReqlessJob.ns .. self.jid .. '-data')
+        end
+        fields[i + 1] = false
+        table.insert(fields, 'data_size')
+        table.insert(fields, #data)
+      elseif existed and redis.call(
+          'hdel', ReqlessJob.ns .. self.jid, 'data_size') == 1 then
+        redis.call('del', ReqlessJob.ns .. self.jid .. '-data')
+      end
+      break
+    end
+  end
+  return fields
+end
+
+-- Fields of the job data that require lookups beyond the job's hash
+ReqlessJob.derived_fields = {
+  tracked = function(job)
+    return Reqless.tracked(job.jid)
+  end,
+  history = function(job)
+    return job:history()
+  end,
+  dependents = function(job)
+    return redis.call('smembers', ReqlessJob.ns .. job.jid .. '-dependents')
+  end,
+  dependencies = function(job)
+    return redis.call('smembers', ReqlessJob.ns .. job.jid .. '-dependencies')
+  end,
+}
+
+-- All the fields of the job data
+ReqlessJob.all_fields = {
+  'jid', 'klass', 'state', 'queue', 'worker', 'tracked', 'priority', 'expires',
+  'retries', 'remaining', 'data', 'tags', 'history', 'failure', 'throttles',
+  'spawned_from_jid', 'dependents', 'dependencies',
+}
+
+-- Named lists of fields that may be requested in place of an explicit list of
+-- fields. The `lite` profile includes every field that is stored in the job's
+-- hash, skipping the history, tracked, dependents and dependencies lookups.
+-- The `listing` profile is like `lite`, but has the size of the job's data in
+-- `data_size` rather than the data itself, so that data kept in its own key
+-- isn't read, and is what's listed unless other fields are asked for. The
+-- `full` profile includes every field.
+ReqlessJob.field_profiles = {
+  full = ReqlessJob.all_fields,
+  lite = {
+    'jid', 'klass', 'state', 'queue', 'worker', 'priority', 'expires',
+    'retries', 'remaining', 'data', 'tags', 'failure', 'throttles',
+    'spawned_from_jid',
+  },
+  listing = {
+    'jid', 'klass', 'state', 'queue', 'worker', 'priority', 'expires',
+    'retries', 'remaining', 'data_size', 'tags', 'failure', 'throttles',
+    'spawned_from_jid',
+  },
+}
+
+-- Resolve the `fields` argument accepted by commands that return job data into
+-- a list of field names. The argument may be the name of a field profile or a
+-- JSON-encoded array of field names. If no fields are provided, those of the
+-- `default` profile are returned, or if there's none, nil, meaning that all
+-- fields should be returned.
+function ReqlessJob.parse_fields(fields, default)
+  if fields == nil or fields == '' then
+    return ReqlessJob.field_profiles[default]
+  end
+
+  if ReqlessJob.field_profiles[fields] then
+    return ReqlessJob.field_profiles[fields]
+  end
+
+  local parsed = cjson.decode(fields)
+  assert(type(parsed) == 'table',
+    'Fields(): Arg "fields" not a profile or JSON array: ' .. tostring(fields))
+  for _, field in ipairs(parsed) do
+    if ReqlessJob.hash_fields[field] == nil and
+      ReqlessJob.derived_fields[field] == nil then
+      error('Fields(): Unknown field "' .. tostring(field) .. '"')
+    end
+  end
+  return parsed
+end
 
+-- This gets all the data associated with the job with the provided id. If the
+-- job is not found, it returns nil. If found, it returns an object with the
+-- appropriate properties. If any field names are provided, then a list of the
+-- values of just those fields is returned instead.
+function ReqlessJob:data(...)
   if #arg > 0 then
-    -- This section could probably be optimized, but I wanted the interface
-    -- in place first
+    local data = self:fields(arg)
+    if not data then
+      return nil
+    end
+
     local response = {}
     for _, key in ipairs(arg) do
       table.insert(response, data[key])
@@ -49,9 +265,323 @@ function ReqlessJob:data(...)
     return response
   end
 
+  return self:fields(ReqlessJob.all_fields)
+end
+
+-- Like `data`, but only reads the provided list of fields, only issuing the
+-- lookups required to produce them. If `fields` is nil, all fields are read.
+-- Data that's kept in its own key is only read if `data` is among the fields,
+-- while `data_size` is the size of the data wherever it's kept.
+function ReqlessJob:fields(fields)
+  fields = fields or ReqlessJob.all_fields
+
+  -- The state is always read in order to tell whether the job exists, since
+  -- unlike the jid it's never packed, and the size of the data in order to
+  -- tell whether it's kept in its own key
+  local hash_fields = {'state'}
+  local wants_data, wants_size = false, false
+  for _, field in ipairs(fields) do
+    if field == 'data' then
+      wants_data = true
+    elseif field == 'data_size' then
+      wants_size = true
+    end
+    if field ~= 'jid' and field ~= 'state' and field ~= 'data' and
+      field ~= 'data_size' and ReqlessJob.hash_fields[field] then
+      table.insert(hash_fields, field)
+    end
+  end
+  if wants_data or wants_size then
+    table.insert(hash_fields, 'data')
+  end
+  table.insert(hash_fields, 'data_size')
+
+  local values = self:hmget(unpack(hash_fields))
+
+  -- Return nil if we haven't found it
+  if not values[1] then
+    return nil
+  end
+
+  local stored = {jid = self.jid}
+  for i, field in ipairs(hash_fields) do
+    stored[field] = values[i]
+  end
+
+  local data = {}
+  for _, field in ipairs(fields) do
+    local derived = ReqlessJob.derived_fields[field]
+    if derived then
+      data[field] = derived(self)
+    else
+      data[field] = ReqlessJob.hash_fields[field](stored[field])
+    end
+  end
+
+  if wants_data and not stored.data and stored.data_size then
+    data.data = redis.call('get', ReqlessJob.ns .. self.jid .. '-data')
+  end
+  if wants_size and stored.data then
+    data.data_size = #stored.data
+  end
   return data
 end
 
+-- Return the data for each of the provided jids that exists, limited to the
+-- provided list of fields if one is given
+function ReqlessJob.multi_fields(jids, fields)
+  local response = {}
+  for _, jid in ipairs(jids) do
+    table.insert(response, Reqless.job(jid):fields(fields))
+  end
+  return response
+end
+
+-- The work deferred until the end of a batch of jobs in this invocation, if
+-- one is underway. Within a batch, stats and failures are counted, throttles
+-- released and completed jobs expired once rather than once per job.
+ReqlessJob.deferred = nil
+
+-- Add the value to the list kept for the key in the deferred table, keeping
+-- the order in which keys were first seen
+function ReqlessJob.defer_add(deferred, key, value)
+  if not deferred[key] then
+    deferred[key] = {}
+    table.insert(deferred, key)
+  end
+  table.insert(deferred[key], value)
+end
+
+-- Apply an operation to each item of a batch, collecting the outcome of each
+-- in order. `prepare` checks that the operation can be applied to the item,
+-- and returns a function that applies it, without writing anything itself.
+-- The outcome holds the result of the operation under `key`, or the error
+-- raised preparing it, so that one item that can't be operated on doesn't stop
+-- the others. Errors raised once the operation is writing aren't caught. Work
+-- that can be shared across the batch is done once, at the end, for the items
+-- whose operation returned.
+function ReqlessJob.batch(now, items, key, prepare)
+  local outcomes = {}
+  local deferred = ReqlessJob.new_deferred()
+  for index, item in ipairs(items) do
+    local ok, result = pcall(prepare, index, item)
+    local outcome = {jid = item}
+    if type(item) == 'table' then
+      outcome.jid = item.jid
+    end
+    if ok then
+      -- The work the operation defers is only added to the batch's once the
+      -- operation has returned
+      ReqlessJob.deferred = ReqlessJob.new_deferred()
+      local applied, value = pcall(result)
+      local item_deferred = ReqlessJob.deferred
+      ReqlessJob.deferred = nil
+      if not applied then
+        -- The earlier items are done, so their deferred work is too
+        ReqlessJob.flush_deferred(now, deferred)
+        error(value, 0)
+      end
+      ReqlessJob.merge_deferred(deferred, item_deferred)
+      outcome[key] = value
+    else
+      -- Errors raised by redis commands are tables rather than strings
+      if type(result) == 'table' then
+        result = result.err
+      end
+      outcome.error = string.gsub(tostring(result), '^.-:%d+: ', '')
+    end
+    table.insert(outcomes, outcome)
+  end
+
+  ReqlessJob.flush_deferred(now, deferred)
+  return outcomes
+end
+
+-- A table of no deferred work
+function ReqlessJob.new_deferred()
+  return {completed = false, failures = {}, groups = {}, releases = {}}
+end
+
+-- Add the deferred work of `other` to that of `deferred`
+function ReqlessJob.merge_deferred(deferred, other)
+  for _, kind in ipairs({'failures', 'groups', 'releases'}) do
+    for _, key in ipairs(other[kind]) do
+      for _, value in ipairs(other[kind][key]) do
+        ReqlessJob.defer_add(deferred[kind], key, value)
+      end
+    end
+  end
+  deferred.completed = deferred.completed or other.completed
+end
+
+-- Do the deferred work, once for the whole batch
+function ReqlessJob.flush_deferred(now, deferred)
+  for _, key in ipairs(deferred.failures) do
+    local count = #deferred.failures[key]
+    redis.call('hincrby', key, 'failures', count)
+    redis.call('hincrby', key, 'failed'  , count)
+  end
+  -- The jids are passed on a thousand at a time, since lua can only unpack so
+  -- many
+  for _, group in ipairs(deferred.groups) do
+    local jids = deferred.groups[group]
+    for index = 1, #jids, 1000 do
+      Reqless.failure_groups.add(
+        now, group, unpack(jids, index, math.min(index + 999, #jids)))
+    end
+  end
+  for _, tid in ipairs(deferred.releases) do
+    local jids = deferred.releases[tid]
+    for index = 1, #jids, 1000 do
+      Reqless.throttle(tid):release(
+        now, unpack(jids, index, math.min(index + 999, #jids)))
+    end
+  end
+  ReqlessQueue.flush_stats()
+  if deferred.completed then
+    ReqlessJob.expire_completed(now)
+  end
+end
+
+-- Count a failure of this job in the queue's stats for the day, and add it to
+-- the jobs that failed in the group
+function ReqlessJob:count_failure(now, queue_name, group)
+  -- The bin is midnight of the provided day
+  -- 24 * 60 * 60 = 86400
+  local bin = now - (now % 86400)
+  local key = Reqless.ns .. 's:stats:' .. bin .. ':' .. queue_name
+
+  local deferred = ReqlessJob.deferred
+  if deferred then
+    ReqlessJob.defer_add(deferred.failures, key, self.jid)
+    ReqlessJob.defer_add(deferred.groups, group, self.jid)
+    return
+  end
+
+  redis.call('hincrby', key, 'failures', 1)
+  redis.call('hincrby', key, 'failed'  , 1)
+  -- And add this particular instance to the failed group
+  Reqless.failure_groups.add(now, group, self.jid)
+end
+
+-- Delete the data of up to `budget` of the completed jobs that are older
+-- than `jobs-history`, or beyond the most recent `jobs-history-count`, oldest
+-- first. The budget defaults to `jobs-history-budget`, the most that a single
+-- completion deletes, so that no completion stalls on a backlog. Returns how
+-- many were deleted, and how many are left to expire:
+--
+--  {
+--      'expired': 10,
+--      'remaining': 0
+--  }
+function ReqlessJob.expire_completed(now, budget)
+  local count = Reqless.config.get('jobs-history-count')
+  local time  = Reqless.config.get('jobs-history')
+
+  -- These are the default values
+  count  = tonumber(count or 50000)
+  time   = tonumber(time  or 7 * 24 * 60 * 60)
+  budget = assert(
+    tonumber(budget or Reqless.config.get('jobs-history-budget', 10)),
+    'Expire(): Arg "budget" not a number: ' .. tostring(budget))
+
+  -- Completed jobs are sorted by completion time, so those that are too old
+  -- and those beyond the most recent 'count' are all at the front
+  local excess = math.max(
+    redis.call('zcount', Reqless.ns .. 'completed', 0, now - time),
+    redis.call('zcard', Reqless.ns .. 'completed') - count)
+  local expired = math.min(excess, budget)
+
+  if expired > 0 then
+    -- Any jobs that need to be expired... delete
+    for _, jid in ipairs(redis.call('zrange', Reqless.ns .. 'completed', 0, expired - 1)) do
+      Reqless.job(jid):delete()
+    end
+
+    -- And now remove those from the queued-for-cleanup queue
+    redis.call('zremrangebyrank', Reqless.ns .. 'completed', 0, expired - 1)
+  end
+
+  return {
+    expired   = expired,
+    remaining = excess - expired,
+  }
+end
+
+-- With the `ttl` retention mode, have redis expire the data of this completed
+-- job once it's older than `jobs-history`, rather than deleting it from
+-- `ql:completed`. That index, and the index of each of the job's tags, is
+-- only trimmed by score, which doesn't delete any job data.
+function ReqlessJob:retain(now)
+  local count = tonumber(Reqless.config.get('jobs-history-count', 50000))
+  local time  = tonumber(Reqless.config.get('jobs-history', 7 * 24 * 60 * 60))
+
+  local tags = cjson.decode(self:hmget('tags')[1] or '[]')
+
+  local ttl = math.ceil(time)
+  redis.call('expire', ReqlessJob.ns .. self.jid, ttl)
+  redis.call('expire', ReqlessJob.ns .. self.jid .. '-history', ttl)
+  redis.call('expire', ReqlessJob.ns .. self.jid .. '-dependencies', ttl)
+  redis.call('expire', ReqlessJob.ns .. self.jid .. '-data', ttl)
+
+  -- Note when the job expires from each of its tags
+  for _, tag in ipairs(tags) do
+    redis.call('zadd', Reqless.ns .. 't-expires:' .. tag, now + time, self.jid)
+    ReqlessJob.expire_tag(now, tag)
+  end
+
+  redis.call('zremrangebyscore', Reqless.ns .. 'completed', 0, now - time)
+  redis.call('zremrangebyrank', Reqless.ns .. 'completed', 0, (-1-count))
+end
+
+-- Have redis expire one of the job's keys that's just been created along with
+-- its hash, if that's to be expired because the job was completed with the
+-- `ttl` retention mode
+function ReqlessJob:retain_key(key)
+  local ttl = redis.call('pttl', ReqlessJob.ns .. self.jid)
+  if ttl > 0 then
+    redis.call('pexpire', key, ttl)
+  end
+end
+
+-- Remove the completed jobs that redis has expired from the index of the tag.
+-- Jobs that have since been put again are just no longer expiring, and those
+-- that redis hasn't expired yet are left for later, as are any beyond the
+-- `jobs-history-budget` oldest.
+function ReqlessJob.expire_tag(now, tag)
+  local key = Reqless.ns .. 't-expires:' .. tag
+  local jids = redis.call('zrangebyscore', key, 0, now,
+    'LIMIT', 0, tonumber(Reqless.config.get('jobs-history-budget', 10)))
+  if #jids == 0 then
+    return
+  end
+
+  local expired = {}
+  local done = {}
+  for _, jid in ipairs(jids) do
+    local state = redis.call('hget', ReqlessJob.ns .. jid, 'state')
+    if not state then
+      table.insert(expired, jid)
+      table.insert(done, jid)
+    elseif state ~= 'complete' then
+      table.insert(done, jid)
+    end
+  end
+
+  if #done > 0 then
+    redis.call('zrem', key, unpack(done))
+  end
+  if #expired > 0 then
+    local namespaced_tag = Reqless.ns .. 't:' .. tag
+    local removed = redis.call('zrem', namespaced_tag, unpack(expired))
+    if redis.call('zcard', namespaced_tag) == 0 then
+      redis.call('zrem', Reqless.ns .. 'tags', tag)
+    elseif removed > 0 then
+      redis.call('zincrby', Reqless.ns .. 'tags', -removed, tag)
+    end
+  end
+end
+
 -- Complete a job and optionally put it in another queue, either scheduled or
 -- to be considered waiting immediately. It can also optionally accept other
 -- jids on which this job will be considered dependent before it's considered
@@ -65,6 +595,13 @@ end
 --          '["jid1", "jid2", ...]')
 ---
 function ReqlessJob:complete(now, worker, queue_name, raw_data, ...)
+  return self:prepare_complete(
+    now, worker, queue_name, raw_data, unpack(arg))()
+end
+
+-- Check that the job can be completed, as `complete` does, and return a
+-- function that completes it. Nothing is written until that's called.
+function ReqlessJob:prepare_complete(now, worker, queue_name, raw_data, ...)
   assert(worker, 'Complete(): Arg "worker" missing')
   assert(queue_name , 'Complete(): Arg "queue_name" missing')
   local data = assert(cjson.decode(raw_data),
@@ -96,8 +633,7 @@ function ReqlessJob:complete(now, worker, queue_name, raw_data, ...)
 
   -- First things first, we should see if the worker still owns this job
   local lastworker, state, priority, retries, current_queue = unpack(
-    redis.call('hmget', ReqlessJob.ns .. self.jid, 'worker', 'state',
-      'priority', 'retries', 'queue'))
+    self:hmget('worker', 'state', 'priority', 'retries', 'queue'))
 
   if lastworker == false then
     error('Complete(): Job does not exist')
@@ -111,168 +647,214 @@ function ReqlessJob:complete(now, worker, queue_name, raw_data, ...)
       tostring(current_queue))
   end
 
-  -- Now we can assume that the worker does own the job. We need to
-  --    1) Remove the job from the 'locks' from the old queue
-  --    2) Enqueue it in the next stage if necessary
-  --    3) Update the data
-  --    4) Mark the job as completed, remove the worker, remove expires, and
-  --          update history
-  self:history(now, 'done')
+  return function()
+    -- Now we can assume that the worker does own the job. We need to
+    --    1) Remove the job from the 'locks' from the old queue
+    --    2) Enqueue it in the next stage if necessary
+    --    3) Update the data
+    --    4) Mark the job as completed, remove the worker, remove expires, and
+    --          update history
+    self:history(now, 'done', nil, queue_name)
 
-  redis.call('hset', ReqlessJob.ns .. self.jid, 'data', raw_data)
+    self:hmset('data', raw_data)
 
-  -- Remove the job from the previous queue
-  local queue = Reqless.queue(queue_name)
-  queue:remove_job(self.jid)
+    -- Remove the job from the previous queue
+    local queue = Reqless.queue(queue_name)
+    queue:remove_job(self.jid)
 
-  self:throttles_release(now)
+    self:throttles_release(now)
 
-  -- Calculate how long the job has been running.
-  local popped_time = tonumber(
-    redis.call('hget', ReqlessJob.ns .. self.jid, 'time') or now)
-  local run_time = now - popped_time
-  queue:stat(now, 'run', run_time)
-  redis.call('hset', ReqlessJob.ns .. self.jid,
-    'time', string.format("%.20f", now))
+    -- Calculate how long the job has been running.
+    local popped_time = tonumber(
+      redis.call('hget', ReqlessJob.ns .. self.jid, 'time') or now)
+    local run_time = now - popped_time
+    queue:stat(now, 'run', run_time)
+    if not ReqlessJob.deferred then
+      ReqlessQueue.flush_stats()
+    end
+    redis.call('hset', ReqlessJob.ns .. self.jid,
+      'time', string.format("%.20f", now))
 
-  -- Remove this job from the jobs that the worker that was running it has
-  redis.call('zrem', 'ql:w:' .. worker .. ':jobs', self.jid)
+    -- Remove this job from the jobs that the worker that was running it has
+    redis.call('zrem', Reqless.ns .. 'w:' .. worker .. ':jobs', self.jid)
 
-  if redis.call('zscore', 'ql:tracked', self.jid) ~= false then
-    Reqless.publish('completed', self.jid)
-  end
+    if Reqless.tracked(self.jid) then
+      Reqless.publish('completed', self.jid)
+    end
 
-  if next_queue_name then
-    local next_queue = Reqless.queue(next_queue_name)
+    if next_queue_name then
+      local next_queue = Reqless.queue(next_queue_name)
+      -- Send a message out to log
+      Reqless.publish('log', cjson.encode({
+        jid = self.jid,
+        event = 'advanced',
+        queue = queue_name,
+        to = next_queue_name,
+      }))
+
+      -- Enqueue the job
+      self:history(now, 'put', {queue = next_queue_name})
+
+      -- We're going to make sure that this queue is in the
+      -- set of known queues
+      if redis.call(
+        'zscore', Reqless.ns .. 'queues', next_queue_name) == false then
+        redis.call('zadd', Reqless.ns .. 'queues', now, next_queue_name)
+      end
+
+      redis.call('hmset', ReqlessJob.ns .. self.jid,
+        'state', 'waiting',
+        'worker', '',
+        'failure', '{}',
+        'queue', next_queue_name,
+        'expires', 0,
+        'remaining', tonumber(retries))
+
+      if (delay > 0) and (#depends == 0) then
+        next_queue.scheduled:add(now + delay, self.jid)
+        return 'scheduled'
+      end
+
+      -- These are the jids we legitimately have to wait on
+      local count = 0
+      for _, j in ipairs(depends) do
+        -- Make sure it's something other than 'nil' or complete.
+        local state = redis.call('hget', ReqlessJob.ns .. j, 'state')
+        if (state and state ~= 'complete') then
+          count = count + 1
+          redis.call(
+            'sadd', ReqlessJob.ns .. j .. '-dependents',self.jid)
+          redis.call(
+            'sadd', ReqlessJob.ns .. self.jid .. '-dependencies', j)
+        end
+      end
+      if count > 0 then
+        next_queue.depends:add(now, self.jid)
+        redis.call('hset', ReqlessJob.ns .. self.jid, 'state', 'depends')
+        if delay > 0 then
+          -- We've already put it in 'depends'. Now, we must just save the data
+          -- for when it's scheduled
+          next_queue.depends:add(now, self.jid)
+          redis.call(
+            'hset', ReqlessJob.ns .. self.jid, 'scheduled', now + delay)
+        end
+        return 'depends'
+      end
+
+      next_queue.work:add(now, priority, self.jid)
+      return 'waiting'
+    end
     -- Send a message out to log
     Reqless.publish('log', cjson.encode({
       jid = self.jid,
-      event = 'advanced',
+      event = 'completed',
       queue = queue_name,
-      to = next_queue_name,
     }))
 
-    -- Enqueue the job
-    self:history(now, 'put', {queue = next_queue_name})
-
-    -- We're going to make sure that this queue is in the
-    -- set of known queues
-    if redis.call('zscore', 'ql:queues', next_queue_name) == false then
-      redis.call('zadd', 'ql:queues', now, next_queue_name)
-    end
-
     redis.call('hmset', ReqlessJob.ns .. self.jid,
-      'state', 'waiting',
+      'state', 'complete',
       'worker', '',
       'failure', '{}',
-      'queue', next_queue_name,
+      'queue', '',
       'expires', 0,
       'remaining', tonumber(retries))
 
-    if (delay > 0) and (#depends == 0) then
-      next_queue.scheduled.add(now + delay, self.jid)
-      return 'scheduled'
-    end
+    -- Schedule this job for destructination eventually
+    redis.call('zadd', Reqless.ns .. 'completed', now, self.jid)
 
-    -- These are the jids we legitimately have to wait on
-    local count = 0
-    for _, j in ipairs(depends) do
-      -- Make sure it's something other than 'nil' or complete.
-      local state = redis.call('hget', ReqlessJob.ns .. j, 'state')
-      if (state and state ~= 'complete') then
-        count = count + 1
-        redis.call(
-          'sadd', ReqlessJob.ns .. j .. '-dependents',self.jid)
-        redis.call(
-          'sadd', ReqlessJob.ns .. self.jid .. '-dependencies', j)
-      end
+    -- Do the completion dance, unless it's left to redis or the end of a batch
+    if Reqless.config.get('jobs-retention') == 'ttl' then
+      self:retain(now)
+    elseif ReqlessJob.deferred then
+      ReqlessJob.deferred.completed = true
+    else
+      ReqlessJob.expire_completed(now)
     end
-    if count > 0 then
-      next_queue.depends.add(now, self.jid)
-      redis.call('hset', ReqlessJob.ns .. self.jid, 'state', 'depends')
-      if delay > 0 then
-        -- We've already put it in 'depends'. Now, we must just save the data
-        -- for when it's scheduled
-        next_queue.depends.add(now, self.jid)
-        redis.call('hset', ReqlessJob.ns .. self.jid, 'scheduled', now + delay)
+
+    -- Alright, if this has any dependents, then we should go ahead
+    -- and unstick those guys.
+    for _, j in ipairs(redis.call(
+      'smembers', ReqlessJob.ns .. self.jid .. '-dependents')) do
+      redis.call('srem', ReqlessJob.ns .. j .. '-dependencies', self.jid)
+      if redis.call(
+        'scard', ReqlessJob.ns .. j .. '-dependencies') == 0 then
+        local other_queue_name, priority, scheduled = unpack(
+          redis.call('hmget', ReqlessJob.ns .. j,
+            'queue', 'priority', 'scheduled'))
+        if other_queue_name then
+          local other_queue = Reqless.queue(other_queue_name)
+          other_queue.depends:remove(j)
+          if scheduled then
+            other_queue.scheduled:add(scheduled, j)
+            redis.call('hset', ReqlessJob.ns .. j, 'state', 'scheduled')
+            redis.call('hdel', ReqlessJob.ns .. j, 'scheduled')
+          else
+            other_queue.work:add(now, priority, j)
+            redis.call('hset', ReqlessJob.ns .. j, 'state', 'waiting')
+          end
+        end
       end
-      return 'depends'
     end
 
-    next_queue.work.add(now, priority, self.jid)
-    return 'waiting'
-  end
-  -- Send a message out to log
-  Reqless.publish('log', cjson.encode({
-    jid = self.jid,
-    event = 'completed',
-    queue = queue_name,
-  }))
-
-  redis.call('hmset', ReqlessJob.ns .. self.jid,
-    'state', 'complete',
-    'worker', '',
-    'failure', '{}',
-    'queue', '',
-    'expires', 0,
-    'remaining', tonumber(retries))
-
-  -- Do the completion dance
-  local count = Reqless.config.get('jobs-history-count')
-  local time  = Reqless.config.get('jobs-history')
-
-  -- These are the default values
-  count = tonumber(count or 50000)
-  time  = tonumber(time  or 7 * 24 * 60 * 60)
-
-  -- Schedule this job for destructination eventually
-  redis.call('zadd', 'ql:completed', now, self.jid)
+    -- Delete our dependents key
+    redis.call('del', ReqlessJob.ns .. self.jid .. '-dependents')
 
-  -- Now look at the expired job data. First, based on the current time
-  local jids = redis.call('zrangebyscore', 'ql:completed', 0, now - time)
-  -- Any jobs that need to be expired... delete
-  for _, jid in ipairs(jids) do
-    Reqless.job(jid):delete()
+    return 'complete'
   end
+end
 
-  -- And now remove those from the queued-for-cleanup queue
-  redis.call('zremrangebyscore', 'ql:completed', 0, now - time)
-
-  -- Now take the all by the most recent 'count' ids
-  jids = redis.call('zrange', 'ql:completed', 0, (-1-count))
-  for _, jid in ipairs(jids) do
-    Reqless.job(jid):delete()
-  end
-  redis.call('zremrangebyrank', 'ql:completed', 0, (-1-count))
-
-  -- Alright, if this has any dependents, then we should go ahead
-  -- and unstick those guys.
-  for _, j in ipairs(redis.call(
-    'smembers', ReqlessJob.ns .. self.jid .. '-dependents')) do
-    redis.call('srem', ReqlessJob.ns .. j .. '-dependencies', self.jid)
-    if redis.call(
-      'scard', ReqlessJob.ns .. j .. '-dependencies') == 0 then
-      local other_queue_name, priority, scheduled = unpack(
-        redis.call('hmget', ReqlessJob.ns .. j, 'queue', 'priority', 'scheduled'))
-      if other_queue_name then
-        local other_queue = Reqless.queue(other_queue_name)
-        other_queue.depends.remove(j)
-        if scheduled then
-          other_queue.scheduled.add(scheduled, j)
-          redis.call('hset', ReqlessJob.ns .. j, 'state', 'scheduled')
-          redis.call('hdel', ReqlessJob.ns .. j, 'scheduled')
-        else
-          other_queue.work.add(now, priority, j)
-          redis.call('hset', ReqlessJob.ns .. j, 'state', 'waiting')
-        end
+-- Complete each of a batch of jobs held by the worker. `jobs` is a JSON array
+-- of objects with the arguments to `Complete`:
+--
+--  [{
+--      'jid': 'jid',
+--      'queue': 'queue',
+--      'data': {...},
+--      # All of the following are optional
+--      'next': 'next-queue',
+--      'delay': 0,
+--      'depends': [...]
+--  }, ...]
+--
+-- A job that can't be completed doesn't stop the others. Returns the outcome
+-- of each job, in order, as either its new state or the reason it failed:
+--
+--  [{
+--      'jid': 'jid',
+--      'state': 'complete'
+--  }, {
+--      'jid': 'other',
+--      'error': 'Complete(): Job does not exist'
+--  }]
+function ReqlessJob.completeMulti(now, worker, raw_jobs)
+  assert(worker, 'CompleteMulti(): Arg "worker" missing')
+  local jobs = assert(cjson.decode(raw_jobs or ''),
+    'CompleteMulti(): Arg "jobs" missing or not JSON: ' .. tostring(raw_jobs))
+  assert(type(jobs) == 'table',
+    'CompleteMulti(): Arg "jobs" not a JSON array: ' .. tostring(raw_jobs))
+
+  return ReqlessJob.batch(now, jobs, 'state', function(index, job)
+    assert(type(job) == 'table',
+      'CompleteMulti(): Job ' .. index .. ' not a JSON object')
+    assert(job.jid, 'CompleteMulti(): Job ' .. index .. ' Arg "jid" missing')
+    local raw_data = job.data
+    if type(raw_data) == 'table' then
+      raw_data = cjson.encode(raw_data)
+    end
+    local options = {}
+    for _, key in ipairs({'next', 'delay'}) do
+      if job[key] ~= nil then
+        table.insert(options, key)
+        table.insert(options, job[key])
       end
     end
-  end
-
-  -- Delete our dependents key
-  redis.call('del', ReqlessJob.ns .. self.jid .. '-dependents')
-
-  return 'complete'
+    if job.depends ~= nil then
+      table.insert(options, 'depends')
+      table.insert(options, cjson.encode(job.depends))
+    end
+    return Reqless.job(job.jid):prepare_complete(
+      now, worker, job.queue, raw_data, unpack(options))
+  end)
 end
 
 -- Fail(now, worker, group, message, [data])
@@ -302,21 +884,23 @@ end
 --    5) the current time
 --    6) [data]
 function ReqlessJob:fail(now, worker, group, message, data)
+  return self:prepare_fail(now, worker, group, message, data)()
+end
+
+-- Check that the job can be failed, as `fail` does, and return a function
+-- that fails it. Nothing is written until that's called.
+function ReqlessJob:prepare_fail(now, worker, group, message, data)
   local worker  = assert(worker           , 'Fail(): Arg "worker" missing')
   local group   = assert(group            , 'Fail(): Arg "group" missing')
   local message = assert(message          , 'Fail(): Arg "message" missing')
 
-  -- The bin is midnight of the provided day
-  -- 24 * 60 * 60 = 86400
-  local bin = now - (now % 86400)
-
   if data then
     data = cjson.decode(data)
   end
 
   -- First things first, we should get the history
-  local queue_name, state, oldworker = unpack(redis.call(
-    'hmget', ReqlessJob.ns .. self.jid, 'queue', 'state', 'worker'))
+  local queue_name, state, oldworker = unpack(
+    self:hmget('queue', 'state', 'worker'))
 
   -- If the job has been completed, we cannot fail it
   if not state then
@@ -327,64 +911,85 @@ function ReqlessJob:fail(now, worker, group, message, data)
     error('Fail(): Job running with another worker: ' .. oldworker)
   end
 
-  -- Send out a log message
-  Reqless.publish('log', cjson.encode({
-    jid = self.jid,
-    event = 'failed',
-    worker = worker,
-    group = group,
-    message = message,
-  }))
+  return function()
+    -- Send out a log message
+    Reqless.publish('log', cjson.encode({
+      jid = self.jid,
+      event = 'failed',
+      worker = worker,
+      group = group,
+      message = message,
+    }))
 
-  if redis.call('zscore', 'ql:tracked', self.jid) ~= false then
-    Reqless.publish('failed', self.jid)
-  end
+    if Reqless.tracked(self.jid) then
+      Reqless.publish('failed', self.jid)
+    end
 
-  -- Remove this job from the jobs that the worker that was running it has
-  redis.call('zrem', 'ql:w:' .. worker .. ':jobs', self.jid)
+    -- Remove this job from the jobs that the worker that was running it has
+    redis.call('zrem', Reqless.ns .. 'w:' .. worker .. ':jobs', self.jid)
 
-  -- Now, take the element of the history for which our provided worker is
-  -- the worker, and update 'failed'
-  self:history(now, 'failed', {worker = worker, group = group})
+    -- Now, take the element of the history for which our provided worker is
+    -- the worker, and update 'failed'
+    self:history(now, 'failed', {worker = worker, group = group}, queue_name)
 
-  -- Increment the number of failures for that queue for the
-  -- given day.
-  redis.call('hincrby', 'ql:s:stats:' .. bin .. ':' .. queue_name, 'failures', 1)
-  redis.call('hincrby', 'ql:s:stats:' .. bin .. ':' .. queue_name, 'failed'  , 1)
+    -- Now remove the instance from the schedule, and work queues for the
+    -- queue it's in
+    local queue = Reqless.queue(queue_name)
+    queue:remove_job(self.jid)
 
-  -- Now remove the instance from the schedule, and work queues for the
-  -- queue it's in
-  local queue = Reqless.queue(queue_name)
-  queue:remove_job(self.jid)
+    -- The reason that this appears here is that the above will fail if the
+    -- job doesn't exist
+    if data then
+      self:hmset('data', cjson.encode(data))
+    end
 
-  -- The reason that this appears here is that the above will fail if the
-  -- job doesn't exist
-  if data then
-    redis.call('hset', ReqlessJob.ns .. self.jid, 'data', cjson.encode(data))
-  end
+    redis.call('hmset', ReqlessJob.ns .. self.jid,
+      'state', 'failed',
+      'worker', '',
+      'expires', '',
+      'failure', cjson.encode({
+        group   = group,
+        message = message,
+        when    = math.floor(now),
+        worker  = worker
+      }))
 
-  redis.call('hmset', ReqlessJob.ns .. self.jid,
-    'state', 'failed',
-    'worker', '',
-    'expires', '',
-    'failure', cjson.encode({
-      group   = group,
-      message = message,
-      when    = math.floor(now),
-      worker  = worker
-    }))
+    self:throttles_release(now)
 
-  self:throttles_release(now)
+    -- Increment the number of failures for that queue for the given day, and
+    -- add this particular instance to the failed groups
+    self:count_failure(now, queue_name, group)
 
-  -- Add this group of failure to the list of failures
-  redis.call('sadd', 'ql:failures', group)
-  -- And add this particular instance to the failed groups
-  redis.call('lpush', 'ql:f:' .. group, self.jid)
+    -- Here is where we'd increment stats about the particular stage
+    -- and possibly the workers
 
-  -- Here is where we'd increment stats about the particular stage
-  -- and possibly the workers
+    return self.jid
+  end
+end
 
-  return self.jid
+-- Fail each of the jobs with the provided jids, held by the worker, with the
+-- same group and message. A job that can't be failed doesn't stop the others.
+-- Returns the outcome of each job, in order:
+--
+--  [{
+--      'jid': 'jid',
+--      'failed': 'jid'
+--  }, {
+--      'jid': 'other',
+--      'error': 'Fail(): Job does not exist'
+--  }]
+function ReqlessJob.failMulti(now, raw_jids, worker, group, message)
+  local jids = assert(cjson.decode(raw_jids or ''),
+    'FailMulti(): Arg "jids" missing or not JSON: ' .. tostring(raw_jids))
+  assert(type(jids) == 'table',
+    'FailMulti(): Arg "jids" not a JSON array: ' .. tostring(raw_jids))
+  assert(worker , 'FailMulti(): Arg "worker" missing')
+  assert(group  , 'FailMulti(): Arg "group" missing')
+  assert(message, 'FailMulti(): Arg "message" missing')
+
+  return ReqlessJob.batch(now, jids, 'failed', function(index, jid)
+    return Reqless.job(jid):prepare_fail(now, worker, group, message)
+  end)
 end
 
 -- retry(now, queue_name, worker, [delay, [group, [message]]])
@@ -405,6 +1010,12 @@ end
 -- the provided group and message will be used in place of the default
 -- messaging about retries in the particular queue being exhausted
 function ReqlessJob:retry(now, queue_name, worker, delay, group, message)
+  return self:prepare_retry(now, queue_name, worker, delay, group, message)()
+end
+
+-- Check that the job can be retried, as `retry` does, and return a function
+-- that retries it. Nothing is written until that's called.
+function ReqlessJob:prepare_retry(now, queue_name, worker, delay, group, message)
   assert(queue_name , 'Retry(): Arg "queue_name" missing')
   assert(worker, 'Retry(): Arg "worker" missing')
   delay = assert(tonumber(delay or 0),
@@ -424,84 +1035,108 @@ function ReqlessJob:retry(now, queue_name, worker, delay, group, message)
     error('Retry(): Job has been given to another worker: ' .. oldworker)
   end
 
-  -- For each of these, decrement their retries. If any of them
-  -- have exhausted their retries, then we should mark them as
-  -- failed.
-  local remaining = tonumber(redis.call(
-    'hincrby', ReqlessJob.ns .. self.jid, 'remaining', -1))
-  redis.call('hdel', ReqlessJob.ns .. self.jid, 'grace')
-
-  -- Remove it from the locks key of the old queue
-  Reqless.queue(old_queue_name).locks.remove(self.jid)
-
-  -- Release the throttle for the job
-  self:throttles_release(now)
-
-  -- Remove this job from the worker that was previously working it
-  redis.call('zrem', 'ql:w:' .. worker .. ':jobs', self.jid)
-
-  if remaining < 0 then
-    -- Now remove the instance from the schedule, and work queues for the
-    -- queue it's in
-    local group = group or 'failed-retries-' .. queue_name
-    self:history(now, 'failed-retries', {group = group})
-
-    redis.call('hmset', ReqlessJob.ns .. self.jid, 'state', 'failed',
-      'worker', '',
-      'expires', '')
-    -- If the failure has not already been set, then set it
-    if group ~= nil and message ~= nil then
-      redis.call('hset', ReqlessJob.ns .. self.jid,
+  return function()
+    -- For each of these, decrement their retries. If any of them
+    -- have exhausted their retries, then we should mark them as
+    -- failed.
+    local remaining = tonumber(redis.call(
+      'hincrby', ReqlessJob.ns .. self.jid, 'remaining', -1))
+    redis.call('hdel', ReqlessJob.ns .. self.jid, 'grace')
+
+    -- Remove it from the locks key of the old queue
+    Reqless.queue(old_queue_name).locks:remove(self.jid)
+
+    -- Release the throttle for the job
+    self:throttles_release(now)
+
+    -- Remove this job from the worker that was previously working it
+    redis.call('zrem', Reqless.ns .. 'w:' .. worker .. ':jobs', self.jid)
+
+    if remaining < 0 then
+      -- Now remove the instance from the schedule, and work queues for the
+      -- queue it's in
+      local group = group or 'failed-retries-' .. queue_name
+      self:history(now, 'failed-retries', {group = group}, old_queue_name)
+
+      redis.call('hmset', ReqlessJob.ns .. self.jid, 'state', 'failed',
+        'worker', '',
+        'expires', '')
+      -- If the failure has not already been set, then set it
+      if group ~= nil and message ~= nil then
+        redis.call('hset', ReqlessJob.ns .. self.jid,
+          'failure', cjson.encode({
+            group   = group,
+            message = message,
+            when    = math.floor(now),
+            worker  = worker
+          })
+        )
+      else
+        redis.call('hset', ReqlessJob.ns .. self.jid,
         'failure', cjson.encode({
           group   = group,
-          message = message,
-          when    = math.floor(now),
-          worker  = worker
-        })
-      )
-    else
-      redis.call('hset', ReqlessJob.ns .. self.jid,
-      'failure', cjson.encode({
-        group   = group,
-        message = 'Job exhausted retries in queue "' .. old_queue_name .. '"',
-        when    = now,
-        worker  = unpack(self:data('worker'))
-      }))
-    end
+          message = 'Job exhausted retries in queue "' .. old_queue_name .. '"',
+          when    = now,
+          worker  = unpack(self:data('worker'))
+        }))
+      end
 
-    -- Add this type of failure to the list of failures
-    redis.call('sadd', 'ql:failures', group)
-    -- And add this particular instance to the failed types
-    redis.call('lpush', 'ql:f:' .. group, self.jid)
-    -- Increment the count of the failed jobs
-    local bin = now - (now % 86400)
-    redis.call('hincrby', 'ql:s:stats:' .. bin .. ':' .. queue_name, 'failures', 1)
-    redis.call('hincrby', 'ql:s:stats:' .. bin .. ':' .. queue_name, 'failed'  , 1)
-  else
-    -- Put it in the queue again with a delay. Like put()
-    local queue = Reqless.queue(queue_name)
-    if delay > 0 then
-      queue.scheduled.add(now + delay, self.jid)
-      redis.call('hset', ReqlessJob.ns .. self.jid, 'state', 'scheduled')
+      -- Add this particular instance to the failed types, and increment the
+      -- count of the failed jobs
+      self:count_failure(now, queue_name, group)
     else
-      queue.work.add(now, priority, self.jid)
-      redis.call('hset', ReqlessJob.ns .. self.jid, 'state', 'waiting')
-    end
+      -- Put it in the queue again with a delay. Like put()
+      local queue = Reqless.queue(queue_name)
+      if delay > 0 then
+        queue.scheduled:add(now + delay, self.jid)
+        redis.call('hset', ReqlessJob.ns .. self.jid, 'state', 'scheduled')
+      else
+        queue.work:add(now, priority, self.jid)
+        redis.call('hset', ReqlessJob.ns .. self.jid, 'state', 'waiting')
+      end
 
-    -- If a group and a message was provided, then we should save it
-    if group ~= nil and message ~= nil then
-      redis.call('hset', ReqlessJob.ns .. self.jid,
-        'failure', cjson.encode({
-          group   = group,
-          message = message,
-          when    = math.floor(now),
-          worker  = worker
-        })
-      )
+      -- If a group and a message was provided, then we should save it
+      if group ~= nil and message ~= nil then
+        redis.call('hset', ReqlessJob.ns .. self.jid,
+          'failure', cjson.encode({
+            group   = group,
+            message = message,
+            when    = math.floor(now),
+            worker  = worker
+          })
+        )
+      end
     end
+
+    return math.floor(remaining)
   end
+end
+
+-- Retry each of the jobs with the provided jids, held by the worker, just as
+-- `retry` does. A job that can't be retried doesn't stop the others. Returns
+-- the outcome of each job, in order:
+--
+--  [{
+--      'jid': 'jid',
+--      'remaining': 4
+--  }, {
+--      'jid': 'other',
+--      'error': 'Retry(): Job does not exist'
+--  }]
+function ReqlessJob.retryMulti(now, raw_jids, queue_name, worker, delay, group, message)
+  local jids = assert(cjson.decode(raw_jids or ''),
+    'RetryMulti(): Arg "jids" missing or not JSON: ' .. tostring(raw_jids))
+  assert(type(jids) == 'table',
+    'RetryMulti(): Arg "jids" not a JSON array: ' .. tostring(raw_jids))
+  assert(queue_name, 'RetryMulti(): Arg "queue_name" missing')
+  assert(worker, 'RetryMulti(): Arg "worker" missing')
+  delay = assert(tonumber(delay or 0),
+    'RetryMulti(): Arg "delay" not a number: ' .. tostring(delay))
 
-  return math.floor(remaining)
+  return ReqlessJob.batch(now, jids, 'remaining', function(index, jid)
+    return Reqless.job(jid):prepare_retry(
+      now, queue_name, worker, delay, group, message)
+  end)
 end
 
 -- Depends(jid, 'on', [jid, [jid, [...]]]
@@ -552,8 +1187,8 @@ function ReqlessJob:depends(now, command, ...)
       'hmget', ReqlessJob.ns .. self.jid, 'queue', 'priority'))
     if queue_name then
       local queue = Reqless.queue(queue_name)
-      queue.depends.remove(self.jid)
-      queue.work.add(now, priority, self.jid)
+      queue.depends:remove(self.jid)
+      queue.work:add(now, priority, self.jid)
       redis.call('hset', ReqlessJob.ns .. self.jid, 'state', 'waiting')
     end
   else
@@ -567,8 +1202,8 @@ function ReqlessJob:depends(now, command, ...)
           'hmget', ReqlessJob.ns .. self.jid, 'queue', 'priority'))
         if queue_name then
           local queue = Reqless.queue(queue_name)
-          queue.depends.remove(self.jid)
-          queue.work.add(now, priority, self.jid)
+          queue.depends:remove(self.jid)
+          queue.work:add(now, priority, self.jid)
           redis.call('hset',
             ReqlessJob.ns .. self.jid, 'state', 'waiting')
         end
@@ -590,10 +1225,11 @@ function ReqlessJob:heartbeat(now, worker, data)
 
   -- We should find the heartbeat interval for this queue
   -- heartbeat. First, though, we need to find the queue
-  -- this particular job is in
-  local queue_name = redis.call('hget', ReqlessJob.ns .. self.jid, 'queue') or ''
+  -- this particular job is in, and whether the worker still owns it
+  local queue_name, job_worker, state = unpack(
+    self:hmget('queue', 'worker', 'state'))
   local expires = now + tonumber(
-    Reqless.config.get(queue_name .. '-heartbeat') or
+    Reqless.config.get((queue_name or '') .. '-heartbeat') or
     Reqless.config.get('heartbeat', 60))
 
   if data then
@@ -602,8 +1238,6 @@ function ReqlessJob:heartbeat(now, worker, data)
 
   -- First, let's see if the worker still owns this job, and there is a
   -- worker
-  local job_worker, state = unpack(
-    redis.call('hmget', ReqlessJob.ns .. self.jid, 'worker', 'state'))
   if job_worker == false then
     -- This means the job doesn't exist
     error('Heartbeat(): Job does not exist')
@@ -617,8 +1251,8 @@ function ReqlessJob:heartbeat(now, worker, data)
   if data then
     -- I don't know if this is wise, but I'm decoding and encoding
     -- the user data to hopefully ensure its sanity
-    redis.call('hmset', ReqlessJob.ns .. self.jid, 'expires',
-      expires, 'worker', worker, 'data', cjson.encode(data))
+    self:hmset('expires', expires, 'worker', worker,
+      'data', cjson.encode(data))
   else
     redis.call('hmset', ReqlessJob.ns .. self.jid,
       'expires', expires, 'worker', worker)
@@ -626,12 +1260,11 @@ function ReqlessJob:heartbeat(now, worker, data)
 
   -- Update when this job was last updated on that worker
   -- Add this job to the list of jobs handled by this worker
-  redis.call('zadd', 'ql:w:' .. worker .. ':jobs', expires, self.jid)
+  redis.call('zadd', Reqless.ns .. 'w:' .. worker .. ':jobs', expires, self.jid)
 
   -- And now we should just update the locks
-  local queue = Reqless.queue(
-    redis.call('hget', ReqlessJob.ns .. self.jid, 'queue'))
-  queue.locks.add(expires, self.jid)
+  local queue = Reqless.queue(queue_name)
+  queue.locks:add(expires, self.jid)
   return expires
 end
 
@@ -656,8 +1289,8 @@ function ReqlessJob:priority(priority)
   -- currently in
   if queue_name ~= '' then
     local queue = Reqless.queue(queue_name)
-    if queue.work.score(self.jid) then
-      queue.work.add(0, priority, self.jid)
+    if queue.work:score(self.jid) then
+      queue.work:add(0, priority, self.jid)
     end
   end
 
@@ -672,7 +1305,7 @@ function ReqlessJob:update(data)
     table.insert(tmp, k)
     table.insert(tmp, v)
   end
-  redis.call('hmset', ReqlessJob.ns .. self.jid, unpack(tmp))
+  self:hmset(unpack(tmp))
 end
 
 -- Times out the job now rather than when its lock is normally set to expire
@@ -685,14 +1318,14 @@ function ReqlessJob:timeout(now)
     error('Timeout(): Job ' .. self.jid .. ' not running')
   end
   -- Time out the job
-  self:history(now, 'timed-out')
+  self:history(now, 'timed-out', nil, queue_name)
   local queue = Reqless.queue(queue_name)
-  queue.locks.remove(self.jid)
+  queue.locks:remove(self.jid)
 
   -- Release acquired throttles
   self:throttles_release(now)
 
-  queue.work.add(now, math.huge, self.jid)
+  queue.work:add(now, math.huge, self.jid)
   redis.call('hmset', ReqlessJob.ns .. self.jid,
     'state', 'stalled', 'expires', 0, 'worker', '')
   local encoded = cjson.encode({
@@ -710,47 +1343,150 @@ function ReqlessJob:exists()
   return redis.call('exists', ReqlessJob.ns .. self.jid) == 1
 end
 
--- Get or append to history
-function ReqlessJob:history(now, what, item)
-  -- First, check if there's an old-style history, and update it if there is
-  local history = redis.call('hget', ReqlessJob.ns .. self.jid, 'history')
-  if history then
-    history = cjson.decode(history)
-    for _, value in ipairs(history) do
-      redis.call('rpush', ReqlessJob.ns .. self.jid .. '-history',
-        cjson.encode({math.floor(value.put), 'put', {queue = value.queue}}))
-
-      -- If there's any popped time
-      if value.popped then
-        redis.call('rpush', ReqlessJob.ns .. self.jid .. '-history',
-          cjson.encode({math.floor(value.popped), 'popped',
-            {worker = value.worker}}))
-      end
+-- The ways in which a job's history may be kept, selected with the
+-- `history-mode` and `<queue>-history-mode` configuration options. Entries
+-- are appended to the list `ql:j:<jid>-history`, and each mode bounds that
+-- list with as few additional commands as possible, returning its length:
+--
+--  - `full`: every entry
+--  - `capped`: the first entry, kept in the job's `first_history` field, and
+--    the most recent entries up to a total of `max-job-history`
+--  - `ring`: the most recent `max-job-history` entries
+--  - `first-last`: only the first and the most recent entries
+--  - `sampled`: like `capped`, but besides `put` entries, only one in
+--    `history-sample-rate` entries is kept
+--  - `off`: no entries
+ReqlessJob.history_modes = {}
+
+function ReqlessJob.history_modes.full(key, entry)
+  return redis.call('rpush', key, entry)
+end
 
-      -- If there's any failure
-      if value.failed then
-        redis.call('rpush', ReqlessJob.ns .. self.jid .. '-history',
-          cjson.encode(
-            {math.floor(value.failed), 'failed', nil}))
-      end
+function ReqlessJob.history_modes.capped(key, entry, what, now, jid)
+  local length = redis.call('rpush', key, entry)
+  local count = tonumber(Reqless.config.get('max-job-history', 100))
+  if length == 1 and redis.call('hsetnx',
+      ReqlessJob.ns .. jid, 'first_history', entry) == 1 then
+    -- The list is only ever empty before the first entry, which is kept
+    -- apart so that it needn't be spared when the list is trimmed
+    redis.call('del', key)
+    return 0
+  end
+  if count > 0 and length >= count then
+    redis.call('ltrim', key, length - count + 1, -1)
+    length = count - 1
+  end
+  return length
+end
 
-      -- If it was completed
-      if value.done then
-        redis.call('rpush', ReqlessJob.ns .. self.jid .. '-history',
-          cjson.encode(
-            {math.floor(value.done), 'done', nil}))
-      end
+function ReqlessJob.history_modes.ring(key, entry)
+  local length = redis.call('rpush', key, entry)
+  local count = tonumber(Reqless.config.get('max-job-history', 100))
+  if count > 0 and length > count then
+    redis.call('ltrim', key, -count, -1)
+    length = count
+  end
+  return length
+end
+
+function ReqlessJob.history_modes.first_last(key, entry)
+  -- Once there are two entries, the last one is just replaced
+  local replaced = redis.pcall('lset', key, 1, entry)
+  if type(replaced) == 'table' and replaced.err then
+    return redis.call('rpush', key, entry)
+  end
+  return 2
+end
+ReqlessJob.history_modes['first-last'] = ReqlessJob.history_modes.first_last
+
+-- Whether the sampling of entries has been seeded in this invocation
+ReqlessJob.history_seeded = false
+
+function ReqlessJob.history_modes.sampled(key, entry, what, now, jid)
+  if what ~= 'put' then
+    if not ReqlessJob.history_seeded then
+      math.randomseed(math.floor(now * 1000) % 2147483647)
+      ReqlessJob.history_seeded = true
+    end
+    local rate = tonumber(Reqless.config.get('history-sample-rate', 10))
+    if rate > 1 and math.random(rate) ~= 1 then
+      return 0
     end
-    -- With all this ported forward, delete the old-style history
-    redis.call('hdel', ReqlessJob.ns .. self.jid, 'history')
   end
+  return ReqlessJob.history_modes.capped(key, entry, what, now, jid)
+end
+
+function ReqlessJob.history_modes.off()
+  return 0
+end
+
+-- Return the history mode for jobs in the queue: that configured for it, or
+-- else `history-mode`
+function ReqlessJob.history_mode(queue)
+  return (queue and Reqless.config.get(queue .. '-history-mode')) or
+    Reqless.config.get('history-mode', 'capped')
+end
+
+-- Get or append to history. Entries are appended according to the history
+-- mode of `queue`, the queue the job is in, or for `put` entries, the queue
+-- it's put in.
+function ReqlessJob:history(now, what, item, queue)
+  local key = ReqlessJob.ns .. self.jid .. '-history'
 
-  -- Now to the meat of the function
   if what == nil then
+    -- First, check if there's an old-style history, and port it forward if
+    -- there is. These entries predate any others, so they go in front.
+    local entries = {}
+    local history, first = unpack(redis.call('hmget',
+      ReqlessJob.ns .. self.jid, 'history', 'first_history'))
+    if history then
+      history = cjson.decode(history)
+      for _, value in ipairs(history) do
+        table.insert(entries,
+          cjson.encode({math.floor(value.put), 'put', {queue = value.queue}}))
+
+        -- If there's any popped time
+        if value.popped then
+          table.insert(entries, cjson.encode({math.floor(value.popped),
+            'popped', {worker = value.worker}}))
+        end
+
+        -- If there's any failure
+        if value.failed then
+          table.insert(entries,
+            cjson.encode({math.floor(value.failed), 'failed', nil}))
+        end
+
+        -- If it was completed
+        if value.done then
+          table.insert(entries,
+            cjson.encode({math.floor(value.done), 'done', nil}))
+        end
+      end
+      -- Unless it's only being read, port these forward and delete the
+      -- old-style history
+      if not Reqless.read_only then
+        if first then
+          table.insert(entries, first)
+          first = table.remove(entries, 1)
+          redis.call('hset', ReqlessJob.ns .. self.jid, 'first_history', first)
+        end
+        for index = #entries, 1, -1 do
+          redis.call('lpush', key, entries[index])
+        end
+        self:retain_key(key)
+        redis.call('hdel', ReqlessJob.ns .. self.jid, 'history')
+        entries = {}
+      end
+    end
+
     -- Get the history
     local response = {}
-    for _, value in ipairs(redis.call('lrange',
-      ReqlessJob.ns .. self.jid .. '-history', 0, -1)) do
+    if first then
+      table.insert(entries, first)
+    end
+    table_extend(entries, redis.call('lrange', key, 0, -1))
+    for _, value in ipairs(entries) do
       value = cjson.decode(value)
       local dict = value[3] or {}
       dict['when'] = value[1]
@@ -760,27 +1496,31 @@ function ReqlessJob:history(now, what, item)
     return response
   end
 
-  -- Append to the history. If the length of the history should be limited,
-  -- then we'll truncate it.
-  local count = tonumber(Reqless.config.get('max-job-history', 100))
-  if count > 0 then
-    -- We'll always keep the first item around
-    local obj = redis.call('lpop', ReqlessJob.ns .. self.jid .. '-history')
-    redis.call('ltrim', ReqlessJob.ns .. self.jid .. '-history', -count + 2, -1)
-    if obj ~= nil and obj ~= false then
-      redis.call('lpush', ReqlessJob.ns .. self.jid .. '-history', obj)
-    end
+  -- Append to the history, bounded according to the job's history mode
+  if what == 'put' and item and item.queue then
+    queue = item.queue
+  end
+  local append = ReqlessJob.history_modes[ReqlessJob.history_mode(queue)] or
+    ReqlessJob.history_modes.capped
+  local length = append(
+    key, cjson.encode({math.floor(now), what, item}), what, now, self.jid)
+  if length == 1 then
+    -- The list may have just been created
+    self:retain_key(key)
   end
-  return redis.call('rpush', ReqlessJob.ns .. self.jid .. '-history',
-    cjson.encode({math.floor(now), what, item}))
+  return length
 end
 
 function ReqlessJob:throttles_release(now)
-  local throttles = redis.call('hget', ReqlessJob.ns .. self.jid, 'throttles')
-  throttles = cjson.decode(throttles or '[]')
+  local throttles = cjson.decode(self:hmget('throttles')[1] or '[]')
 
+  local deferred = ReqlessJob.deferred
   for _, tid in ipairs(throttles) do
-    Reqless.throttle(tid):release(now, self.jid)
+    if deferred then
+      ReqlessJob.defer_add(deferred.releases, tid, self.jid)
+    else
+      Reqless.throttle(tid):release(now, self.jid)
+    end
   end
 end
 
@@ -820,7 +1560,7 @@ end
 function ReqlessJob:throttles()
   -- memoize throttles for the job.
   if not self._throttles then
-    self._throttles = cjson.decode(redis.call('hget', ReqlessJob.ns .. self.jid, 'throttles') or '[]')
+    self._throttles = cjson.decode(self:hmget('throttles')[1] or '[]')
   end
 
   return self._throttles
@@ -830,26 +1570,24 @@ end
 -- associated with this job, use
 -- with care.
 function ReqlessJob:delete()
-  local tags = redis.call('hget', ReqlessJob.ns .. self.jid, 'tags') or '[]'
-  tags = cjson.decode(tags)
+  local tags = cjson.decode(self:hmget('tags')[1] or '[]')
   -- remove the jid from each tag
   for _, tag in ipairs(tags) do
     self:remove_tag(tag)
   end
-  -- Delete the job's data
-  redis.call('del', ReqlessJob.ns .. self.jid)
-  -- Delete the job's history
-  redis.call('del', ReqlessJob.ns .. self.jid .. '-history')
-  -- Delete any notion of dependencies it has
-  redis.call('del', ReqlessJob.ns .. self.jid .. '-dependencies')
+  -- Delete the job's data, its history, and any notion of dependencies it has
+  redis.call('del', ReqlessJob.ns .. self.jid,
+    ReqlessJob.ns .. self.jid .. '-history',
+    ReqlessJob.ns .. self.jid .. '-dependencies',
+    ReqlessJob.ns .. self.jid .. '-data')
 end
 
 -- Inserts the jid into the specified tag.
 -- This should probably be moved to its own tag
 -- object.
 function ReqlessJob:insert_tag(now, tag)
-  redis.call('zadd', 'ql:t:' .. tag, now, self.jid)
-  redis.call('zincrby', 'ql:tags', 1, tag)
+  redis.call('zadd', Reqless.ns .. 't:' .. tag, now, self.jid)
+  redis.call('zincrby', Reqless.ns .. 'tags', 1, tag)
 end
 
 -- Removes the jid from the specified tag.
@@ -857,7 +1595,7 @@ end
 -- object.
 function ReqlessJob:remove_tag(tag)
   -- namespace the tag
-  local namespaced_tag = 'ql:t:' .. tag
+  local namespaced_tag = Reqless.ns .. 't:' .. tag
 
   -- Remove the job from the specified tag
   redis.call('zrem', namespaced_tag, self.jid)
@@ -870,9 +1608,9 @@ function ReqlessJob:remove_tag(tag)
   -- and we should remove it from the set of all tags
   -- to prevent memory leaks.
   if tonumber(remaining) == 0 then
-    redis.call('zrem', 'ql:tags', tag)
+    redis.call('zrem', Reqless.ns .. 'tags', tag)
   else
     -- Decrement the tag in the set of all tags.
-    redis.call('zincrby', 'ql:tags', -1, tag)
+    redis.call('zincrby', Reqless.ns .. 'tags', -1, tag)
   end
 end
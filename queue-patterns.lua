@@ -1,16 +1,39 @@
 local ReqlessQueuePatterns = {
   default_identifiers_default_pattern = '["*"]',
   default_priority_pattern = '{"fairly": false, "pattern": ["default"]}',
-  ns = Reqless.ns .. "qp:",
 }
 ReqlessQueuePatterns.__index = ReqlessQueuePatterns
 
+-- The key of the queue patterns of the given kind
+function ReqlessQueuePatterns.key(kind)
+  return Reqless.ns .. 'qp:' .. kind
+end
+
+-- The key the patterns of the given kind were kept in by qmore, which is only
+-- read from and cleared in the default namespace
+function ReqlessQueuePatterns.legacy_key(name)
+  if Reqless.ns == 'ql:' then
+    return 'qmore:' .. name
+  end
+end
+
+-- Delete the key, along with the legacy key of that name if there is one
+function ReqlessQueuePatterns.clear(key, legacy_name)
+  local legacy_key = ReqlessQueuePatterns.legacy_key(legacy_name)
+  if legacy_key then
+    redis.call('del', key, legacy_key)
+  else
+    redis.call('del', key)
+  end
+end
+
 ReqlessQueuePatterns['getIdentifierPatterns'] = function(now)
-  local reply = redis.call('hgetall', ReqlessQueuePatterns.ns .. 'identifiers')
+  local reply = redis.call('hgetall', ReqlessQueuePatterns.key('identifiers'))
 
-  if #reply == 0 then
+  local legacy_key = ReqlessQueuePatterns.legacy_key('dynamic')
+  if #reply == 0 and legacy_key then
     -- Check legacy key
-    reply = redis.call('hgetall', 'qmore:dynamic')
+    reply = redis.call('hgetall', legacy_key)
   end
 
   -- Include default pattern in case identifier patterns have never been set.
@@ -30,7 +53,7 @@ ReqlessQueuePatterns['setIdentifierPatterns'] = function(now, ...)
   if #arg % 2 == 1 then
     error('Odd number of identifier patterns: ' .. tostring(arg))
   end
-  local key = ReqlessQueuePatterns.ns .. 'identifiers'
+  local key = ReqlessQueuePatterns.key('identifiers')
 
   local goodDefault = false;
   local identifierPatterns = {}
@@ -61,16 +84,17 @@ ReqlessQueuePatterns['setIdentifierPatterns'] = function(now, ...)
   end
 
   -- Clear out the legacy key too
-  redis.call('del', key, 'qmore:dynamic')
+  ReqlessQueuePatterns.clear(key, 'dynamic')
   redis.call('hset', key, unpack(identifierPatterns))
 end
 
 ReqlessQueuePatterns['getPriorityPatterns'] = function(now)
-  local reply = redis.call('lrange', ReqlessQueuePatterns.ns .. 'priorities', 0, -1)
+  local reply = redis.call('lrange', ReqlessQueuePatterns.key('priorities'), 0, -1)
 
-  if #reply == 0 then
+  local legacy_key = ReqlessQueuePatterns.legacy_key('priority')
+  if #reply == 0 and legacy_key then
     -- Check legacy key
-    reply = redis.call('lrange', 'qmore:priority', 0, -1)
+    reply = redis.call('lrange', legacy_key, 0, -1)
   end
 
   if #reply == 0 then
@@ -84,10 +108,9 @@ end
 -- where the JSON object has a shape like:
 -- {"fairly": true, "pattern": ["string", "string", "string"]}
 ReqlessQueuePatterns['setPriorityPatterns'] = function(now, ...)
-  local key = ReqlessQueuePatterns.ns .. 'priorities'
-  redis.call('del', key)
-  -- Clear out the legacy key
-  redis.call('del', 'qmore:priority')
+  local key = ReqlessQueuePatterns.key('priorities')
+  -- Clear out the legacy key too
+  ReqlessQueuePatterns.clear(key, 'priority')
 
   if #arg > 0 then
     -- Check for the default priority pattern and add one if none is given.
@@ -106,3 +129,160 @@ ReqlessQueuePatterns['setPriorityPatterns'] = function(now, ...)
     redis.call('rpush', key, unpack(arg))
   end
 end
+
+-- Convert a queue name pattern into an anchored Lua pattern. The only wildcard
+-- supported is `*`, which matches any sequence of characters.
+local function queuePatternToLuaPattern(pattern)
+  local escaped = string.gsub(pattern, '[%^%$%(%)%%%.%[%]%+%-%?]', '%%%0')
+  return '^' .. string.gsub(escaped, '%*', '.*') .. '$'
+end
+
+-- Expand a list of queue name patterns against the given list of queue names.
+-- Patterns may be plain names or contain `*` wildcards, patterns prefixed with
+-- `!` exclude previously matched queues, and patterns prefixed with `@` are
+-- replaced by the identifier patterns stored under that identifier (`!@` to
+-- exclude them). The matched queue names are returned sorted.
+ReqlessQueuePatterns['expandQueues'] = function(now, patterns, queueNames, identifierPatterns)
+  identifierPatterns = identifierPatterns or ReqlessQueuePatterns.getIdentifierPatterns(now)
+
+  local pending = {}
+  table_extend(pending, patterns)
+
+  local matched = {}
+  local matchedSet = {}
+  local index = 1
+  while index <= #pending do
+    local pattern = pending[index]
+    index = index + 1
+
+    local negated, identifier = string.match(pattern, '^(!?)@(.*)$')
+    if identifier then
+      local serialized = identifierPatterns[identifier] or identifierPatterns['default']
+      for _, identifierPattern in ipairs(cjson.decode(serialized)) do
+        if negated == '!' then
+          if string.sub(identifierPattern, 1, 1) == '!' then
+            identifierPattern = string.sub(identifierPattern, 2)
+          else
+            identifierPattern = '!' .. identifierPattern
+          end
+        end
+        table.insert(pending, identifierPattern)
+      end
+    elseif string.sub(pattern, 1, 1) == '!' then
+      local luaPattern = queuePatternToLuaPattern(string.sub(pattern, 2))
+      local kept = {}
+      for _, queueName in ipairs(matched) do
+        if string.match(queueName, luaPattern) then
+          matchedSet[queueName] = nil
+        else
+          table.insert(kept, queueName)
+        end
+      end
+      matched = kept
+    else
+      local luaPattern = queuePatternToLuaPattern(pattern)
+      for _, queueName in ipairs(queueNames) do
+        if not matchedSet[queueName] and string.match(queueName, luaPattern) then
+          matchedSet[queueName] = true
+          table.insert(matched, queueName)
+        end
+      end
+    end
+  end
+
+  table.sort(matched)
+  return matched
+end
+
+-- Order the given queue names according to the stored priority patterns. Each
+-- priority pattern claims the queues it matches that haven't been claimed by
+-- an earlier pattern, and the `default` pattern receives whatever queues remain
+-- unclaimed. Queues within a pattern with `fairly` set are shuffled, otherwise
+-- they are kept in sorted order.
+ReqlessQueuePatterns['prioritizeQueues'] = function(now, queueNames, identifierPatterns)
+  identifierPatterns = identifierPatterns or ReqlessQueuePatterns.getIdentifierPatterns(now)
+  local remaining = {}
+  table_extend(remaining, queueNames)
+
+  local shuffle = function(list)
+    for i = #list, 2, -1 do
+      local j = math.random(i)
+      list[i], list[j] = list[j], list[i]
+    end
+  end
+
+  -- Redis seeds the Lua PRNG identically for every script invocation, so seed
+  -- it from the client-provided time to vary the order of fair buckets.
+  math.randomseed(math.floor(now * 1000) % 2147483647)
+
+  local buckets = {}
+  local defaultIndex = nil
+  local defaultFairly = false
+  for _, serialized in ipairs(ReqlessQueuePatterns.getPriorityPatterns(now)) do
+    local priorityPattern = cjson.decode(serialized)
+    local pattern = priorityPattern['pattern']
+    if #pattern == 1 and pattern[1] == 'default' then
+      defaultIndex = #buckets + 1
+      defaultFairly = priorityPattern['fairly']
+    else
+      local bucket = ReqlessQueuePatterns.expandQueues(
+        now, pattern, remaining, identifierPatterns)
+      local claimed = {}
+      for _, queueName in ipairs(bucket) do
+        claimed[queueName] = true
+      end
+      local unclaimed = {}
+      for _, queueName in ipairs(remaining) do
+        if not claimed[queueName] then
+          table.insert(unclaimed, queueName)
+        end
+      end
+      remaining = unclaimed
+
+      if priorityPattern['fairly'] then
+        shuffle(bucket)
+      end
+      table.insert(buckets, bucket)
+    end
+  end
+
+  if defaultFairly then
+    shuffle(remaining)
+  end
+  table.insert(buckets, defaultIndex or (#buckets + 1), remaining)
+
+  local prioritized = {}
+  for _, bucket in ipairs(buckets) do
+    table_extend(prioritized, bucket)
+  end
+  return prioritized
+end
+
+-- Return the names of the known queues the given identifier should work, in
+-- the order in which they should be worked. The identifier is resolved using
+-- the identifier patterns, falling back to the `default` identifier patterns.
+ReqlessQueuePatterns['getQueueNames'] = function(now, identifier)
+  local identifierPatterns = ReqlessQueuePatterns.getIdentifierPatterns(now)
+  local queueNames = ReqlessQueuePatterns.expandQueues(
+    now, {'@' .. (identifier or 'default')}, ReqlessQueue.names(now),
+    identifierPatterns)
+  return ReqlessQueuePatterns.prioritizeQueues(now, queueNames, identifierPatterns)
+end
+
+-- Pop up to `limit` jobs for the given worker from the queues resolved for the
+-- given identifier, working through the queues in priority order until the
+-- limit is met.
+ReqlessQueuePatterns['pop'] = function(now, worker, identifier, limit)
+  assert(worker, 'Pop(): Arg "worker" missing')
+  limit = assert(tonumber(limit),
+    'Pop(): Arg "limit" missing or not a number: ' .. tostring(limit))
+
+  local popped = {}
+  for _, queueName in ipairs(ReqlessQueuePatterns.getQueueNames(now, identifier)) do
+    if #popped >= limit then
+      break
+    end
+    table_extend(popped, Reqless.queue(queueName):pop(now, worker, limit - #popped))
+  end
+  return popped
+end
@@ -1,6 +1,297 @@
 -------------------------------------------------------------------------------
 -- Queue class
 -------------------------------------------------------------------------------
+-- Each queue is made up of several sorted sets of jids. Rather than building
+-- closures for every queue object, each queue object holds one small table per
+-- sorted set with its precomputed key, and these share their methods.
+
+-- Each queue also keeps the number of jobs in each of its sorted sets in a
+-- hash, so that they can be read without counting each set. The sorted sets
+-- write the changes to their sizes to the counts as they're made. The counts
+-- of queues that were around before counts were kept are built from their
+-- sorted sets the first time they change.
+
+-- The counts keys that are known to exist in this invocation
+ReqlessQueue.counted = {}
+
+-- Count `delta` more jobs in the `field` of the counts of the sorted set's
+-- queue, which already has the change made to it
+function ReqlessQueue.count_change(set, field, delta)
+  if delta == 0 then
+    return
+  end
+  if not ReqlessQueue.counted[set.counts] then
+    ReqlessQueue.counted[set.counts] = true
+    if redis.call('exists', set.counts) == 0 then
+      -- Counting the sorted sets includes this change
+      ReqlessQueue.rebuild_counts(nil, set.name)
+      return
+    end
+  end
+  redis.call('hincrby', set.counts, field, delta)
+end
+
+-- Access to our work
+local ReqlessQueueWork = {}
+ReqlessQueueWork.__index = ReqlessQueueWork
+
+function ReqlessQueueWork:peek(offset, limit)
+  if limit <= 0 then
+    return {}
+  end
+  return redis.call('zrevrange', self.key, offset, offset + limit - 1)
+end
+
+function ReqlessQueueWork:remove(...)
+  if #arg > 0 then
+    local removed = redis.call('zrem', self.key, unpack(arg))
+    ReqlessQueue.count_change(self, 'waiting', -removed)
+    return removed
+  end
+end
+
+function ReqlessQueueWork:add(now, priority, jid)
+  local added = redis.call('zadd',
+    self.key, priority - (now / 10000000000), jid)
+  ReqlessQueue.count_change(self, 'waiting', added)
+  -- Let any workers blocked on this queue know that there's new work
+  if added > 0 then
+    self:wake(added)
+  end
+  return added
+end
+
+-- Push wake-up tokens onto the queue's wake list so that workers blocked on it
+-- with BLPOP know to pop. The list holds at most `max-wake-tokens` tokens, and
+-- no tokens are pushed at all when that is zero.
+function ReqlessQueueWork:wake(count)
+  local max = tonumber(Reqless.config.get('max-wake-tokens', 0))
+  if max <= 0 then
+    return
+  end
+
+  local tokens = {}
+  for i = 1, math.min(count, max) do
+    table.insert(tokens, 1)
+  end
+  redis.call('rpush', self.wake_key, unpack(tokens))
+  redis.call('ltrim', self.wake_key, -max, -1)
+end
+
+function ReqlessQueueWork:score(jid)
+  return redis.call('zscore', self.key, jid)
+end
+
+function ReqlessQueueWork:length()
+  return redis.call('zcard', self.key)
+end
+
+-- Access to our locks. The locks of every queue are also kept in one index of
+-- lock expirations, so that expired locks can be found without going through
+-- each queue.
+local ReqlessQueueLocks = {}
+ReqlessQueueLocks.__index = ReqlessQueueLocks
+
+-- The key of the index of the locks of every queue
+function ReqlessQueueLocks.index()
+  return Reqless.ns .. 'locks'
+end
+
+function ReqlessQueueLocks:expired(now, offset, limit)
+  return redis.call('zrangebyscore',
+    self.key, -math.huge, now, 'LIMIT', offset, limit)
+end
+
+function ReqlessQueueLocks:peek(now, offset, limit)
+  return redis.call('zrangebyscore', self.key,
+    now, math.huge, 'LIMIT', offset, limit)
+end
+
+-- Add locks, given as pairs of expiration and jid
+function ReqlessQueueLocks:add(...)
+  ReqlessQueue.count_change(self, 'running',
+    redis.call('zadd', self.key, unpack(arg)))
+  redis.call('zadd', ReqlessQueueLocks.index(), unpack(arg))
+end
+
+function ReqlessQueueLocks:remove(...)
+  if #arg > 0 then
+    redis.call('zrem', ReqlessQueueLocks.index(), unpack(arg))
+    local removed = redis.call('zrem', self.key, unpack(arg))
+    ReqlessQueue.count_change(self, 'running', -removed)
+    return removed
+  end
+end
+
+function ReqlessQueueLocks:score(jid)
+  return redis.call('zscore', self.key, jid)
+end
+
+function ReqlessQueueLocks:running(now)
+  return redis.call('zcount', self.key, now, math.huge)
+end
+
+function ReqlessQueueLocks:length(now)
+  -- If a 'now' is provided, we're interested in how many are before
+  -- that time
+  if now then
+    return redis.call('zcount', self.key, 0, now)
+  else
+    return redis.call('zcard', self.key)
+  end
+end
+
+-- Access to our dependent jobs
+local ReqlessQueueDepends = {}
+ReqlessQueueDepends.__index = ReqlessQueueDepends
+
+function ReqlessQueueDepends:peek(now, offset, limit)
+  return redis.call('zrange', self.key, offset, offset + limit - 1)
+end
+
+function ReqlessQueueDepends:add(now, jid)
+  ReqlessQueue.count_change(self, 'depends',
+    redis.call('zadd', self.key, now, jid))
+end
+
+function ReqlessQueueDepends:remove(...)
+  if #arg > 0 then
+    local removed = redis.call('zrem', self.key, unpack(arg))
+    ReqlessQueue.count_change(self, 'depends', -removed)
+    return removed
+  end
+end
+
+function ReqlessQueueDepends:length()
+  return redis.call('zcard', self.key)
+end
+
+-- Access to the queue level throttled jobs.
+local ReqlessQueueThrottled = {}
+ReqlessQueueThrottled.__index = ReqlessQueueThrottled
+
+function ReqlessQueueThrottled:length()
+  return (redis.call('zcard', self.key) or 0)
+end
+
+function ReqlessQueueThrottled:peek(now, offset, limit)
+  return redis.call('zrange', self.key, offset, offset + limit - 1)
+end
+
+function ReqlessQueueThrottled:add(...)
+  if #arg > 0 then
+    ReqlessQueue.count_change(self, 'throttled',
+      redis.call('zadd', self.key, unpack(arg)))
+  end
+end
+
+function ReqlessQueueThrottled:remove(...)
+  if #arg > 0 then
+    local removed = redis.call('zrem', self.key, unpack(arg))
+    ReqlessQueue.count_change(self, 'throttled', -removed)
+    return removed
+  end
+end
+
+function ReqlessQueueThrottled:pop(min, max)
+  local removed = redis.call('zremrangebyrank', self.key, min, max)
+  ReqlessQueue.count_change(self, 'throttled', -removed)
+  return removed
+end
+
+-- The earliest time at which each queue may have scheduled or recurring jobs
+-- due, so that due jobs can be promoted without going through each queue. An
+-- entry may be earlier than the queue's actual next due time, but never later.
+local ReqlessQueueDue = {}
+
+-- The key of the index of due times
+function ReqlessQueueDue.key()
+  return Reqless.ns .. 'due'
+end
+
+-- Make sure the queue is found to be due no later than `when`
+function ReqlessQueueDue.add(name, when)
+  local due = redis.call('zscore', ReqlessQueueDue.key(), name)
+  if not due or tonumber(when) < tonumber(due) then
+    redis.call('zadd', ReqlessQueueDue.key(), when, name)
+  end
+end
+
+-- Access to our scheduled jobs
+local ReqlessQueueScheduled = {}
+ReqlessQueueScheduled.__index = ReqlessQueueScheduled
+
+function ReqlessQueueScheduled:peek(now, offset, limit)
+  return redis.call('zrange', self.key, offset, offset + limit - 1)
+end
+
+function ReqlessQueueScheduled:ready(now, offset, limit)
+  return redis.call('zrangebyscore',
+    self.key, 0, now, 'LIMIT', offset, limit)
+end
+
+function ReqlessQueueScheduled:add(when, jid)
+  ReqlessQueue.count_change(self, 'scheduled',
+    redis.call('zadd', self.key, when, jid))
+  ReqlessQueueDue.add(self.name, when)
+end
+
+function ReqlessQueueScheduled:next()
+  return redis.call('zrange', self.key, 0, 0, 'WITHSCORES')[2]
+end
+
+function ReqlessQueueScheduled:remove(...)
+  if #arg > 0 then
+    local removed = redis.call('zrem', self.key, unpack(arg))
+    ReqlessQueue.count_change(self, 'scheduled', -removed)
+    return removed
+  end
+end
+
+function ReqlessQueueScheduled:length()
+  return redis.call('zcard', self.key)
+end
+
+-- Access to our recurring jobs
+local ReqlessQueueRecurring = {}
+ReqlessQueueRecurring.__index = ReqlessQueueRecurring
+
+function ReqlessQueueRecurring:peek(now, offset, limit)
+  return redis.call('zrangebyscore', self.key,
+    0, now, 'LIMIT', offset, limit)
+end
+
+function ReqlessQueueRecurring:add(when, jid)
+  ReqlessQueue.count_change(self, 'recurring',
+    redis.call('zadd', self.key, when, jid))
+  ReqlessQueueDue.add(self.name, when)
+end
+
+function ReqlessQueueRecurring:remove(...)
+  if #arg > 0 then
+    local removed = redis.call('zrem', self.key, unpack(arg))
+    ReqlessQueue.count_change(self, 'recurring', -removed)
+    return removed
+  end
+end
+
+function ReqlessQueueRecurring:update(increment, jid)
+  ReqlessQueueDue.add(self.name,
+    redis.call('zincrby', self.key, increment, jid))
+end
+
+function ReqlessQueueRecurring:next()
+  return redis.call('zrange', self.key, 0, 0, 'WITHSCORES')[2]
+end
+
+function ReqlessQueueRecurring:score(jid)
+  return redis.call('zscore', self.key, jid)
+end
+
+function ReqlessQueueRecurring:length()
+  return redis.call('zcard', self.key)
+end
+
 -- Return a queue object
 function Reqless.queue(name)
   assert(name, 'Queue(): no queue name provided')
@@ -8,139 +299,111 @@ function Reqless.queue(name)
   setmetatable(queue, ReqlessQueue)
   queue.name = name
 
-  -- Access to our work
-  queue.work = {
-    peek = function(offset, limit)
-      if limit <= 0 then
-        return {}
-      end
-      return redis.call('zrevrange', queue:prefix('work'), offset, offset + limit - 1)
-    end, remove = function(...)
-      if #arg > 0 then
-        return redis.call('zrem', queue:prefix('work'), unpack(arg))
-      end
-    end, add = function(now, priority, jid)
-      return redis.call('zadd',
-        queue:prefix('work'), priority - (now / 10000000000), jid)
-    end, score = function(jid)
-      return redis.call('zscore', queue:prefix('work'), jid)
-    end, length = function()
-      return redis.call('zcard', queue:prefix('work'))
-    end
-  }
+  local prefix = ReqlessQueue.ns .. name .. '-'
+  local counts = prefix .. 'counts'
+  queue.counts_key = counts
+  queue.work = setmetatable({key = prefix .. 'work', name = name,
+    wake_key = prefix .. 'wake', counts = counts}, ReqlessQueueWork)
+  queue.locks = setmetatable({key = prefix .. 'locks', name = name,
+    counts = counts}, ReqlessQueueLocks)
+  queue.depends = setmetatable({key = prefix .. 'depends', name = name,
+    counts = counts}, ReqlessQueueDepends)
+  queue.throttled = setmetatable({key = prefix .. 'throttled', name = name,
+    counts = counts}, ReqlessQueueThrottled)
+  queue.scheduled = setmetatable({key = prefix .. 'scheduled', name = name,
+    counts = counts}, ReqlessQueueScheduled)
+  queue.recurring = setmetatable({key = prefix .. 'recur', name = name,
+    counts = counts}, ReqlessQueueRecurring)
+  return queue
+end
 
-  -- Access to our locks
-  queue.locks = {
-    expired = function(now, offset, limit)
-      return redis.call('zrangebyscore',
-        queue:prefix('locks'), -math.huge, now, 'LIMIT', offset, limit)
-    end, peek = function(now, offset, limit)
-      return redis.call('zrangebyscore', queue:prefix('locks'),
-        now, math.huge, 'LIMIT', offset, limit)
-    end, add = function(expires, jid)
-      redis.call('zadd', queue:prefix('locks'), expires, jid)
-    end, remove = function(...)
-      if #arg > 0 then
-        return redis.call('zrem', queue:prefix('locks'), unpack(arg))
-      end
-    end, running = function(now)
-      return redis.call('zcount', queue:prefix('locks'), now, math.huge)
-    end, length = function(now)
-      -- If a 'now' is provided, we're interested in how many are before
-      -- that time
-      if now then
-        return redis.call('zcount', queue:prefix('locks'), 0, now)
-      else
-        return redis.call('zcard', queue:prefix('locks'))
-      end
-    end
-  }
+-- Return the prefix for this particular queue
+function ReqlessQueue:prefix(group)
+  if group then
+    return ReqlessQueue.ns .. self.name .. '-' .. group
+  end
 
-  -- Access to our dependent jobs
-  queue.depends = {
-    peek = function(now, offset, limit)
-      return redis.call('zrange',
-        queue:prefix('depends'), offset, offset + limit - 1)
-    end, add = function(now, jid)
-      redis.call('zadd', queue:prefix('depends'), now, jid)
-    end, remove = function(...)
-      if #arg > 0 then
-        return redis.call('zrem', queue:prefix('depends'), unpack(arg))
-      end
-    end, length = function()
-      return redis.call('zcard', queue:prefix('depends'))
-    end
-  }
+  return ReqlessQueue.ns .. self.name
+end
 
+-- The fields of the wait and run stats that hold the histogram, in order
+ReqlessQueue.histokeys = {
+  's0','s1','s2','s3','s4','s5','s6','s7','s8','s9','s10','s11','s12','s13','s14','s15','s16','s17','s18','s19','s20','s21','s22','s23','s24','s25','s26','s27','s28','s29','s30','s31','s32','s33','s34','s35','s36','s37','s38','s39','s40','s41','s42','s43','s44','s45','s46','s47','s48','s49','s50','s51','s52','s53','s54','s55','s56','s57','s58','s59',
+  'm1','m2','m3','m4','m5','m6','m7','m8','m9','m10','m11','m12','m13','m14','m15','m16','m17','m18','m19','m20','m21','m22','m23','m24','m25','m26','m27','m28','m29','m30','m31','m32','m33','m34','m35','m36','m37','m38','m39','m40','m41','m42','m43','m44','m45','m46','m47','m48','m49','m50','m51','m52','m53','m54','m55','m56','m57','m58','m59',
+  'h1','h2','h3','h4','h5','h6','h7','h8','h9','h10','h11','h12','h13','h14','h15','h16','h17','h18','h19','h20','h21','h22','h23',
+  'd1','d2','d3','d4','d5','d6'
+}
+
+-- Read the wait or run stats stored in the hash at `key`, as the totals that
+-- stats are merged as
+function ReqlessQueue.read_stats(key)
+  local reply = redis.call('hgetall', key)
+  local stored = {}
+  for i = 1, #reply, 2 do
+    stored[reply[i]] = tonumber(reply[i + 1])
+  end
 
-  -- Access to the queue level throttled jobs.
-  queue.throttled = {
-    length = function()
-      return (redis.call('zcard', queue:prefix('throttled')) or 0)
-    end, peek = function(now, offset, limit)
-      return redis.call('zrange', queue:prefix('throttled'), offset, offset + limit - 1)
-    end, add = function(...)
-      if #arg > 0 then
-        redis.call('zadd', queue:prefix('throttled'), unpack(arg))
-      end
-    end, remove = function(...)
-      if #arg > 0 then
-        return redis.call('zrem', queue:prefix('throttled'), unpack(arg))
-      end
-    end, pop = function(min, max)
-      return redis.call('zremrangebyrank', queue:prefix('throttled'), min, max)
+  -- Each data point is counted in exactly one bucket of the histogram
+  local count = 0
+  for field, value in pairs(stored) do
+    if string.match(field, '^[smhd]%d+$') then
+      count = count + value
     end
-  }
+  end
 
-  -- Access to our scheduled jobs
-  queue.scheduled = {
-    peek = function(now, offset, limit)
-      return redis.call('zrange',
-        queue:prefix('scheduled'), offset, offset + limit - 1)
-    end, ready = function(now, offset, limit)
-      return redis.call('zrangebyscore',
-        queue:prefix('scheduled'), 0, now, 'LIMIT', offset, limit)
-    end, add = function(when, jid)
-      redis.call('zadd', queue:prefix('scheduled'), when, jid)
-    end, remove = function(...)
-      if #arg > 0 then
-        return redis.call('zrem', queue:prefix('scheduled'), unpack(arg))
-      end
-    end, length = function()
-      return redis.call('zcard', queue:prefix('scheduled'))
-    end
-  }
+  -- The sum and sum of squares, including any data points kept as a mean
+  -- and `vk` by earlier versions
+  local sum   = stored.sum or 0
+  local sumsq = stored.sumsq or 0
+  if stored.total then
+    sum   = sum + stored.total * stored.mean
+    sumsq = sumsq + stored.vk + stored.total * stored.mean * stored.mean
+  end
 
-  -- Access to our recurring jobs
-  queue.recurring = {
-    peek = function(now, offset, limit)
-      return redis.call('zrangebyscore', queue:prefix('recur'),
-        0, now, 'LIMIT', offset, limit)
-    end, ready = function(now, offset, limit)
-    end, add = function(when, jid)
-      redis.call('zadd', queue:prefix('recur'), when, jid)
-    end, remove = function(...)
-      if #arg > 0 then
-        return redis.call('zrem', queue:prefix('recur'), unpack(arg))
-      end
-    end, update = function(increment, jid)
-      redis.call('zincrby', queue:prefix('recur'), increment, jid)
-    end, score = function(jid)
-      return redis.call('zscore', queue:prefix('recur'), jid)
-    end, length = function()
-      return redis.call('zcard', queue:prefix('recur'))
-    end
-  }
-  return queue
+  local histogram = {}
+  for i, field in ipairs(ReqlessQueue.histokeys) do
+    histogram[i] = stored[field] or 0
+  end
+  return {count = count, sum = sum, sumsq = sumsq, histogram = histogram}
 end
 
--- Return the prefix for this particular queue
-function ReqlessQueue:prefix(group)
-  if group then
-    return ReqlessQueue.ns .. self.name .. '-' .. group
+-- Add the totals of the `stats` to the totals `into`, returning `into`
+function ReqlessQueue.merge_stats(into, stats)
+  into.count = into.count + stats.count
+  into.sum   = into.sum + stats.sum
+  into.sumsq = into.sumsq + stats.sumsq
+  for i, value in ipairs(stats.histogram) do
+    into.histogram[i] = into.histogram[i] + value
   end
+  return into
+end
 
-  return ReqlessQueue.ns .. self.name
+-- Empty totals of wait or run stats, to merge others into
+function ReqlessQueue.empty_stats()
+  local histogram = {}
+  for i = 1, #ReqlessQueue.histokeys do
+    histogram[i] = 0
+  end
+  return {count = 0, sum = 0, sumsq = 0, histogram = histogram}
+end
+
+-- Summarize the totals of wait or run stats as their count, mean, standard
+-- deviation and histogram
+function ReqlessQueue.summarize_stats(stats)
+  local results = {
+    count     = stats.count,
+    mean      = 0,
+    std       = 0,
+    histogram = stats.histogram
+  }
+  if stats.count > 0 then
+    results.mean = stats.sum / stats.count
+  end
+  if stats.count > 1 then
+    results.std = math.sqrt(math.max(0,
+      (stats.sumsq - stats.sum * stats.sum / stats.count) / (stats.count - 1)))
+  end
+  return results
 end
 
 -- Stats(now, date)
@@ -183,53 +446,198 @@ function ReqlessQueue:stats(now, date)
   -- 24 * 60 * 60 = 86400
   local bin = date - (date % 86400)
 
-  -- This a table of all the keys we want to use in order to produce a histogram
-  local histokeys = {
-    's0','s1','s2','s3','s4','s5','s6','s7','s8','s9','s10','s11','s12','s13','s14','s15','s16','s17','s18','s19','s20','s21','s22','s23','s24','s25','s26','s27','s28','s29','s30','s31','s32','s33','s34','s35','s36','s37','s38','s39','s40','s41','s42','s43','s44','s45','s46','s47','s48','s49','s50','s51','s52','s53','s54','s55','s56','s57','s58','s59',
-    'm1','m2','m3','m4','m5','m6','m7','m8','m9','m10','m11','m12','m13','m14','m15','m16','m17','m18','m19','m20','m21','m22','m23','m24','m25','m26','m27','m28','m29','m30','m31','m32','m33','m34','m35','m36','m37','m38','m39','m40','m41','m42','m43','m44','m45','m46','m47','m48','m49','m50','m51','m52','m53','m54','m55','m56','m57','m58','m59',
-    'h1','h2','h3','h4','h5','h6','h7','h8','h9','h10','h11','h12','h13','h14','h15','h16','h17','h18','h19','h20','h21','h22','h23',
-    'd1','d2','d3','d4','d5','d6'
+  local mkstats = function(name, bin, queue)
+    return ReqlessQueue.summarize_stats(ReqlessQueue.read_stats(
+      Reqless.ns .. 's:' .. name .. ':' .. bin .. ':' .. queue))
+  end
+
+  local retries, failed, failures = unpack(redis.call('hmget', Reqless.ns .. 's:stats:' .. bin .. ':' .. self.name, 'retries', 'failed', 'failures'))
+  return {
+    retries  = tonumber(retries  or 0),
+    failed   = tonumber(failed   or 0),
+    failures = tonumber(failures or 0),
+    wait     = mkstats('wait', bin, self.name),
+    run      = mkstats('run' , bin, self.name)
   }
+end
 
-  local mkstats = function(name, bin, queue)
-    -- The results we'll be sending back
-    local results = {}
+-- StatsRange(now, queues, from, to, [resolution])
+-- -----------------------------------------------
+-- Return the stats of each of the named queues, and of all of them together,
+-- over the days from the one containing `from` to the one containing `to`.
+-- The days are merged into periods of `resolution` seconds, which must be a
+-- whole number of days, starting from the start of the first day. Without a
+-- resolution, all the days are merged into one period.
+--
+--  {
+--      'queues': {
+--          'queue': [
+--              {
+--                  'time'    : <start of the period>,
+--                  'failed'  : 3,
+--                  'failures': 5,
+--                  'retries' : 5,
+--                  'wait'    : {'count': ..., 'mean': ..., 'std': ...,
+--                      'histogram': [...]},
+--                  'run'     : {...}
+--              }, ...
+--          ], ...
+--      },
+--      'total': [...]
+--  }
+function ReqlessQueue.stats_range(now, names, from, to, resolution)
+  from = assert(tonumber(from),
+    'StatsRange(): Arg "from" missing or not a number: ' .. tostring(from))
+  to = assert(tonumber(to),
+    'StatsRange(): Arg "to" missing or not a number: ' .. tostring(to))
+  assert(to >= from, 'StatsRange(): Arg "to" must not be before "from"')
+
+  local first = from - (from % 86400)
+  local last = to - (to % 86400)
+  resolution = assert(tonumber(resolution or (last - first + 86400)),
+    'StatsRange(): Arg "resolution" not a number: ' .. tostring(resolution))
+  assert(resolution > 0 and resolution % 86400 == 0,
+    'StatsRange(): Arg "resolution" must be a positive number of days')
+
+  local empty_period = function(time)
+    return {
+      time = time, retries = 0, failed = 0, failures = 0,
+      wait = ReqlessQueue.empty_stats(), run = ReqlessQueue.empty_stats()
+    }
+  end
 
-    local key = 'ql:s:' .. name .. ':' .. bin .. ':' .. queue
-    local count, mean, vk = unpack(redis.call('hmget', key, 'total', 'mean', 'vk'))
+  local merge_period = function(into, period)
+    into.retries  = into.retries + period.retries
+    into.failed   = into.failed + period.failed
+    into.failures = into.failures + period.failures
+    ReqlessQueue.merge_stats(into.wait, period.wait)
+    ReqlessQueue.merge_stats(into.run, period.run)
+  end
 
-    count = tonumber(count) or 0
-    mean  = tonumber(mean) or 0
-    vk    = tonumber(vk)
+  local summarize_periods = function(periods)
+    for _, period in ipairs(periods) do
+      period.wait = ReqlessQueue.summarize_stats(period.wait)
+      period.run  = ReqlessQueue.summarize_stats(period.run)
+    end
+    return periods
+  end
 
-    results.count     = count or 0
-    results.mean      = mean  or 0
-    results.histogram = {}
+  local total = {}
+  for time = first, last, resolution do
+    table.insert(total, empty_period(time))
+  end
 
-    if not count then
-      results.std = 0
-    else
-      if count > 1 then
-        results.std = math.sqrt(vk / (count - 1))
-      else
-        results.std = 0
+  local response = {queues = {}, total = total}
+  for _, name in ipairs(names) do
+    local periods = {}
+    for index, total_period in ipairs(total) do
+      local period = empty_period(total_period.time)
+      for bin = period.time, math.min(period.time + resolution, last + 1) - 1,
+        86400 do
+        local retries, failed, failures = unpack(redis.call('hmget',
+          Reqless.ns .. 's:stats:' .. bin .. ':' .. name, 'retries', 'failed', 'failures'))
+        merge_period(period, {
+          retries  = tonumber(retries  or 0),
+          failed   = tonumber(failed   or 0),
+          failures = tonumber(failures or 0),
+          wait     = ReqlessQueue.read_stats(
+            Reqless.ns .. 's:wait:' .. bin .. ':' .. name),
+          run      = ReqlessQueue.read_stats(
+            Reqless.ns .. 's:run:' .. bin .. ':' .. name)
+        })
       end
+      merge_period(total_period, period)
+      table.insert(periods, period)
     end
+    response.queues[name] = summarize_periods(periods)
+  end
+  summarize_periods(total)
+  return response
+end
 
-    local histogram = redis.call('hmget', key, unpack(histokeys))
-    for i=1, #histokeys do
-      table.insert(results.histogram, tonumber(histogram[i]) or 0)
+-- Percentiles(now, date, [quantiles, [span]])
+-- --------------------------------------------
+-- Return the given quantiles of the wait and run times of jobs in this queue,
+-- computed from the log-scale histograms kept when the `stats-precision`
+-- config is non-zero. The histograms are kept hourly, and `span` seconds of
+-- them are merged, starting from the start of the span containing `date`. The
+-- span is a day by default, and must be a whole number of hours. The default
+-- quantiles are 0.5, 0.95 and 0.99.
+--
+--  {
+--      'quantiles': [0.5, 0.95, 0.99],
+--      'wait': {
+--          'count' : 100,
+--          'values': [1.2, 3.5, 4.9]
+--      }, 'run': {
+--          ...
+--      }
+--  }
+--
+-- Each value is in seconds, and is accurate to within the precision of the
+-- histogram. The values are all 0 when there are no data points.
+function ReqlessQueue:percentiles(now, date, quantiles, span)
+  date = assert(tonumber(date),
+    'Percentiles(): Arg "date" missing or not a number: ' .. tostring(date))
+  quantiles = cjson.decode(quantiles or '[0.5, 0.95, 0.99]')
+  assert(type(quantiles) == 'table',
+    'Percentiles(): Arg "quantiles" not a JSON array')
+  for _, quantile in ipairs(quantiles) do
+    assert(type(quantile) == 'number' and quantile >= 0 and quantile <= 1,
+      'Percentiles(): Arg "quantiles" must hold numbers from 0 to 1')
+  end
+  span = assert(tonumber(span or 86400),
+    'Percentiles(): Arg "span" not a number: ' .. tostring(span))
+  assert(span > 0 and span % 3600 == 0,
+    'Percentiles(): Arg "span" must be a positive number of hours')
+
+  local start = date - (date % span)
+  local precision = tonumber(Reqless.config.get('stats-precision'))
+
+  local mkpercentiles = function(name)
+    -- Merge the counts of each bucket across the hours of the span
+    local counts, lowers, total = {}, {}, 0
+    for hour = start, start + span - 1, 3600 do
+      local key =
+        Reqless.ns .. 's:' .. name .. '-log:' .. hour .. ':' .. self.name
+      local histogram = redis.call('hgetall', key)
+      for i = 1, #histogram, 2 do
+        local lower = tonumber(histogram[i])
+        if not counts[lower] then
+          counts[lower] = 0
+          table.insert(lowers, lower)
+        end
+        counts[lower] = counts[lower] + tonumber(histogram[i + 1])
+        total = total + tonumber(histogram[i + 1])
+      end
     end
-    return results
+    table.sort(lowers)
+
+    -- Walk the buckets in order, reporting the middle of the bucket that
+    -- holds the data point of each rank
+    local values = {}
+    for _, quantile in ipairs(quantiles) do
+      if total == 0 then
+        table.insert(values, 0)
+      else
+        local rank = math.max(1, math.ceil(quantile * total))
+        local seen, index = 0, 0
+        while seen < rank do
+          index = index + 1
+          seen = seen + counts[lowers[index]]
+        end
+        local lower = lowers[index]
+        local width = ReqlessQueue.log_bucket_width(lower, precision)
+        table.insert(values, (lower + width / 2) / 1000)
+      end
+    end
+    return {count = total, values = values}
   end
 
-  local retries, failed, failures = unpack(redis.call('hmget', 'ql:s:stats:' .. bin .. ':' .. self.name, 'retries', 'failed', 'failures'))
   return {
-    retries  = tonumber(retries  or 0),
-    failed   = tonumber(failed   or 0),
-    failures = tonumber(failures or 0),
-    wait     = mkstats('wait', bin, self.name),
-    run      = mkstats('run' , bin, self.name)
+    quantiles = quantiles,
+    wait      = mkpercentiles('wait'),
+    run       = mkpercentiles('run')
   }
 end
 
@@ -252,32 +660,34 @@ function ReqlessQueue:peek(now, offset, limit)
 
   -- These are the ids that we're going to return. We'll begin with any jobs
   -- that have lost their locks
-  local jids = self.locks.expired(now, 0, offset_with_limit)
+  local jids = self.locks:expired(now, 0, offset_with_limit)
 
   -- Since we can't just peek the range we want, we have to consider all offset
   -- + limit jobs before we can take the relevant range.
   local remaining_capacity = offset_with_limit - #jids
 
-  -- If we still need jobs in order to meet demand, then we should
-  -- look for all the recurring jobs that need jobs run
-  self:check_recurring(now, remaining_capacity)
-
-  -- Now we've checked __all__ the locks for this queue the could
-  -- have expired, and are no more than the number requested. If
-  -- we still need values in order to meet the demand, then we
-  -- should check if any scheduled items, and if so, we should
-  -- insert them to ensure correctness when pulling off the next
-  -- unit of work.
-  self:check_scheduled(now, remaining_capacity)
+  if ReqlessQueue.inline_promotion() then
+    -- If we still need jobs in order to meet demand, then we should
+    -- look for all the recurring jobs that need jobs run
+    self:check_recurring(now, remaining_capacity)
+
+    -- Now we've checked __all__ the locks for this queue the could
+    -- have expired, and are no more than the number requested. If
+    -- we still need values in order to meet the demand, then we
+    -- should check if any scheduled items, and if so, we should
+    -- insert them to ensure correctness when pulling off the next
+    -- unit of work.
+    self:check_scheduled(now, remaining_capacity)
+  end
 
   if offset > #jids then
     -- Offset takes us past the expired jids, so just return straight from the
     -- work queue
-    return self.work.peek(offset - #jids, limit)
+    return self.work:peek(offset - #jids, limit)
   end
 
   -- Return a mix of expired jids and prioritized items from the work queue
-  table_extend(jids, self.work.peek(0, remaining_capacity))
+  table_extend(jids, self.work:peek(0, remaining_capacity))
 
   if #jids < offset then
     return {}
@@ -288,7 +698,7 @@ end
 
 -- Return true if this queue is paused
 function ReqlessQueue:paused()
-  return redis.call('sismember', 'ql:paused_queues', self.name) == 1
+  return redis.call('sismember', Reqless.ns .. 'paused_queues', self.name) == 1
 end
 
 -- Pause this queue
@@ -299,12 +709,12 @@ end
 -- For now, this is far simpler, but we should rewrite this
 -- in terms of the rate limiting feature if/when that is added.
 function ReqlessQueue.pause(now, ...)
-  redis.call('sadd', 'ql:paused_queues', unpack(arg))
+  redis.call('sadd', Reqless.ns .. 'paused_queues', unpack(arg))
 end
 
 -- Unpause this queue
 function ReqlessQueue.unpause(...)
-  redis.call('srem', 'ql:paused_queues', unpack(arg))
+  redis.call('srem', Reqless.ns .. 'paused_queues', unpack(arg))
 end
 
 -- Checks for expired locks, scheduled and recurring jobs, returning any
@@ -320,36 +730,48 @@ function ReqlessQueue:pop(now, worker, limit)
   end
 
   -- Make sure we this worker to the list of seen workers
-  redis.call('zadd', 'ql:workers', now, worker)
+  redis.call('zadd', Reqless.ns .. 'workers', now, worker)
 
-  local dead_jids = self:invalidate_locks(now, limit) or {}
+  -- Unless they're left to `queues.reap`, invalidate any expired locks
+  local dead_jids = {}
+  if tonumber(Reqless.config.get('pop-invalidates-locks', 1)) ~= 0 then
+    dead_jids = self:invalidate_locks(now, limit) or {}
+  end
   local popped = {}
+  -- The expiration and jid of each lock to add once the jobs are popped
+  local locks = {}
 
   for _, jid in ipairs(dead_jids) do
-    local success = self:pop_job(now, worker, Reqless.job(jid))
+    local expires = self:pop_job(now, worker, Reqless.job(jid))
     -- only track jid if a job was popped and it's not a phantom jid
-    if success then
+    if expires then
       table.insert(popped, jid)
+      table.insert(locks, expires)
+      table.insert(locks, jid)
     end
   end
 
   -- if queue is at max capacity don't pop any further jobs.
   if not Reqless.throttle(ReqlessQueue.ns .. self.name):available() then
+    self:add_locks(worker, locks)
+    ReqlessQueue.flush_stats()
     return popped
   end
 
   -- Now we've checked __all__ the locks for this queue the could
   -- have expired, and are no more than the number requested.
 
-  -- If we still need jobs in order to meet demand, then we should
-  -- look for all the recurring jobs that need jobs run
-  self:check_recurring(now, limit - #dead_jids)
+  if ReqlessQueue.inline_promotion() then
+    -- If we still need jobs in order to meet demand, then we should
+    -- look for all the recurring jobs that need jobs run
+    self:check_recurring(now, limit - #dead_jids)
 
-  -- If we still need values in order to meet the demand, then we
-  -- should check if any scheduled items, and if so, we should
-  -- insert them to ensure correctness when pulling off the next
-  -- unit of work.
-  self:check_scheduled(now, limit - #dead_jids)
+    -- If we still need values in order to meet the demand, then we
+    -- should check if any scheduled items, and if so, we should
+    -- insert them to ensure correctness when pulling off the next
+    -- unit of work.
+    self:check_scheduled(now, limit - #dead_jids)
+  end
 
   -- With these in place, we can expand this list of jids based on the work
   -- queue itself and the priorities therein
@@ -365,7 +787,7 @@ function ReqlessQueue:pop(now, worker, limit)
   -- the desired limit or exhaust our retry limit
   while #popped < limit and pop_retry_limit > 0 do
 
-    local jids = self.work.peek(0, limit - #popped) or {}
+    local jids = self.work:peek(0, limit - #popped) or {}
 
     -- If there is nothing in the work queue, then no need to keep looping
     if #jids == 0 then
@@ -376,10 +798,12 @@ function ReqlessQueue:pop(now, worker, limit)
     for _, jid in ipairs(jids) do
       local job = Reqless.job(jid)
       if job:throttles_acquire(now) then
-        local success = self:pop_job(now, worker, job)
+        local expires = self:pop_job(now, worker, job)
         -- only track jid if a job was popped and it's not a phantom jid
-        if success then
+        if expires then
           table.insert(popped, jid)
+          table.insert(locks, expires)
+          table.insert(locks, jid)
         end
       else
         self:throttle(now, job)
@@ -388,36 +812,52 @@ function ReqlessQueue:pop(now, worker, limit)
 
     -- All jobs should have acquired locks or be throttled,
     -- ergo, remove all jids from work queue
-    self.work.remove(unpack(jids))
+    self.work:remove(unpack(jids))
 
     pop_retry_limit = pop_retry_limit - 1
   end
 
+  self:add_locks(worker, locks)
+  ReqlessQueue.flush_stats()
   return popped
 end
 
+-- Add the locks of the jobs popped by the worker, and add the jobs to the
+-- worker's jobs. `locks` holds pairs of expiration and jid, which are written
+-- a few hundred at a time rather than one job at a time.
+function ReqlessQueue:add_locks(worker, locks)
+  local key = Reqless.ns .. 'w:' .. worker .. ':jobs'
+  for index = 1, #locks, 1000 do
+    local chunk = {unpack(locks, index, math.min(index + 999, #locks))}
+    redis.call('zadd', key, unpack(chunk))
+    self.locks:add(unpack(chunk))
+  end
+end
+
 -- Throttle a job
 function ReqlessQueue:throttle(now, job)
   job:throttle(now)
-  self.throttled.add(now, job.jid)
+  self.throttled:add(now, job.jid)
   local state = unpack(job:data('state'))
   if state ~= 'throttled' then
     job:update({state = 'throttled'})
-    job:history(now, 'throttled', {queue = self.name})
+    job:history(now, 'throttled', {queue = self.name}, self.name)
   end
 end
 
+-- Hand the job out to the worker, returning when its lock expires, or false
+-- if the job doesn't exist. The lock itself is left for `add_locks` to add.
 function ReqlessQueue:pop_job(now, worker, job)
-  local state
   local jid = job.jid
-  local job_state = job:data('state')
+  -- Read everything we need from the job's hash at once
+  local state, time = unpack(
+    redis.call('hmget', ReqlessJob.ns .. jid, 'state', 'time'))
   -- if the job doesn't exist, short circuit
-  if not job_state then
+  if not state then
     return false
   end
 
-  state = unpack(job_state)
-  job:history(now, 'popped', {worker = worker})
+  job:history(now, 'popped', {worker = worker}, self.name)
 
   -- We should find the heartbeat interval for this queue heartbeat
   local expires = now + tonumber(
@@ -425,71 +865,123 @@ function ReqlessQueue:pop_job(now, worker, job)
     Reqless.config.get('heartbeat', 60))
 
   -- Update the wait time statistics
-  -- Just does job:data('time') do the same as this?
-  local time = tonumber(redis.call('hget', ReqlessJob.ns .. jid, 'time') or now)
-  local waiting = now - time
+  local waiting = now - tonumber(time or now)
   self:stat(now, 'wait', waiting)
-  redis.call('hset', ReqlessJob.ns .. jid,
-    'time', string.format("%.20f", now))
-
-  -- Add this job to the list of jobs handled by this worker
-  redis.call('zadd', 'ql:w:' .. worker .. ':jobs', expires, jid)
 
-  -- Update the jobs data, and add its locks, and return the job
+  -- Update the jobs data
   job:update({
     worker  = worker,
     expires = expires,
-    state   = 'running'
+    state   = 'running',
+    time    = string.format("%.20f", now)
   })
 
-  self.locks.add(expires, jid)
-
-  local tracked = redis.call('zscore', 'ql:tracked', jid) ~= false
-  if tracked then
+  if Reqless.tracked(jid) then
     Reqless.publish('popped', jid)
   end
-  return true
+  return expires
 end
 
--- Update the stats for this queue
+-- The width, in milliseconds, of the log-scale histogram bucket starting at
+-- `lower` milliseconds. Values below 2 ^ (precision + 1) milliseconds are kept
+-- exactly, and the width of the buckets doubles with each doubling of values
+-- after that, so that each value is within 2 ^ -precision of its bucket.
+function ReqlessQueue.log_bucket_width(lower, precision)
+  local width = 1
+  local limit = 2 ^ (precision + 1)
+  while lower >= limit * width do
+    width = width * 2
+  end
+  return width
+end
+
+-- The log-scale histogram bucket for a value in seconds, as the lower bound
+-- of the bucket in milliseconds
+function ReqlessQueue.log_bucket(val, precision)
+  local millis = math.max(0, math.floor(val * 1000))
+  local width = ReqlessQueue.log_bucket_width(millis, precision)
+  return millis - (millis % width)
+end
+
+-- The observations of wait and run times in this invocation that are yet to
+-- be written, by the stats key they belong to, so that the observations of
+-- many jobs popped or completed together are written at once
+ReqlessQueue.observations = {}
+
+-- Update the stats for this queue. The observation is only written once the
+-- stats are flushed.
 function ReqlessQueue:stat(now, stat, val)
   -- The bin is midnight of the provided day
   local bin = now - (now % 86400)
-  local key = 'ql:s:' .. stat .. ':' .. bin .. ':' .. self.name
-
-  -- Get the current data
-  local count, mean, vk = unpack(
-    redis.call('hmget', key, 'total', 'mean', 'vk'))
-
-  -- If there isn't any data there presently, then we must initialize it
-  count = count or 0
-  if count == 0 then
-    mean  = val
-    vk    = 0
-    count = 1
-  else
-    count = count + 1
-    local oldmean = mean
-    mean  = mean + (val - mean) / count
-    vk    = vk + (val - mean) * (val - oldmean)
-  end
+  local observed = ReqlessQueue.observed(
+    Reqless.ns .. 's:' .. stat .. ':' .. bin .. ':' .. self.name)
+  observed.sum = observed.sum + val
+  observed.sumsq = observed.sumsq + val * val
 
   -- Now, update the histogram
   -- - `s1`, `s2`, ..., -- second-resolution histogram counts
   -- - `m1`, `m2`, ..., -- minute-resolution
   -- - `h1`, `h2`, ..., -- hour-resolution
   -- - `d1`, `d2`, ..., -- day-resolution
-  val = math.floor(val)
-  if val < 60 then -- seconds
-    redis.call('hincrby', key, 's' .. val, 1)
-  elseif val < 3600 then -- minutes
-    redis.call('hincrby', key, 'm' .. math.floor(val / 60), 1)
-  elseif val < 86400 then -- hours
-    redis.call('hincrby', key, 'h' .. math.floor(val / 3600), 1)
+  local seconds = math.floor(val)
+  if seconds < 60 then -- seconds
+    ReqlessQueue.observe(observed, 's' .. seconds)
+  elseif seconds < 3600 then -- minutes
+    ReqlessQueue.observe(observed, 'm' .. math.floor(seconds / 60))
+  elseif seconds < 86400 then -- hours
+    ReqlessQueue.observe(observed, 'h' .. math.floor(seconds / 3600))
   else -- days
-    redis.call('hincrby', key, 'd' .. math.floor(val / 86400), 1)
+    ReqlessQueue.observe(observed, 'd' .. math.floor(seconds / 86400))
+  end
+
+  -- And the hourly log-scale histogram, if one is kept
+  local precision = tonumber(Reqless.config.get('stats-precision'))
+  if precision > 0 then
+    local hour = now - (now % 3600)
+    ReqlessQueue.observe(
+      ReqlessQueue.observed(
+        Reqless.ns .. 's:' .. stat .. '-log:' .. hour .. ':' .. self.name),
+      string.format('%d', ReqlessQueue.log_bucket(val, precision)))
+  end
+end
+
+-- The observations yet to be written to the stats key
+function ReqlessQueue.observed(key)
+  local observed = ReqlessQueue.observations[key]
+  if not observed then
+    observed = {sum = 0, sumsq = 0, counts = {}}
+    ReqlessQueue.observations[key] = observed
+    table.insert(ReqlessQueue.observations, key)
+  end
+  return observed
+end
+
+-- Count an observation in a field of the observed stats
+function ReqlessQueue.observe(observed, field)
+  if not observed.counts[field] then
+    observed.counts[field] = 0
+    table.insert(observed.counts, field)
+  end
+  observed.counts[field] = observed.counts[field] + 1
+end
+
+-- Write all the observations made so far. Each field is incremented once, no
+-- matter how many observations it holds, and none of the stats are read.
+function ReqlessQueue.flush_stats()
+  local observations = ReqlessQueue.observations
+  ReqlessQueue.observations = {}
+  for _, key in ipairs(observations) do
+    local observed = observations[key]
+    for _, field in ipairs(observed.counts) do
+      redis.call('hincrby', key, field, observed.counts[field])
+    end
+    if observed.sumsq > 0 then
+      redis.call('hincrbyfloat', key, 'sum',
+        string.format('%.17g', observed.sum))
+      redis.call('hincrbyfloat', key, 'sumsq',
+        string.format('%.17g', observed.sumsq))
+    end
   end
-  redis.call('hmset', key, 'total', count, 'mean', mean, 'vk', vk)
 end
 
 -- Put(now, jid, klass, data, delay,
@@ -503,7 +995,7 @@ end
 function ReqlessQueue:put(now, worker, jid, klass, raw_data, delay, ...)
   assert(jid  , 'Put(): Arg "jid" missing')
   assert(klass, 'Put(): Arg "klass" missing')
-  local data = assert(cjson.decode(raw_data),
+  assert(cjson.decode(raw_data),
     'Put(): Arg "data" missing or not JSON: ' .. tostring(raw_data))
   delay = assert(tonumber(delay),
     'Put(): Arg "delay" not a number: ' .. tostring(delay))
@@ -516,28 +1008,174 @@ function ReqlessQueue:put(now, worker, jid, klass, raw_data, delay, ...)
   local options = {}
   for i = 1, #arg, 2 do options[arg[i]] = arg[i + 1] end
 
+  -- Sanity check on optional args
+  if options['retries'] then
+    options['retries'] = assert(tonumber(options['retries']),
+      'Put(): Arg "retries" not a number: ' .. tostring(options['retries']))
+  end
+  if options['tags'] then
+    options['tags'] = assert(cjson.decode(options['tags']),
+      'Put(): Arg "tags" not JSON'          .. tostring(options['tags']))
+  end
+  if options['priority'] then
+    options['priority'] = assert(tonumber(options['priority']),
+      'Put(): Arg "priority" not a number'  .. tostring(options['priority']))
+  end
+  options['depends'] = assert(cjson.decode(options['depends'] or '[]') ,
+    'Put(): Arg "depends" not JSON: '     .. tostring(options['depends']))
+  options['throttles'] = assert(cjson.decode(options['throttles'] or '[]'),
+    'Put(): Arg "throttles" not JSON array: ' .. tostring(options['throttles']))
+
+  -- Send out a log message
+  Reqless.publish('log', cjson.encode({
+    jid   = jid,
+    event = 'put',
+    queue = self.name
+  }))
+
+  self:put_job(now, worker, jid, klass, raw_data, delay, options)
+
+  -- Lastly, we're going to make sure that this queue is in the set of known
+  -- queues
+  self:register(now)
+
+  return jid
+end
+
+-- PutMulti(now, worker, jobs)
+-- ---------------------------
+-- Insert many jobs into the queue at once. `jobs` is a JSON array of objects
+-- with the same arguments as `Put`:
+--
+--  [{
+--      'jid': 'jid',
+--      'klass': 'klass',
+--      'data': {...},
+--      # All of the following are optional
+--      'delay': 0,
+--      'priority': 0,
+--      'tags': [...],
+--      'retries': 5,
+--      'depends': [...],
+--      'throttles': [...]
+--  }, ...]
+--
+-- Every job is validated before any is inserted, and a job that is malformed
+-- doesn't stop the others. No more than `max-put-multi` jobs are inserted in
+-- one call, so that Redis isn't blocked for too long. Returns the outcome of
+-- each job inserted, in order, so any jobs beyond those should be sent again
+-- in another call:
+--
+--  [{
+--      'jid': 'jid',
+--      'put': 'jid'
+--  }, {
+--      'jid': 'other',
+--      'error': 'PutMulti(): Job 2 Arg "klass" missing'
+--  }]
+function ReqlessQueue:putMulti(now, worker, raw_jobs)
+  local jobs = assert(cjson.decode(raw_jobs or ''),
+    'PutMulti(): Arg "jobs" missing or not JSON: ' .. tostring(raw_jobs))
+  assert(type(jobs) == 'table',
+    'PutMulti(): Arg "jobs" not a JSON array: ' .. tostring(raw_jobs))
+  local count = math.min(#jobs,
+    tonumber(Reqless.config.get('max-put-multi', 1000)))
+
+  -- Validate all the jobs before inserting any of them
+  local items, puts = {}, {}
+  for index = 1, count do
+    items[index] = jobs[index]
+    puts[index] = {pcall(ReqlessQueue.put_args, index, jobs[index])}
+  end
+
+  local registered = false
+  return ReqlessJob.batch(now, items, 'put',
+    function(index)
+      local ok, args = unpack(puts[index])
+      if not ok then
+        error(args, 0)
+      end
+      return function()
+        local jid, klass, raw_data, delay, options = unpack(args)
+
+        -- Send out a log message
+        Reqless.publish('log', cjson.encode({
+          jid   = jid,
+          event = 'put',
+          queue = self.name
+        }))
+
+        self:put_job(now, worker, jid, klass, raw_data, delay, options)
+
+        if not registered then
+          self:register(now)
+          registered = true
+        end
+        return jid
+      end
+    end)
+end
+
+-- The arguments of `put_job` for the job at the index of a `PutMulti` call,
+-- decoded and validated
+function ReqlessQueue.put_args(index, job)
+  local prefix = 'PutMulti(): Job ' .. index .. ' '
+  assert(type(job) == 'table', prefix .. 'not a JSON object')
+  local jid = assert(job.jid, prefix .. 'Arg "jid" missing')
+  assert(job.klass, prefix .. 'Arg "klass" missing')
+  local raw_data = job.data
+  if type(raw_data) == 'table' then
+    raw_data = cjson.encode(raw_data)
+  else
+    assert(raw_data and pcall(cjson.decode, raw_data),
+      prefix .. 'Arg "data" missing or not JSON: ' .. tostring(raw_data))
+  end
+  local delay = assert(tonumber(job.delay or 0),
+    prefix .. 'Arg "delay" not a number: ' .. tostring(job.delay))
+  local options = {
+    retries = job.retries and assert(tonumber(job.retries),
+      prefix .. 'Arg "retries" not a number: ' .. tostring(job.retries)),
+    priority = job.priority and assert(tonumber(job.priority),
+      prefix .. 'Arg "priority" not a number: ' .. tostring(job.priority)),
+  }
+  for _, key in ipairs({'tags', 'depends', 'throttles'}) do
+    assert(job[key] == nil or type(job[key]) == 'table',
+      prefix .. 'Arg "' .. key .. '" not a JSON array: ' .. tostring(job[key]))
+    options[key] = job[key]
+  end
+  options.depends = options.depends or {}
+  options.throttles = options.throttles or {}
+  return {jid, job.klass, raw_data, delay, options}
+end
+
+-- Make sure that this queue is in the set of known queues. We should keep
+-- this sorted by the order in which we saw each of these queues
+function ReqlessQueue:register(now)
+  if redis.call('zscore', Reqless.ns .. 'queues', self.name) == false then
+    redis.call('zadd', Reqless.ns .. 'queues', now, self.name)
+  end
+end
+
+-- Insert a job into the queue once its arguments have been validated. The
+-- `options` hold the decoded optional arguments of `Put`, and any of retries,
+-- tags and priority that are missing are kept from the job's previous values.
+function ReqlessQueue:put_job(now, worker, jid, klass, raw_data, delay, options)
   -- Let's see what the old priority and tags were
   local job = Reqless.job(jid)
-  local priority, tags, oldqueue, state, failure, retries, oldworker =
-    unpack(redis.call('hmget', ReqlessJob.ns .. jid, 'priority', 'tags',
-      'queue', 'state', 'failure', 'retries', 'worker'))
+  local priority, tags, oldqueue, state, failure, retries, oldworker,
+    spawned_from_jid = unpack(job:hmget('priority', 'tags', 'queue', 'state',
+      'failure', 'retries', 'worker', 'spawned_from_jid'))
 
   -- If there are old tags, then we should remove the tags this job has
   if tags then
     Reqless.tag(now, 'remove', jid, unpack(cjson.decode(tags)))
   end
 
-  -- Sanity check on optional args
-  local retries  = assert(tonumber(options['retries']  or retries or 5) ,
-    'Put(): Arg "retries" not a number: ' .. tostring(options['retries']))
-  local tags     = assert(cjson.decode(options['tags'] or tags or '[]' ),
-    'Put(): Arg "tags" not JSON'          .. tostring(options['tags']))
-  local priority = assert(tonumber(options['priority'] or priority or 0),
-    'Put(): Arg "priority" not a number'  .. tostring(options['priority']))
-  local depends = assert(cjson.decode(options['depends'] or '[]') ,
-    'Put(): Arg "depends" not JSON: '     .. tostring(options['depends']))
-  local throttles = assert(cjson.decode(options['throttles'] or '[]'),
-    'Put(): Arg "throttles" not JSON array: ' .. tostring(options['throttles']))
+  local retries   = options['retries'] or tonumber(retries or 5)
+  local tags      = options['tags'] or cjson.decode(tags or '[]')
+  local priority  = options['priority'] or tonumber(priority or 0)
+  local depends   = options['depends']
+  local throttles = options['throttles']
 
   -- If the job has old dependencies, determine which dependencies are
   -- in the new dependencies but not in the old ones, and which are in the
@@ -559,13 +1197,6 @@ function ReqlessQueue:put(now, worker, jid, klass, raw_data, delay, ...)
     end
   end
 
-  -- Send out a log message
-  Reqless.publish('log', cjson.encode({
-    jid   = jid,
-    event = 'put',
-    queue = self.name
-  }))
-
   -- Update the history to include this new change
   job:history(now, 'put', {queue = self.name})
 
@@ -585,7 +1216,7 @@ function ReqlessQueue:put(now, worker, jid, klass, raw_data, delay, ...)
   -- If this had previously been given out to a worker, make sure to remove it
   -- from that worker's jobs
   if oldworker and oldworker ~= '' then
-    redis.call('zrem', 'ql:w:' .. oldworker .. ':jobs', jid)
+    redis.call('zrem', Reqless.ns .. 'w:' .. oldworker .. ':jobs', jid)
     -- If it's a different worker that's putting this job, send a notification
     -- to the last owner of the job
     if oldworker ~= worker then
@@ -601,9 +1232,14 @@ function ReqlessQueue:put(now, worker, jid, klass, raw_data, delay, ...)
   end
 
   -- If the job was previously in the 'completed' state, then we should
-  -- remove it from being enqueued for destructination
+  -- remove it from being enqueued for destructination, and make sure that
+  -- redis doesn't expire it either
   if state == 'complete' then
-    redis.call('zrem', 'ql:completed', jid)
+    redis.call('zrem', Reqless.ns .. 'completed', jid)
+    redis.call('persist', ReqlessJob.ns .. jid)
+    redis.call('persist', ReqlessJob.ns .. jid .. '-history')
+    redis.call('persist', ReqlessJob.ns .. jid .. '-dependencies')
+    redis.call('persist', ReqlessJob.ns .. jid .. '-data')
   end
 
   -- Add this job to the list of jobs tagged with whatever tags were supplied
@@ -615,22 +1251,19 @@ function ReqlessQueue:put(now, worker, jid, klass, raw_data, delay, ...)
   if state == 'failed' then
     failure = cjson.decode(failure)
     -- We need to make this remove it from the failed queues
-    redis.call('lrem', 'ql:f:' .. failure.group, 0, jid)
-    if redis.call('llen', 'ql:f:' .. failure.group) == 0 then
-      redis.call('srem', 'ql:failures', failure.group)
-    end
+    Reqless.failure_groups.remove(failure.group, jid)
     -- The bin is midnight of the provided day
     -- 24 * 60 * 60 = 86400
     local bin = failure.when - (failure.when % 86400)
     -- We also need to decrement the stats about the queue on
     -- the day that this failure actually happened.
-    redis.call('hincrby', 'ql:s:stats:' .. bin .. ':' .. self.name, 'failed'  , -1)
+    redis.call('hincrby', Reqless.ns .. 's:stats:' .. bin .. ':' .. self.name, 'failed'  , -1)
   end
 
   -- insert default queue throttle
   table.insert(throttles, ReqlessQueue.ns .. self.name)
 
-  data = {
+  local data = {
     'jid'      , jid,
     'klass'    , klass,
     'data'     , raw_data,
@@ -645,9 +1278,13 @@ function ReqlessQueue:put(now, worker, jid, klass, raw_data, delay, ...)
     'time'     , string.format("%.20f", now),
     'throttles', cjson.encode(throttles)
   }
+  if spawned_from_jid then
+    table.insert(data, 'spawned_from_jid')
+    table.insert(data, spawned_from_jid)
+  end
 
   -- First, let's save its data
-  redis.call('hmset', ReqlessJob.ns .. jid, unpack(data))
+  job:store(state, data)
 
   -- These are the jids we legitimately have to wait on
   for _, j in ipairs(depends) do
@@ -666,35 +1303,28 @@ function ReqlessQueue:put(now, worker, jid, klass, raw_data, delay, ...)
     if redis.call('scard', ReqlessJob.ns .. jid .. '-dependencies') > 0 then
       -- We've already put it in 'depends'. Now, we must just save the data
       -- for when it's scheduled
-      self.depends.add(now, jid)
+      self.depends:add(now, jid)
       redis.call('hmset', ReqlessJob.ns .. jid,
         'state', 'depends',
         'scheduled', now + delay)
     else
-      self.scheduled.add(now + delay, jid)
+      self.scheduled:add(now + delay, jid)
     end
   else
     -- to avoid false negatives when popping jobs check if the job should be
     -- throttled immediately.
     local job = Reqless.job(jid)
     if redis.call('scard', ReqlessJob.ns .. jid .. '-dependencies') > 0 then
-      self.depends.add(now, jid)
+      self.depends:add(now, jid)
       redis.call('hset', ReqlessJob.ns .. jid, 'state', 'depends')
     elseif not job:throttles_available() then
       self:throttle(now, job)
     else
-      self.work.add(now, priority, jid)
+      self.work:add(now, priority, jid)
     end
   end
 
-  -- Lastly, we're going to make sure that this item is in the
-  -- set of known queues. We should keep this sorted by the
-  -- order in which we saw each of these queues
-  if redis.call('zscore', 'ql:queues', self.name) == false then
-    redis.call('zadd', 'ql:queues', now, self.name)
-  end
-
-  if redis.call('zscore', 'ql:tracked', jid) ~= false then
+  if Reqless.tracked(jid) then
     Reqless.publish('put', jid)
   end
 
@@ -708,29 +1338,28 @@ function ReqlessQueue:unfail(now, group, count)
     'Unfail(): Arg "count" not a number: ' .. tostring(count))
   assert(count > 0, 'Unfail(): Arg "count" must be greater than zero')
 
-  -- Get up to that many jobs, and we'll put them in the appropriate queue
-  local jids = redis.call('lrange', 'ql:f:' .. group, -count, -1)
+  -- Get up to that many of the jobs that failed first, and we'll put them in
+  -- the appropriate queue
+  local jids = Reqless.failure_groups.oldest(group, count)
 
   -- And now set each job's state, and put it into the appropriate queue
   local toinsert = {}
   for _, jid in ipairs(jids) do
     local job = Reqless.job(jid)
-    local data = job:data()
+    local priority, retries = unpack(
+      redis.call('hmget', ReqlessJob.ns .. jid, 'priority', 'retries'))
     job:history(now, 'put', {queue = self.name})
-    redis.call('hmset', ReqlessJob.ns .. data.jid,
+    redis.call('hmset', ReqlessJob.ns .. jid,
       'state'    , 'waiting',
       'worker'   , '',
       'expires'  , 0,
       'queue'    , self.name,
-      'remaining', data.retries or 5)
-    self.work.add(now, data.priority, data.jid)
+      'remaining', tonumber(retries or 5))
+    self.work:add(now, tonumber(priority), jid)
   end
 
   -- Remove these jobs from the failed state
-  redis.call('ltrim', 'ql:f:' .. group, 0, -count - 1)
-  if (redis.call('llen', 'ql:f:' .. group) == 0) then
-    redis.call('srem', 'ql:failures', group)
-  end
+  Reqless.failure_groups.remove_oldest(group, count)
 
   return #jids
 end
@@ -774,7 +1403,7 @@ function ReqlessQueue:recurAtInterval(now, jid, klass, raw_data, interval, offse
   options.throttles = assert(cjson.decode(options['throttles'] or '{}'),
     'Recur(): Arg "throttles" not JSON array: ' .. tostring(options['throttles']))
 
-  local count, old_queue = unpack(redis.call('hmget', 'ql:r:' .. jid, 'count', 'queue'))
+  local count, old_queue = unpack(redis.call('hmget', Reqless.ns .. 'r:' .. jid, 'count', 'queue'))
   count = count or 0
 
   local throttles = options['throttles'] or {}
@@ -782,7 +1411,7 @@ function ReqlessQueue:recurAtInterval(now, jid, klass, raw_data, interval, offse
   -- If it has previously been in another queue, then we should remove
   -- some information about it
   if old_queue then
-    Reqless.queue(old_queue).recurring.remove(jid)
+    Reqless.queue(old_queue).recurring:remove(jid)
 
     for index, throttle_name in ipairs(throttles) do
       if throttle_name == old_queue then
@@ -795,7 +1424,7 @@ function ReqlessQueue:recurAtInterval(now, jid, klass, raw_data, interval, offse
   table.insert(throttles, ReqlessQueue.ns .. self.name)
 
   -- Do some insertions
-  redis.call('hmset', 'ql:r:' .. jid,
+  redis.call('hmset', Reqless.ns .. 'r:' .. jid,
     'jid'      , jid,
     'klass'    , klass,
     'data'     , raw_data,
@@ -811,13 +1440,13 @@ function ReqlessQueue:recurAtInterval(now, jid, klass, raw_data, interval, offse
     'backlog'  , options.backlog,
     'throttles', cjson.encode(throttles))
   -- Now, we should schedule the next run of the job
-  self.recurring.add(now + offset, jid)
+  self.recurring:add(now + offset, jid)
 
   -- Lastly, we're going to make sure that this item is in the
   -- set of known queues. We should keep this sorted by the
   -- order in which we saw each of these queues
-  if redis.call('zscore', 'ql:queues', self.name) == false then
-    redis.call('zadd', 'ql:queues', now, self.name)
+  if redis.call('zscore', Reqless.ns .. 'queues', self.name) == false then
+    redis.call('zadd', Reqless.ns .. 'queues', now, self.name)
   end
 
   return jid
@@ -825,41 +1454,42 @@ end
 
 -- Return the length of the queue
 function ReqlessQueue:length()
-  return  self.locks.length() + self.work.length() + self.scheduled.length()
+  return  self.locks:length() + self.work:length() + self.scheduled:length()
 end
 
 -------------------------------------------------------------------------------
 -- Housekeeping methods
 -------------------------------------------------------------------------------
 function ReqlessQueue:remove_job(jid)
-  self.work.remove(jid)
-  self.locks.remove(jid)
-  self.throttled.remove(jid)
-  self.depends.remove(jid)
-  self.scheduled.remove(jid)
+  self.work:remove(jid)
+  self.locks:remove(jid)
+  self.throttled:remove(jid)
+  self.depends:remove(jid)
+  self.scheduled:remove(jid)
 end
 
--- Instantiate any recurring jobs that are ready
+-- Instantiate up to `count` jobs from the recurring jobs that are ready.
+-- Returns the number of jobs instantiated
 function ReqlessQueue:check_recurring(now, count)
   if count <= 0 then
-    return
+    return 0
   end
   -- This is how many jobs we've moved so far
   local moved = 0
   -- These are the recurring jobs that need work
-  local r = self.recurring.peek(now, 0, count)
+  local r = self.recurring:peek(now, 0, count)
   for _, jid in ipairs(r) do
     -- For each of the jids that need jobs scheduled, first
     -- get the last time each of them was run, and then increment
     -- it by its interval. While this time is less than now,
     -- we need to keep putting jobs on the queue
-    local r = redis.call('hmget', 'ql:r:' .. jid, 'klass', 'data', 'priority',
+    local r = redis.call('hmget', Reqless.ns .. 'r:' .. jid, 'klass', 'data', 'priority',
         'tags', 'retries', 'interval', 'backlog', 'throttles')
     local klass, data, priority, tags, retries, interval, backlog, throttles = unpack(
-      redis.call('hmget', 'ql:r:' .. jid, 'klass', 'data', 'priority',
+      redis.call('hmget', Reqless.ns .. 'r:' .. jid, 'klass', 'data', 'priority',
         'tags', 'retries', 'interval', 'backlog', 'throttles'))
     local _tags = cjson.decode(tags)
-    local score = math.floor(tonumber(self.recurring.score(jid)))
+    local score = math.floor(tonumber(self.recurring:score(jid)))
     interval = tonumber(interval)
 
     -- If the backlog is set for this job, then see if it's been a long
@@ -879,7 +1509,7 @@ function ReqlessQueue:check_recurring(now, count)
     -- We're saving this value so that in the history, we can accurately
     -- reflect when the job would normally have been scheduled
     while (score <= now) and (moved < count) do
-      local count = redis.call('hincrby', 'ql:r:' .. jid, 'count', 1)
+      local count = redis.call('hincrby', Reqless.ns .. 'r:' .. jid, 'count', 1)
       moved = moved + 1
 
       local child_jid = jid .. '-' .. count
@@ -891,7 +1521,7 @@ function ReqlessQueue:check_recurring(now, count)
       end
 
       -- First, let's save its data
-      redis.call('hmset', ReqlessJob.ns .. child_jid,
+      Reqless.job(child_jid):store(false, {
         'jid'      , child_jid,
         'klass'    , klass,
         'data'     , data,
@@ -905,31 +1535,33 @@ function ReqlessQueue:check_recurring(now, count)
         'remaining', retries,
         'time'     , string.format("%.20f", score),
         'throttles', throttles,
-        'spawned_from_jid', jid)
+        'spawned_from_jid', jid})
 
       Reqless.job(child_jid):history(score, 'put', {queue = self.name})
 
       -- Now, if a delay was provided, and if it's in the future,
       -- then we'll have to schedule it. Otherwise, we're just
       -- going to add it to the work queue.
-      self.work.add(score, priority, child_jid)
+      self.work:add(score, priority, child_jid)
 
       score = score + interval
-      self.recurring.add(score, jid)
+      self.recurring:add(score, jid)
     end
   end
+
+  return moved
 end
 
 -- Check for any jobs that have been scheduled, and shovel them onto
--- the work queue. Returns nothing, but afterwards, up to `count`
--- scheduled jobs will be moved into the work queue
+-- the work queue. Returns the number of jobs moved, which is no more
+-- than `count`
 function ReqlessQueue:check_scheduled(now, count)
   if count <= 0 then
-    return
+    return 0
   end
   -- zadd is a list of arguments that we'll be able to use to
   -- insert into the work queue
-  local scheduled = self.scheduled.ready(now, 0, count)
+  local scheduled = self.scheduled:ready(now, 0, count)
   for _, jid in ipairs(scheduled) do
     -- With these in hand, we'll have to go out and find the
     -- priorities of these jobs, and then we'll insert them
@@ -937,13 +1569,15 @@ function ReqlessQueue:check_scheduled(now, count)
     -- remove them from the scheduled queue
     local priority = tonumber(
       redis.call('hget', ReqlessJob.ns .. jid, 'priority') or 0)
-    self.work.add(now, priority, jid)
-    self.scheduled.remove(jid)
+    self.work:add(now, priority, jid)
+    self.scheduled:remove(jid)
 
     -- We should also update them to have the state 'waiting'
     -- instead of 'scheduled'
     redis.call('hset', ReqlessJob.ns .. jid, 'state', 'waiting')
   end
+
+  return #scheduled
 end
 
 -- Check for and invalidate any locks that have been lost. Returns the
@@ -952,129 +1586,338 @@ function ReqlessQueue:invalidate_locks(now, count)
   local jids = {}
   -- Iterate through all the expired locks and add them to the list
   -- of keys that we'll return
-  for _, jid in ipairs(self.locks.expired(now, 0, count)) do
-    -- Remove this job from the jobs that the worker that was running it
-    -- has
-    local worker, failure = unpack(
-      redis.call('hmget', ReqlessJob.ns .. jid, 'worker', 'failure'))
-    redis.call('zrem', 'ql:w:' .. worker .. ':jobs', jid)
-
-    -- We'll provide a grace period after jobs time out for them to give
-    -- some indication of the failure mode. After that time, however, we'll
-    -- consider the worker dust in the wind
-    local grace_period = tonumber(Reqless.config.get('grace-period'))
-
-    -- Whether or not we've already sent a coutesy message
-    local courtesy_sent = tonumber(
-      redis.call('hget', ReqlessJob.ns .. jid, 'grace') or 0)
-
-    -- If the remaining value is an odd multiple of 0.5, then we'll assume
-    -- that we're just sending the message. Otherwise, it's time to
-    -- actually hand out the work to another worker
-    local send_message = (courtesy_sent ~= 1)
-    local invalidate   = not send_message
-
-    -- If the grace period has been disabled, then we'll do both.
-    if grace_period <= 0 then
-      send_message = true
-      invalidate   = true
+  for _, jid in ipairs(self.locks:expired(now, 0, count)) do
+    if self:invalidate_lock(now, jid) then
+      table.insert(jids, jid)
     end
+  end
 
-    if send_message then
-      -- This is where we supply a courtesy message and give the worker
-      -- time to provide a failure message
-      if redis.call('zscore', 'ql:tracked', jid) ~= false then
-        Reqless.publish('stalled', jid)
-      end
-      Reqless.job(jid):history(now, 'timed-out')
-      redis.call('hset', ReqlessJob.ns .. jid, 'grace', 1)
+  return jids
+end
 
-      -- Send a message to let the worker know that its lost its lock on
-      -- the job
-      local encoded = cjson.encode({
-        jid    = jid,
-        event  = 'lock_lost',
-        worker = worker,
-      })
-      Reqless.publish('w:' .. worker, encoded)
-      Reqless.publish('log', encoded)
-      self.locks.add(now + grace_period, jid)
+-- Invalidate the expired lock of the job with the provided jid. The first
+-- time a lock expires, the worker is sent a courtesy message and given a
+-- grace period. After that, the job either fails for having exhausted its
+-- retries, or true is returned to indicate that it should be handed out to
+-- another worker.
+function ReqlessQueue:invalidate_lock(now, jid)
+  -- Remove this job from the jobs that the worker that was running it
+  -- has
+  local worker, failure = unpack(
+    redis.call('hmget', ReqlessJob.ns .. jid, 'worker', 'failure'))
+  redis.call('zrem', Reqless.ns .. 'w:' .. worker .. ':jobs', jid)
+
+  -- We'll provide a grace period after jobs time out for them to give
+  -- some indication of the failure mode. After that time, however, we'll
+  -- consider the worker dust in the wind
+  local grace_period = tonumber(Reqless.config.get('grace-period'))
+
+  -- Whether or not we've already sent a coutesy message
+  local courtesy_sent = tonumber(
+    redis.call('hget', ReqlessJob.ns .. jid, 'grace') or 0)
+
+  -- If the remaining value is an odd multiple of 0.5, then we'll assume
+  -- that we're just sending the message. Otherwise, it's time to
+  -- actually hand out the work to another worker
+  local send_message = (courtesy_sent ~= 1)
+  local invalidate   = not send_message
+
+  -- If the grace period has been disabled, then we'll do both.
+  if grace_period <= 0 then
+    send_message = true
+    invalidate   = true
+  end
+
+  if send_message then
+    -- This is where we supply a courtesy message and give the worker
+    -- time to provide a failure message
+    if Reqless.tracked(jid) then
+      Reqless.publish('stalled', jid)
+    end
+    Reqless.job(jid):history(now, 'timed-out', nil, self.name)
+    redis.call('hset', ReqlessJob.ns .. jid, 'grace', 1)
+
+    -- Send a message to let the worker know that its lost its lock on
+    -- the job
+    local encoded = cjson.encode({
+      jid    = jid,
+      event  = 'lock_lost',
+      worker = worker,
+    })
+    Reqless.publish('w:' .. worker, encoded)
+    Reqless.publish('log', encoded)
+    self.locks:add(now + grace_period, jid)
+
+    -- If we got any expired locks, then we should increment the
+    -- number of retries for this stage for this bin. The bin is
+    -- midnight of the provided day
+    local bin = now - (now % 86400)
+    redis.call('hincrby',
+      Reqless.ns .. 's:stats:' .. bin .. ':' .. self.name, 'retries', 1)
+  end
+
+  if invalidate then
+    -- Unset the grace period attribute so that next time we'll send
+    -- the grace period
+    redis.call('hdel', ReqlessJob.ns .. jid, 'grace', 0)
 
-      -- If we got any expired locks, then we should increment the
-      -- number of retries for this stage for this bin. The bin is
-      -- midnight of the provided day
+    -- See how many remaining retries the job has
+    local remaining = tonumber(redis.call(
+      'hincrby', ReqlessJob.ns .. jid, 'remaining', -1))
+
+    -- This is where we actually have to time out the work
+    if remaining < 0 then
+      -- Now remove the instance from the schedule, and work queues
+      -- for the queue it's in
+      self.work:remove(jid)
+      self.locks:remove(jid)
+      self.scheduled:remove(jid)
+
+      local job = Reqless.job(jid)
+      local queue = redis.call('hget', ReqlessJob.ns .. jid, 'queue')
+      local group = 'failed-retries-' .. queue
+
+      job:throttles_release(now)
+
+      job:history(now, 'failed', {group = group}, self.name)
+      redis.call('hmset', ReqlessJob.ns .. jid, 'state', 'failed',
+        'worker', '',
+        'expires', '')
+      -- If the failure has not already been set, then set it
+      redis.call('hset', ReqlessJob.ns .. jid,
+      'failure', cjson.encode({
+        group   = group,
+        message = 'Job exhausted retries in queue "' .. self.name .. '"',
+        when    = now,
+        worker  = unpack(job:data('worker'))
+      }))
+
+      -- Add this particular instance to the failed group
+      Reqless.failure_groups.add(now, group, jid)
+
+      if Reqless.tracked(jid) then
+        Reqless.publish('failed', jid)
+      end
+      Reqless.publish('log', cjson.encode({
+        jid     = jid,
+        event   = 'failed',
+        group   = group,
+        worker  = worker,
+        message =
+          'Job exhausted retries in queue "' .. self.name .. '"'
+      }))
+
+      -- Increment the count of the failed jobs
       local bin = now - (now % 86400)
       redis.call('hincrby',
-        'ql:s:stats:' .. bin .. ':' .. self.name, 'retries', 1)
+        Reqless.ns .. 's:stats:' .. bin .. ':' .. self.name, 'failures', 1)
+      redis.call('hincrby',
+        Reqless.ns .. 's:stats:' .. bin .. ':' .. self.name, 'failed'  , 1)
+    else
+      return true
     end
+  end
 
-    if invalidate then
-      -- Unset the grace period attribute so that next time we'll send
-      -- the grace period
-      redis.call('hdel', ReqlessJob.ns .. jid, 'grace', 0)
-
-      -- See how many remaining retries the job has
-      local remaining = tonumber(redis.call(
-        'hincrby', ReqlessJob.ns .. jid, 'remaining', -1))
-
-      -- This is where we actually have to time out the work
-      if remaining < 0 then
-        -- Now remove the instance from the schedule, and work queues
-        -- for the queue it's in
-        self.work.remove(jid)
-        self.locks.remove(jid)
-        self.scheduled.remove(jid)
-
-        local job = Reqless.job(jid)
-        local job_data = Reqless.job(jid):data()
-        local queue = job_data['queue']
-        local group = 'failed-retries-' .. queue
-
-        job:throttles_release(now)
-
-        job:history(now, 'failed', {group = group})
-        redis.call('hmset', ReqlessJob.ns .. jid, 'state', 'failed',
-          'worker', '',
-          'expires', '')
-        -- If the failure has not already been set, then set it
-        redis.call('hset', ReqlessJob.ns .. jid,
-        'failure', cjson.encode({
-          group   = group,
-          message = 'Job exhausted retries in queue "' .. self.name .. '"',
-          when    = now,
-          worker  = unpack(job:data('worker'))
-        }))
+  return false
+end
 
-        -- Add this type of failure to the list of failures
-        redis.call('sadd', 'ql:failures', group)
-        -- And add this particular instance to the failed types
-        redis.call('lpush', 'ql:f:' .. group, jid)
+-- Move a job whose lock has been invalidated to the front of the work queue so
+-- that any worker may pick it up, releasing the throttles it held
+function ReqlessQueue:requeue_stalled(now, jid)
+  self.locks:remove(jid)
+  Reqless.job(jid):throttles_release(now)
+  self.work:add(now, math.huge, jid)
+  redis.call('hmset', ReqlessJob.ns .. jid,
+    'state', 'stalled', 'expires', 0, 'worker', '')
+end
 
-        if redis.call('zscore', 'ql:tracked', jid) ~= false then
-          Reqless.publish('failed', jid)
-        end
-        Reqless.publish('log', cjson.encode({
-          jid     = jid,
-          event   = 'failed',
-          group   = group,
-          worker  = worker,
-          message =
-            'Job exhausted retries in queue "' .. self.name .. '"'
-        }))
+-- Reap(now, [budget])
+-- -------------------
+-- Invalidate up to `budget` expired locks across all queues, oldest first,
+-- using the index of lock expirations kept in `ql:locks`. Jobs that should be
+-- handed out to another worker are moved to the front of their queue's work.
+-- The response includes how many jobs were moved back to their queues, and how
+-- many expired locks remain, so that the caller knows whether to reap again:
+--
+--  {
+--      'reaped': 100,
+--      'remaining': 20
+--  }
+--
+-- Until the locks of queues from before the index was kept have all been
+-- indexed, as `index_locks` does, `remaining` is at least 1.
+function ReqlessQueue.reap(now, budget)
+  budget = assert(tonumber(budget or 100),
+    'Reap(): Arg "budget" not a number: ' .. tostring(budget))
 
-        -- Increment the count of the failed jobs
-        local bin = now - (now % 86400)
-        redis.call('hincrby',
-          'ql:s:stats:' .. bin .. ':' .. self.name, 'failures', 1)
-        redis.call('hincrby',
-          'ql:s:stats:' .. bin .. ':' .. self.name, 'failed'  , 1)
-      else
-        table.insert(jids, jid)
+  local indexed = ReqlessQueue.index_locks(budget)
+
+  local index = ReqlessQueueLocks.index()
+  local jids = redis.call('zrangebyscore', index, '-inf', now, 'LIMIT', 0, budget)
+  local reaped = 0
+  for _, jid in ipairs(jids) do
+    local queue_name = redis.call('hget', ReqlessJob.ns .. jid, 'queue')
+    local queue = queue_name and queue_name ~= '' and Reqless.queue(queue_name)
+    local expires = queue and queue.locks:score(jid)
+    if not expires then
+      -- The job no longer exists, or no longer holds a lock in its queue, so
+      -- just forget about its lock
+      redis.call('zrem', index, jid)
+    elseif tonumber(expires) > now then
+      -- The lock was renewed since it was indexed
+      redis.call('zadd', index, expires, jid)
+    elseif queue:invalidate_lock(now, jid) then
+      queue:requeue_stalled(now, jid)
+      reaped = reaped + 1
+    end
+  end
+
+  local remaining = redis.call('zcount', index, '-inf', now)
+  if not indexed then
+    remaining = math.max(remaining, 1)
+  end
+  return {reaped = reaped, remaining = remaining}
+end
+
+-- Add the locks of each queue to the index of locks, for the jobs that were
+-- popped before the index was kept. Queues are visited with a cursor kept in
+-- `ql:locks:indexing` until at least `budget` locks have been added, and once
+-- they all have been, `ql:locks:indexed` is set and this does nothing more.
+-- Returns whether all the queues have been indexed.
+function ReqlessQueue.index_locks(budget)
+  if redis.call('exists', Reqless.ns .. 'locks:indexed') == 1 then
+    return true
+  end
+
+  local cursor_key = Reqless.ns .. 'locks:indexing'
+  local cursor = redis.call('get', cursor_key) or '0'
+  local indexed = 0
+  repeat
+    local reply = redis.call(
+      'zscan', Reqless.ns .. 'queues', cursor, 'COUNT', 100)
+    cursor = reply[1]
+    -- The reply alternates between queue names and their scores
+    for i = 1, #reply[2], 2 do
+      local locks = redis.call('zrange',
+        Reqless.queue(reply[2][i]).locks.key, 0, -1, 'WITHSCORES')
+      -- Scores come after members in the reply, but before them in ZADD
+      local members = {}
+      for j = 1, #locks, 2 do
+        table.insert(members, locks[j + 1])
+        table.insert(members, locks[j])
+      end
+      for j = 1, #members, 1000 do
+        redis.call('zadd', ReqlessQueueLocks.index(),
+          unpack(members, j, math.min(j + 999, #members)))
       end
+      indexed = indexed + #locks / 2
+    end
+  until cursor == '0' or indexed >= budget
+
+  if cursor == '0' then
+    redis.call('del', cursor_key)
+    redis.call('set', Reqless.ns .. 'locks:indexed', 1)
+    return true
+  end
+  redis.call('set', cursor_key, cursor)
+  return false
+end
+
+-- Whether popping, peeking and counting a queue should promote its due
+-- scheduled and recurring jobs, rather than leaving it to `scheduler.tick`
+function ReqlessQueue.inline_promotion()
+  return not Reqless.read_only and
+    tonumber(Reqless.config.get('inline-promotion', 1)) ~= 0
+end
+
+-- Tick(now, [budget])
+-- -------------------
+-- Move up to `budget` due scheduled jobs onto their queue's work, and spawn
+-- due recurring jobs, across all queues. Queues are visited in the order in
+-- which they became due, using the index of due times in `ql:due`. The
+-- response includes how many queues still have jobs due, so that the caller
+-- knows whether to tick again:
+--
+--  {
+--      'promoted': 1000,
+--      'remaining': 3
+--  }
+--
+-- Until the queues from before the index was kept have all been indexed, as
+-- `index_due` does, `remaining` is at least 1.
+function ReqlessQueue.tick(now, budget)
+  budget = assert(tonumber(budget or 1000),
+    'Tick(): Arg "budget" not a number: ' .. tostring(budget))
+
+  local indexed = ReqlessQueue.index_due(budget)
+
+  local promoted = 0
+  local names = redis.call('zrangebyscore',
+    ReqlessQueueDue.key(), '-inf', now, 'LIMIT', 0, budget)
+  for _, name in ipairs(names) do
+    if promoted >= budget then
+      break
+    end
+
+    local queue = Reqless.queue(name)
+    promoted = promoted + queue:check_recurring(now, budget - promoted)
+    promoted = promoted + queue:check_scheduled(now, budget - promoted)
+
+    -- Now that its due jobs are promoted, find when this queue is next due
+    local scheduled = tonumber(queue.scheduled:next())
+    local recurring = tonumber(queue.recurring:next())
+    if scheduled or recurring then
+      redis.call('zadd', ReqlessQueueDue.key(),
+        math.min(scheduled or math.huge, recurring or math.huge), name)
+    else
+      redis.call('zrem', ReqlessQueueDue.key(), name)
     end
   end
 
-  return jids
+  local remaining = redis.call('zcount', ReqlessQueueDue.key(), '-inf', now)
+  if not indexed then
+    remaining = math.max(remaining, 1)
+  end
+  return {promoted = promoted, remaining = remaining}
+end
+
+-- Add each queue's next due time to the index of due times, for the jobs that
+-- were scheduled, or recurring, before the index was kept. Queues are visited
+-- with a cursor kept in `ql:due:indexing`, at least `budget` at a time, and
+-- once they all have been, `ql:due:indexed` is set and this does nothing more.
+-- Returns whether all the queues have been indexed.
+function ReqlessQueue.index_due(budget)
+  if redis.call('exists', Reqless.ns .. 'due:indexed') == 1 then
+    return true
+  end
+
+  local cursor_key = Reqless.ns .. 'due:indexing'
+  local cursor = redis.call('get', cursor_key) or '0'
+  local visited = 0
+  repeat
+    local reply = redis.call(
+      'zscan', Reqless.ns .. 'queues', cursor, 'COUNT', 100)
+    cursor = reply[1]
+    -- The reply alternates between queue names and their scores
+    for i = 1, #reply[2], 2 do
+      local queue = Reqless.queue(reply[2][i])
+      local scheduled = tonumber(queue.scheduled:next())
+      local recurring = tonumber(queue.recurring:next())
+      if scheduled or recurring then
+        ReqlessQueueDue.add(queue.name,
+          math.min(scheduled or math.huge, recurring or math.huge))
+      end
+      visited = visited + 1
+    end
+  until cursor == '0' or visited >= budget
+
+  if cursor == '0' then
+    redis.call('del', cursor_key)
+    redis.call('set', Reqless.ns .. 'due:indexed', 1)
+    return true
+  end
+  redis.call('set', cursor_key, cursor)
+  return false
 end
 
 -- Forget the provided queues. As in, remove them from the list of known queues
@@ -1099,23 +1942,25 @@ end
 function ReqlessQueue.counts(now, name)
   if name then
     local queue = Reqless.queue(name)
-    local stalled = queue.locks.length(now)
+    local stalled = queue.locks:length(now)
     -- Check for any scheduled jobs that need to be moved
-    queue:check_scheduled(now, queue.scheduled.length())
+    if ReqlessQueue.inline_promotion() then
+      queue:check_scheduled(now, queue.scheduled:length())
+    end
     return {
       name      = name,
-      waiting   = queue.work.length(),
+      waiting   = queue.work:length(),
       stalled   = stalled,
-      running   = queue.locks.length() - stalled,
-      throttled = queue.throttled.length(),
-      scheduled = queue.scheduled.length(),
-      depends   = queue.depends.length(),
-      recurring = queue.recurring.length(),
+      running   = queue.locks:length() - stalled,
+      throttled = queue.throttled:length(),
+      scheduled = queue.scheduled:length(),
+      depends   = queue.depends:length(),
+      recurring = queue.recurring:length(),
       paused    = queue:paused()
     }
   end
 
-  local queues = redis.call('zrange', 'ql:queues', 0, -1)
+  local queues = redis.call('zrange', Reqless.ns .. 'queues', 0, -1)
   local response = {}
   for _, qname in ipairs(queues) do
     table.insert(response, ReqlessQueue.counts(now, qname))
@@ -1123,7 +1968,77 @@ function ReqlessQueue.counts(now, name)
   return response
 end
 
+-- Return information about all queues, as `counts` does, but read only from
+-- the counts each queue keeps of its jobs. This doesn't tell stalled jobs from
+-- running ones, so `running` includes the stalled jobs and `stalled` is left
+-- out, and it doesn't move any scheduled jobs that are due into the work
+-- queue first.
+function ReqlessQueue.cached_counts(now)
+  local paused = {}
+  for _, name in ipairs(redis.call('smembers', Reqless.ns .. 'paused_queues')) do
+    paused[name] = true
+  end
+
+  local response = {}
+  for _, name in ipairs(redis.call('zrange', Reqless.ns .. 'queues', 0, -1)) do
+    local counts = {
+      name      = name,
+      waiting   = 0,
+      running   = 0,
+      throttled = 0,
+      scheduled = 0,
+      depends   = 0,
+      recurring = 0,
+      paused    = paused[name] or false
+    }
+    local queue = Reqless.queue(name)
+    local reply = redis.call('hgetall', queue.counts_key)
+    if #reply == 0 then
+      -- This queue's counts were never kept, so count its sorted sets, and
+      -- keep the counts from now on
+      reply = queue:count_sets()
+      if not Reqless.read_only then
+        redis.call('hmset', queue.counts_key, unpack(reply))
+      end
+    end
+    for i = 1, #reply, 2 do
+      counts[reply[i]] = tonumber(reply[i + 1])
+    end
+    table.insert(response, counts)
+  end
+  return response
+end
+
+-- The number of jobs in each of this queue's sorted sets, as pairs of field
+-- and count as they're kept in its counts
+function ReqlessQueue:count_sets()
+  return {
+    'waiting'  , self.work:length(),
+    'running'  , self.locks:length(),
+    'throttled', self.throttled:length(),
+    'scheduled', self.scheduled:length(),
+    'depends'  , self.depends:length(),
+    'recurring', self.recurring:length()
+  }
+end
+
+-- Rebuild the counts each of the provided queues keeps of its jobs, or of all
+-- queues if none are provided, from the sorted sets the jobs are kept in.
+-- Returns the number of queues whose counts were rebuilt.
+function ReqlessQueue.rebuild_counts(now, ...)
+  local names = arg
+  if #names == 0 then
+    names = redis.call('zrange', Reqless.ns .. 'queues', 0, -1)
+  end
+
+  for _, name in ipairs(names) do
+    local queue = Reqless.queue(name)
+    redis.call('hmset', queue.counts_key, unpack(queue:count_sets()))
+  end
+  return #names
+end
+
 -- Get the names of all the queues.
 function ReqlessQueue.names(now)
-  return redis.call('zrange', 'ql:queues', 0, -1)
+  return redis.call('zrange', Reqless.ns .. 'queues', 0, -1)
 end
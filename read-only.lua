@@ -0,0 +1,6 @@
+-------------------------------------------------------------------------------
+-- Read-only build
+-------------------------------------------------------------------------------
+-- Included only in `reqless-ro.lua`, which runs just the commands that only
+-- read, and never writes while running them
+Reqless.read_only = true
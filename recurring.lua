@@ -1,7 +1,7 @@
 -- Get all the attributes of this particular job
 function ReqlessRecurringJob:data()
   local job = redis.call(
-    'hmget', 'ql:r:' .. self.jid, 'jid', 'klass', 'state', 'queue',
+    'hmget', Reqless.ns .. 'r:' .. self.jid, 'jid', 'klass', 'state', 'queue',
     'priority', 'interval', 'retries', 'count', 'data', 'tags', 'backlog', 'throttles')
 
   if not job[1] then
@@ -35,7 +35,7 @@ end
 function ReqlessRecurringJob:update(now, ...)
   local options = {}
   -- Make sure that the job exists
-  if redis.call('exists', 'ql:r:' .. self.jid) == 0 then
+  if redis.call('exists', Reqless.ns .. 'r:' .. self.jid) == 0 then
     error('Recur(): No recurring job ' .. self.jid)
   end
 
@@ -48,24 +48,24 @@ function ReqlessRecurringJob:update(now, ...)
       -- If the command is 'interval', then we need to update the
       -- time when it should next be scheduled
       if key == 'interval' then
-        local queue, interval = unpack(redis.call('hmget', 'ql:r:' .. self.jid, 'queue', 'interval'))
-        Reqless.queue(queue).recurring.update(
+        local queue, interval = unpack(redis.call('hmget', Reqless.ns .. 'r:' .. self.jid, 'queue', 'interval'))
+        Reqless.queue(queue).recurring:update(
           value - tonumber(interval), self.jid)
       end
-      redis.call('hset', 'ql:r:' .. self.jid, key, value)
+      redis.call('hset', Reqless.ns .. 'r:' .. self.jid, key, value)
     elseif key == 'data' then
       assert(cjson.decode(value), 'Recur(): Arg "data" is not JSON-encoded: ' .. tostring(value))
-      redis.call('hset', 'ql:r:' .. self.jid, 'data', value)
+      redis.call('hset', Reqless.ns .. 'r:' .. self.jid, 'data', value)
     elseif key == 'klass' then
-      redis.call('hset', 'ql:r:' .. self.jid, 'klass', value)
+      redis.call('hset', Reqless.ns .. 'r:' .. self.jid, 'klass', value)
     elseif key == 'queue' then
-      local old_queue_name = redis.call('hget', 'ql:r:' .. self.jid, 'queue')
+      local old_queue_name = redis.call('hget', Reqless.ns .. 'r:' .. self.jid, 'queue')
       local queue_obj = Reqless.queue(old_queue_name)
-      local score = queue_obj.recurring.score(self.jid)
+      local score = queue_obj.recurring:score(self.jid)
 
       -- Detach from the old queue
-      queue_obj.recurring.remove(self.jid)
-      local throttles = cjson.decode(redis.call('hget', 'ql:r:' .. self.jid, 'throttles') or '{}')
+      queue_obj.recurring:remove(self.jid)
+      local throttles = cjson.decode(redis.call('hget', Reqless.ns .. 'r:' .. self.jid, 'throttles') or '{}')
       for index, throttle_name in ipairs(throttles) do
         if throttle_name == ReqlessQueue.ns .. old_queue_name then
           table.remove(throttles, index)
@@ -75,21 +75,21 @@ function ReqlessRecurringJob:update(now, ...)
 
       -- Attach to the new queue
       table.insert(throttles, ReqlessQueue.ns .. value)
-      redis.call('hset', 'ql:r:' .. self.jid, 'throttles', cjson.encode(throttles))
+      redis.call('hset', Reqless.ns .. 'r:' .. self.jid, 'throttles', cjson.encode(throttles))
 
-      Reqless.queue(value).recurring.add(score, self.jid)
-      redis.call('hset', 'ql:r:' .. self.jid, 'queue', value)
+      Reqless.queue(value).recurring:add(score, self.jid)
+      redis.call('hset', Reqless.ns .. 'r:' .. self.jid, 'queue', value)
       -- If we don't already know about the queue, learn about it
-      if redis.call('zscore', 'ql:queues', value) == false then
-        redis.call('zadd', 'ql:queues', now, value)
+      if redis.call('zscore', Reqless.ns .. 'queues', value) == false then
+        redis.call('zadd', Reqless.ns .. 'queues', now, value)
       end
     elseif key == 'backlog' then
       value = assert(tonumber(value),
         'Recur(): Arg "backlog" not a number: ' .. tostring(value))
-      redis.call('hset', 'ql:r:' .. self.jid, 'backlog', value)
+      redis.call('hset', Reqless.ns .. 'r:' .. self.jid, 'backlog', value)
     elseif key == 'throttles' then
       local throttles = assert(cjson.decode(value), 'Recur(): Arg "throttles" is not JSON-encoded: ' .. tostring(value))
-      redis.call('hset', 'ql:r:' .. self.jid, 'throttles', cjson.encode(throttles))
+      redis.call('hset', Reqless.ns .. 'r:' .. self.jid, 'throttles', cjson.encode(throttles))
     else
       error('Recur(): Unrecognized option "' .. key .. '"')
     end
@@ -100,7 +100,7 @@ end
 
 -- Tags this recurring job with the provided tags
 function ReqlessRecurringJob:tag(...)
-  local tags = redis.call('hget', 'ql:r:' .. self.jid, 'tags')
+  local tags = redis.call('hget', Reqless.ns .. 'r:' .. self.jid, 'tags')
   -- If the job has been canceled / deleted, then throw an error.
   if not tags then
     error('Tag(): Job ' .. self.jid .. ' does not exist')
@@ -121,7 +121,7 @@ function ReqlessRecurringJob:tag(...)
   end
 
   tags = cjsonArrayDegenerationWorkaround(tags)
-  redis.call('hset', 'ql:r:' .. self.jid, 'tags', tags)
+  redis.call('hset', Reqless.ns .. 'r:' .. self.jid, 'tags', tags)
 
   return tags
 end
@@ -129,7 +129,7 @@ end
 -- Removes a tag from the recurring job
 function ReqlessRecurringJob:untag(...)
   -- Get the existing tags
-  local tags = redis.call('hget', 'ql:r:' .. self.jid, 'tags')
+  local tags = redis.call('hget', Reqless.ns .. 'r:' .. self.jid, 'tags')
 
   -- If the job has been canceled / deleted, then return false
   if not tags then
@@ -160,7 +160,7 @@ function ReqlessRecurringJob:untag(...)
 
   -- json encode them, set, and return
   tags = cjson.encode(results)
-  redis.call('hset', 'ql:r:' .. self.jid, 'tags', tags)
+  redis.call('hset', Reqless.ns .. 'r:' .. self.jid, 'tags', tags)
 
   return tags
 end
@@ -168,12 +168,12 @@ end
 -- Stop further occurrences of this job
 function ReqlessRecurringJob:cancel()
   -- First, find out what queue it was attached to
-  local queue = redis.call('hget', 'ql:r:' .. self.jid, 'queue')
+  local queue = redis.call('hget', Reqless.ns .. 'r:' .. self.jid, 'queue')
   if queue then
     -- Now, delete it from the queue it was attached to, and delete the
     -- thing itself
-    Reqless.queue(queue).recurring.remove(self.jid)
-    redis.call('del', 'ql:r:' .. self.jid)
+    Reqless.queue(queue).recurring:remove(self.jid)
+    redis.call('del', Reqless.ns .. 'r:' .. self.jid)
   end
 
   return true
@@ -7,6 +7,10 @@ import unittest
 
 from test import reqless
 
+# Stats of commands that are not run from within the script itself
+SCRIPT_COMMAND_STATS = (
+    'cmdstat_config', 'cmdstat_eval', 'cmdstat_evalsha', 'cmdstat_info')
+
 
 class TestReqless(unittest.TestCase):
     '''Base class for all of our tests'''
@@ -19,6 +23,29 @@ class TestReqless(unittest.TestCase):
     def tearDown(self):
         self.lua.flush()
 
+    def command_calls(self, function, *args):
+        '''Invoke the function and return its result along with the number of
+        redis commands that were run by it, not counting the script calls
+        themselves.'''
+        self.redis.config_resetstat()
+        result = function(*args)
+        stats = self.redis.info('commandstats')
+        calls = sum(
+            stat['calls'] for name, stat in stats.items()
+            if name not in SCRIPT_COMMAND_STATS)
+        return result, calls
+
+    def script_usec(self, function, *args):
+        '''Invoke the function and return its result along with the number of
+        microseconds redis spent running scripts.'''
+        self.redis.config_resetstat()
+        result = function(*args)
+        stats = self.redis.info('commandstats')
+        usec = sum(
+            stats.get(name, {}).get('usec', 0)
+            for name in ('cmdstat_eval', 'cmdstat_evalsha'))
+        return result, usec
+
     def assertMalformed(self, function, examples):
         '''Ensure that all the example inputs to the function are malformed.'''
         for args in examples:
@@ -30,11 +30,14 @@ class ReqlessRecorder(object):
     '''A context-manager to capture anything that goes back and forth'''
     __name__ = 'ReqlessRecorder'
 
-    def __init__(self, client):
+    def __init__(self, client, path='reqless.lua', namespace=None):
         self._client = client
+        # The namespace, if any, is passed as the only key
+        self._keys = [namespace] if namespace else []
+        self.namespace = namespace or 'ql:'
         self._pubsub = self._client.pubsub()
         script_already_registered = os.environ.get('SCRIPT_ALREADY_REGISTERED')
-        with open('reqless.lua') as fin:
+        with open(path) as fin:
             if script_already_registered != None:
                 encoder = client.connection_pool.get_encoder()
                 script = encoder.encode(fin.read())
@@ -50,14 +53,15 @@ class ReqlessRecorder(object):
         return self._lua(*args, **kwargs)
 
     def __call__(self, *args):
-        '''Invoke the lua script with no keys, and some simple transforms'''
+        '''Invoke the lua script with our namespace as its only key, if any,
+        and some simple transforms'''
         transformed = []
         for arg in args:
             if isinstance(arg, dict) or isinstance(arg, list):
                 transformed.append(json.dumps(arg))
             else:
                 transformed.append(arg)
-        result = self._lua([], transformed)
+        result = self._lua(self._keys, transformed)
         try:
             return json.loads(result)
         except json.JSONDecodeError:
@@ -87,3 +91,41 @@ class ReqlessRecorder(object):
                 self.log.append(message)
             elif typ == 'punsubscribe':
                 break
+
+
+class ReqlessWaiter(object):
+    '''A reference implementation of a worker that blocks on the wake lists of
+    its queues rather than polling them'''
+
+    def __init__(self, client, lua, queues, worker, limit=1):
+        self._client = client
+        self._lua = lua
+        self.queues = queues
+        self.worker = worker
+        self.limit = limit
+
+    def wake_keys(self):
+        '''The wake lists of all of our queues'''
+        return [
+            '%sq:%s-wake' % (self._lua.namespace, queue) for queue in self.queues]
+
+    def pop(self, now):
+        '''Pop up to our limit of jobs from our queues, in order'''
+        jobs = []
+        for queue in self.queues:
+            jobs.extend(self._lua(
+                'queue.pop', now(), queue, self.worker, self.limit - len(jobs)))
+            if len(jobs) >= self.limit:
+                break
+        return jobs
+
+    def wait(self, now, timeout):
+        '''Pop jobs, blocking for up to `timeout` seconds at a time until a
+        wake-up token arrives whenever there are none. Gives up and returns an
+        empty list if no token arrives within the timeout.'''
+        while True:
+            jobs = self.pop(now)
+            if jobs:
+                return jobs
+            if self._client.blpop(self.wake_keys(), timeout) is None:
+                return self.pop(now)
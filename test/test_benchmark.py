@@ -0,0 +1,203 @@
+'''Benchmarks of the work done by the most frequently invoked commands'''
+
+import json
+import os
+import time
+import unittest
+
+import msgpack
+
+from test.common import TestReqless
+
+
+@unittest.skipUnless(os.environ.get('REQLESS_BENCHMARK'),
+    'Set REQLESS_BENCHMARK to run the benchmarks')
+class TestBenchmark(TestReqless):
+    '''Track the cost of hot commands so that regressions are visible'''
+
+    def test_pop_redis_calls(self):
+        '''Popping throttled jobs reads config, throttles and tracked flags once'''
+        count = 50
+        self.lua('throttle.set', 0, 'tid', count * 2)
+        self.lua('config.set', 0, 'queue-heartbeat', 30)
+        for jid in range(count):
+            self.lua('queue.put', 0, 'worker', 'queue', jid, 'klass', {}, 0,
+                'throttles', ['tid'])
+
+        jobs, calls = self.command_calls(
+            self.lua, 'queue.pop', 1, 'queue', 'worker', count)
+        self.assertEqual(len(jobs), count)
+        print('queue.pop: %.1f redis calls per job' % (calls / count))
+        self.assertLessEqual(calls / count, 16)
+
+    def test_pop_throttled_scales(self):
+        '''Popping many throttled jobs costs no more per job than popping a
+        few, and report the time spent in Lua popping them'''
+        def put(queue, count):
+            self.lua('throttle.set', 0, queue, count)
+            for jid in range(count):
+                self.lua('queue.put', 0, 'worker', queue, '%s-%d' % (queue, jid),
+                    'klass', {}, 0, 'throttles', [queue])
+
+        calls = {}
+        for count in (100, 1000):
+            queue = 'queue-%d' % count
+            put(queue, count)
+            jobs, calls[count] = self.command_calls(
+                self.lua, 'queue.pop', 1, queue, 'worker', count, 'lite')
+            self.assertEqual(len(jobs), count)
+        self.assertLessEqual(calls[1000] / 1000, calls[100] / 100)
+
+        put('timed', 1000)
+        jobs, usec = self.script_usec(
+            self.lua, 'queue.pop', 1, 'timed', 'worker', 1000, 'lite')
+        self.assertEqual(len(jobs), 1000)
+        print('queue.pop: 1000 throttled jobs in %.1fms of Lua time, '
+            '%.1f redis calls per job' % (usec / 1000.0, calls[1000] / 1000))
+
+    def test_history_modes(self):
+        '''Compare the redis calls and memory of each history mode'''
+        count = 500
+        self.lua('config.set', 0, 'max-job-history', 100)
+
+        def log(jid):
+            for index in range(count):
+                self.lua('job.log', index, jid, 'message', {'index': index})
+
+        calls, memory = {}, {}
+        for mode in ('full', 'capped', 'ring', 'first-last', 'sampled', 'off'):
+            jid = 'jid-' + mode
+            self.lua('config.set', 0, 'history-mode', mode)
+            self.lua('queue.put', 0, 'worker', 'queue', jid, 'klass', {}, 0)
+            _, calls[mode] = self.command_calls(log, jid)
+            memory[mode] = self.redis.memory_usage('ql:j:%s-history' % jid) or 0
+            print('%s history: %.1f redis calls per append, %d bytes' % (
+                mode, calls[mode] / count, memory[mode]))
+
+        self.assertLess(memory['off'], memory['first-last'])
+        self.assertLess(memory['first-last'], memory['ring'])
+        self.assertLess(memory['ring'], memory['full'])
+        self.assertLess(calls['off'], calls['first-last'])
+        self.assertLess(calls['full'], calls['ring'])
+        self.assertLessEqual(calls['capped'], calls['ring'] + 2)
+        self.assertLess(calls['sampled'], calls['capped'])
+
+    def test_put_multi_redis_calls(self):
+        '''Putting jobs in bulk shares the work of registering the queue'''
+        count = 100
+        _, put_calls = self.command_calls(lambda: [
+            self.lua('queue.put', 0, 'worker', 'queue', 'put-%d' % jid,
+                'klass', {}, 0) for jid in range(count)])
+        _, multi_calls = self.command_calls(
+            self.lua, 'queue.putMulti', 0, 'worker', 'queue', [
+                {'jid': 'multi-%d' % jid, 'klass': 'klass', 'data': {}}
+                for jid in range(count)])
+        print('queue.put: %.1f redis calls per job, queue.putMulti: %.1f' % (
+            put_calls / count, multi_calls / count))
+        self.assertLess(multi_calls, put_calls)
+
+    def test_pop_encodings(self):
+        '''Popping jobs as MessagePack returns fewer bytes than as JSON, and
+        report the cost of encoding and decoding them'''
+        count = 100
+        data = {'key': 'value' * 20, 'list': list(range(20))}
+        size = {}
+        for encoding, decode in (('json', json.loads),
+                ('msgpack', msgpack.unpackb)):
+            for jid in range(count):
+                self.lua('queue.put', 0, 'worker', encoding, jid, 'klass',
+                    data, 0, 'tags', ['tag'])
+            payload, usec = self.script_usec(self.lua.raw,
+                [], ['queue.pop:' + encoding, 1, encoding, 'worker', count])
+            start = time.time()
+            jobs = decode(payload)
+            decoded = (time.time() - start) * 1000
+            self.assertEqual(len(jobs), count)
+            size[encoding] = len(payload)
+            print('queue.pop as %s: %d bytes, %.1fms in Lua, %.1fms decoding' % (
+                encoding, size[encoding], usec / 1000.0, decoded))
+        self.assertLess(size['msgpack'], size['json'])
+
+    def test_job_layouts(self):
+        '''Compare the memory used by each job in each job layout'''
+        count = 200
+        data = {'url': 'https://example.com/' + 'path/' * 8, 'depth': 3}
+        memory = {}
+        for layout in ('hash', 'packed'):
+            self.lua('config.set', 0, 'job-layout', layout)
+            total = 0
+            for index in range(count):
+                jid = '%s-%032d' % (layout, index)
+                self.lua('queue.put', 0, 'worker', 'queue', jid, 'crawl.Job',
+                    data, 0, 'tags', ['crawl'], 'throttles', ['domain'])
+                total += self.redis.memory_usage('ql:j:' + jid, samples=0)
+            memory[layout] = total / count
+            print('%s job layout: %d bytes per job' % (layout, memory[layout]))
+        self.assertLess(memory['packed'], memory['hash'])
+
+    def test_peek_offloaded_data(self):
+        '''Listing jobs with large data kept out of their hashes returns fewer
+        bytes than peeking them with their data, and report the Lua time of
+        each'''
+        count = 100
+        data = {'payload': 'x' * 100000}
+        self.lua('config.set', 0, 'max-inline-data', 1000)
+        for jid in range(count):
+            self.lua('queue.put', 0, 'worker', 'queue', jid, 'klass', data, 0)
+        size = {}
+        for fields in ('lite', 'listing'):
+            payload, usec = self.script_usec(self.lua.raw,
+                [], ['queue.peek', 1, 'queue', 0, count, fields])
+            self.assertEqual(len(json.loads(payload)), count)
+            size[fields] = len(payload)
+            print('queue.peek with the %s fields: %d bytes, %.1fms of Lua '
+                'time' % (fields, size[fields], usec / 1000.0))
+        self.assertLess(size['listing'] * 100, size['lite'])
+
+    def test_pop_batched(self):
+        '''Popping many jobs at a time costs fewer redis calls per job than
+        popping one at a time, and report how many jobs per second of Lua time
+        are popped each way'''
+        count, batch = 200, 100
+        calls = {}
+        for size in (1, batch):
+            for measure in (self.command_calls, self.script_usec):
+                queue = 'queue-%s-%d' % (measure.__name__, size)
+                for jid in range(count):
+                    self.lua('queue.put', 0, 'worker', queue,
+                        '%s-%d' % (queue, jid), 'klass', {}, 0)
+
+                def pop():
+                    for index in range(count // size):
+                        jobs = self.lua('queue.pop', index, queue, 'worker', size)
+                        self.assertEqual(len(jobs), size)
+
+                _, cost = measure(pop)
+                if measure == self.command_calls:
+                    calls[size] = cost
+                else:
+                    print('queue.pop: %d jobs per second of Lua time, %d at a '
+                        'time, %.1f redis calls per job' % (
+                            count * 1e6 / cost, size, calls[size] / count))
+        self.assertLess(calls[batch], calls[1])
+
+    def test_queues_counts_cached(self):
+        '''Counting the jobs of many queues from their cached counts takes
+        fewer redis calls than from their sorted sets'''
+        count = 200
+        for index in range(count):
+            queue = 'queue-%d' % index
+            self.lua('queue.put', 0, 'worker', queue, 'a', 'klass', {}, 0)
+            self.lua('queue.put', 0, 'worker', queue, 'b', 'klass', {}, 10)
+
+        _, calls = self.command_calls(self.lua, 'queues.counts', 1)
+        cached, cached_calls = self.command_calls(
+            self.lua, 'queues.counts', 1, 'cached')
+        _, usec = self.script_usec(self.lua, 'queues.counts', 1)
+        _, cached_usec = self.script_usec(
+            self.lua, 'queues.counts', 1, 'cached')
+        print('queues.counts: %.1f redis calls per queue in %.1fms, '
+            'cached: %.1f in %.1fms' % (calls / count, usec / 1000.0,
+                cached_calls / count, cached_usec / 1000.0))
+        self.assertEqual(len(cached), count)
+        self.assertLess(cached_calls, calls)
@@ -0,0 +1,118 @@
+'''Test keeping all the keys under a hash-tagged namespace'''
+
+import os
+
+import redis
+from redis.crc import key_slot
+
+from test.common import TestReqless
+from test.reqless import ReqlessRecorder, ReqlessWaiter
+
+NAMESPACE = 'ql:{shard}:'
+
+
+class TestCluster(TestReqless):
+    '''Every key touched is under the namespace, and so in its slot'''
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # A user that may only touch keys under the namespace, so that any
+        # other key the script touches raises an error
+        cls.redis.execute_command(
+            'ACL', 'SETUSER', 'reqless-shard', 'reset', 'on', 'nopass',
+            '~' + NAMESPACE + '*', 'allchannels', '+@all')
+        url = os.environ.get('REDIS_URL', 'redis://localhost:6379/')
+        cls.shard = redis.Redis.from_url(
+            url, username='reqless-shard', password='')
+        cls.lua = ReqlessRecorder(cls.shard, namespace=NAMESPACE)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.redis.execute_command('ACL', 'DELUSER', 'reqless-shard')
+
+    def tearDown(self):
+        self.redis.flushdb()
+
+    def assertInSlot(self):
+        '''All the keys are in the namespace's slot'''
+        keys = self.redis.keys('*')
+        self.assertNotEqual(keys, [])
+        for key in keys:
+            self.assertTrue(key.decode().startswith(NAMESPACE), key)
+            self.assertEqual(key_slot(key), key_slot(NAMESPACE.encode()), key)
+
+    def test_malformed(self):
+        '''The namespace must have a hash tag, and be the only key'''
+        unsharded = ReqlessRecorder(self.redis, namespace='ql:shard:')
+        self.assertRaisesRegexp(redis.ResponseError, r'hash tag',
+            unsharded, 'queues.counts', 0)
+        self.assertRaisesRegexp(redis.ResponseError, r'Only the namespace',
+            self.lua.raw, [NAMESPACE, NAMESPACE], ['queues.counts', 0])
+
+    def test_lifecycle(self):
+        '''Jobs can go through all of their states within the namespace'''
+        self.lua('config.set', 0, 'grace-period', 0)
+        self.lua('config.set', 0, 'stats-precision', 2)
+        self.lua('throttle.set', 0, 'tid', 1)
+        self.lua('queue.put', 0, 'worker', 'queue', 'a', 'klass', {}, 0,
+            'tags', ['tag'], 'throttles', ['tid'])
+        self.lua('queue.put', 0, 'worker', 'queue', 'b', 'klass', {}, 0,
+            'depends', ['a'], 'throttles', ['tid'])
+        self.lua('queue.put', 0, 'worker', 'queue', 'c', 'klass', {}, 10,
+            'retries', 0)
+        self.lua('queue.recurAtInterval', 0, 'queue', 'd', 'klass', {}, 60, 0)
+        self.lua('job.track', 0, 'a')
+        self.lua('queue.pop', 1, 'queue', 'worker', 10)
+        self.lua('job.heartbeat', 2, 'a', 'worker', {})
+        self.lua('job.complete', 3, 'a', 'worker', 'queue', {})
+        self.lua('job.fail', 4, 'd-1', 'worker', 'group', 'message')
+        self.lua('queue.unfail', 5, 'queue', 'group', 10)
+        self.lua('queue.pop', 20, 'queue', 'worker', 10)
+        self.lua('scheduler.tick', 100)
+        self.lua('queues.reap', 100)
+        self.lua('queue.pop', 200, 'queue', 'worker', 10)
+        self.lua('job.cancel', 300, 'b')
+        self.lua('queue.stats', 300, 'queue', 0)
+        self.lua('queue.percentiles', 300, 'queue', 0)
+        self.lua('queues.statsRange', 300, ['*'], 0, 0)
+        self.lua('queues.counts', 300)
+        self.lua('queues.counts', 300, 'cached')
+        self.lua('queues.rebuildCounts', 300)
+        self.lua('failureGroups.counts', 300)
+        self.lua('failureGroups.migrate', 300)
+        self.lua('jobs.failedByGroup', 300, 'failed-retries-queue')
+        self.lua('jobs.tagged', 300, 'tag')
+        self.lua('jobs.tracked', 300)
+        self.lua('jobs.completed', 300)
+        self.lua('workers.counts', 300)
+        self.lua('worker.jobs', 300, 'worker')
+        self.assertInSlot()
+
+    def test_patterns(self):
+        '''Queue patterns are kept within the namespace'''
+        self.lua('queueIdentifierPatterns.setAll', 0, 'id', ['queue'])
+        self.lua('queuePriorityPatterns.setAll', 0,
+            {'fairly': False, 'pattern': ['queue']})
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.assertEqual(
+            [job['jid'] for job in self.lua('queues.pop', 0, 'worker', 'id', 1)],
+            ['jid'])
+        self.assertEqual(
+            self.lua('queueIdentifierPatterns.getAll', 0)['id'], '["queue"]')
+        self.assertInSlot()
+
+    def test_isolated(self):
+        '''Namespaces don't see each other's jobs'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        default = ReqlessRecorder(self.redis)
+        self.assertEqual(default('queues.counts', 0), [])
+        self.assertEqual(self.lua('job.get', 0, 'jid')['queue'], 'queue')
+
+    def test_waiter(self):
+        '''Waiters block on the wake lists within the namespace'''
+        self.lua('config.set', 0, 'max-wake-tokens', 1)
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        waiter = ReqlessWaiter(self.shard, self.lua, ['queue'], 'worker')
+        self.assertEqual(waiter.wake_keys(), [NAMESPACE + 'q:queue-wake'])
+        self.assertEqual(self.redis.llen(waiter.wake_keys()[0]), 1)
@@ -12,11 +12,22 @@ class TestConfig(TestReqless):
             'application': 'reqless',
             'grace-period': '10',
             'heartbeat': '60',
+            'history-mode': 'capped',
+            'history-sample-rate': '10',
+            'inline-promotion': '1',
+            'job-layout': 'hash',
             'jobs-history': '604800',
+            'jobs-history-budget': '10',
             'jobs-history-count': '50000',
+            'jobs-retention': 'sweep',
+            'max-inline-data': '0',
             'max-job-history': '100',
             'max-pop-retry': '1',
+            'max-put-multi': '1000',
+            'max-wake-tokens': '0',
             'max-worker-age': '86400',
+            'pop-invalidates-locks': '1',
+            'stats-precision': '0',
         })
 
     def test_get(self):
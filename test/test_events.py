@@ -166,6 +166,19 @@ class TestEvents(TestReqless):
             'data': b'{"jid":"jid","event":"put","queue":"queue"}'
         }])
 
+    def test_put_multi(self):
+        '''We should hear chatter about each job put into a queue at once'''
+        with self.lua:
+            self.lua('queue.putMulti', 0, 'worker', 'queue', [
+                {'jid': jid, 'klass': 'klass', 'data': {}} for jid in 'ab'])
+        self.assertEqual(self.lua.log, [{
+            'channel': b'ql:log',
+            'data': b'{"jid":"a","event":"put","queue":"queue"}'
+        }, {
+            'channel': b'ql:log',
+            'data': b'{"jid":"b","event":"put","queue":"queue"}'
+        }])
+
     def test_reput(self):
         '''When we put a popped job into a queue, it informs the worker'''
         self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
@@ -3,6 +3,7 @@
 import redis
 
 from test.common import TestReqless
+from test.reqless import ReqlessRecorder
 
 
 class TestFail(TestReqless):
@@ -106,13 +107,73 @@ class TestFail(TestReqless):
             self.lua, 'job.fail', 4, 'jid', 'worker', 'group', 'message', {})
 
 
+class TestFailMulti(TestReqless):
+    '''Test failing many jobs at once'''
+    def setUp(self):
+        TestReqless.setUp(self)
+        self.lua('throttle.set', 0, 'tid', 2)
+        for jid in 'abcd':
+            self.lua('queue.put', 0, 'worker', 'queue', jid, 'klass', {}, 0,
+                'throttles', ['tid'])
+        self.lua('queue.pop', 1, 'queue', 'worker', 10)
+
+    def test_malformed(self):
+        '''Enumerate all the malformed cases'''
+        self.assertMalformed(self.lua, [
+            ('job.failMulti', 0),
+            ('job.failMulti', 0, '[}'),
+            ('job.failMulti', 0, 5),
+            ('job.failMulti', 0, ['a']),
+            ('job.failMulti', 0, ['a'], 'worker'),
+            ('job.failMulti', 0, ['a'], 'worker', 'group'),
+        ])
+
+    def test_many(self):
+        '''More jobs can be failed at once than lua can unpack'''
+        jids = ['many-%d' % index for index in range(8001)]
+        for index in range(0, len(jids), 1000):
+            self.lua('queue.putMulti', 0, 'worker', 'many', [
+                {'jid': jid, 'klass': 'klass', 'data': {}}
+                for jid in jids[index:index + 1000]])
+            self.lua('queue.pop', 1, 'many', 'worker', 1000)
+        self.lua('job.failMulti', 2, jids, 'worker', 'group', 'message')
+        self.assertEqual(self.lua('failureGroups.counts', 2), {'group': 8001})
+        self.assertEqual(self.lua('throttle.locks', 2, 'ql:q:many'), [])
+
+    def test_basic(self):
+        '''Jobs are failed just as with fail, each with its outcome'''
+        self.assertEqual(self.lua(
+            'job.failMulti', 2, ['c', 'd', 'a'], 'worker', 'group', 'message'), [
+                {'jid': 'c', 'failed': 'c'},
+                {'jid': 'd', 'failed': 'd'},
+                {'jid': 'a', 'error': 'Fail(): Job not currently running: throttled'},
+            ])
+        for jid in 'cd':
+            job = self.lua('job.get', 2, jid)
+            self.assertEqual(job['state'], 'failed')
+            self.assertEqual(job['failure']['group'], 'group')
+        self.assertEqual(self.lua('failureGroups.counts', 2), {'group': 2})
+        self.assertEqual(
+            self.lua('jobs.failedByGroup', 2, 'group')['jobs'], ['d', 'c'])
+        self.assertEqual(self.lua('queue.stats', 2, 'queue', 2)['failures'], 2)
+        self.assertEqual(self.lua('queue.stats', 2, 'queue', 2)['failed'], 2)
+        # The throttle was released, and the pending jobs can now be popped
+        self.assertEqual(self.lua('throttle.locks', 2, 'tid'), [])
+        self.assertEqual(self.lua('throttle.pending', 2, 'tid'), [])
+        self.assertEqual(
+            sorted(self.redis.zrange('ql:q:queue-work', 0, -1)), [b'a', b'b'])
+
 class TestFailed(TestReqless):
     '''Test access to our failed jobs'''
     def test_malformed(self):
         '''Enumerate all the malformed requests'''
         self.assertMalformed(self.lua, [
             ('jobs.failedByGroup', 0, 'foo', 'foo'),
-            ('jobs.failedByGroup', 0, 'foo', 0, 'foo')
+            ('jobs.failedByGroup', 0, 'foo', 0, 'foo'),
+            ('jobs.failedByGroup', 0, 'foo', 0, 25, 'foo'),
+            ('jobs.failedByGroup', 0, 'foo', 0, 25, 0, 'foo'),
+            ('failureGroups.counts', 0, 'foo'),
+            ('failureGroups.counts', 0, 0, 'foo'),
         ])
 
     def test_basic(self):
@@ -156,6 +217,204 @@ class TestFailed(TestReqless):
         self.assertEqual(
             self.lua('jobs.failedByGroup', 0, 'group', 50, 50)['jobs'], jids[50:])
 
+    def test_failed_time_range(self):
+        '''Failed can page through the jobs that failed in a time range'''
+        for jid in map(str, range(10)):
+            self.lua('queue.put', jid, 'worker', 'queue', jid, 'klass', {}, 0)
+            self.lua('queue.pop', jid, 'queue', 'worker', 10)
+            self.lua('job.fail', jid, jid, 'worker', 'group', 'message')
+        self.assertEqual(
+            self.lua('jobs.failedByGroup', 0, 'group', 0, 3, 2, 7), {
+                'total': 6,
+                'jobs': ['7', '6', '5']
+            })
+        self.assertEqual(
+            self.lua('jobs.failedByGroup', 0, 'group', 3, 3, 2, 7)['jobs'],
+            ['4', '3', '2'])
+        self.assertEqual(
+            self.lua('jobs.failedByGroup', 0, 'group', 0, 25, 8)['jobs'],
+            ['9', '8'])
+
+    def test_removal(self):
+        '''Jobs that leave a group are removed from it'''
+        for jid in map(str, range(3)):
+            self.lua('queue.put', jid, 'worker', 'queue', jid, 'klass', {}, 0)
+            self.lua('queue.pop', jid, 'queue', 'worker', 10)
+            self.lua('job.fail', jid, jid, 'worker', 'group', 'message')
+        self.lua('job.cancel', 10, '1')
+        self.lua('queue.put', 10, 'worker', 'queue', '2', 'klass', {}, 0)
+        self.assertEqual(self.lua('jobs.failedByGroup', 0, 'group'), {
+            'total': 1,
+            'jobs': ['0']
+        })
+        self.lua('job.cancel', 10, '0')
+        self.assertEqual(self.lua('failureGroups.counts', 0), {})
+        self.assertEqual(self.redis.keys('ql:failed:*'), [])
+
+    def test_counts_top(self):
+        '''Counts can be limited to the largest groups'''
+        for index, group in enumerate(['a', 'b', 'b', 'c', 'c', 'c']):
+            jid = str(index)
+            self.lua('queue.put', 0, 'worker', 'queue', jid, 'klass', {}, 0)
+            self.lua('queue.pop', 0, 'queue', 'worker', 10)
+            self.lua('job.fail', 0, jid, 'worker', group, 'message')
+        self.assertEqual(
+            self.lua('failureGroups.counts', 0, 0, 2), {'c': 3, 'b': 2})
+        self.assertEqual(
+            self.lua('failureGroups.counts', 0, 2, 2), {'a': 1})
+        self.lua('queue.unfail', 0, 'queue', 'c', 2)
+        self.lua('job.cancel', 0, '1')
+        self.assertEqual(
+            self.lua('failureGroups.counts', 0), {'a': 1, 'b': 1, 'c': 1})
+        self.lua('queue.unfail', 0, 'queue', 'c', 2)
+        self.assertEqual(
+            self.redis.zrange('ql:failures:counts', 0, -1), [b'a', b'b'])
+
+
+class TestFailureMigration(TestReqless):
+    '''Test moving the failure groups of earlier versions to sorted sets'''
+
+    def fail_legacy(self, jids, group='group'):
+        '''Fail the jobs, and then keep them in a list like earlier versions'''
+        for now, jid in enumerate(jids):
+            self.lua('queue.put', now, 'worker', 'queue', jid, 'klass', {}, 0)
+            self.lua('queue.pop', now, 'queue', 'worker', 10)
+            self.lua('job.fail', now, jid, 'worker', group, 'message')
+        self.redis.delete('ql:failed:' + group)
+        self.redis.zrem('ql:failures:counts', group)
+        self.redis.lpush('ql:f:' + group, *jids)
+
+    def test_malformed(self):
+        '''Enumerate all the malformed cases'''
+        self.assertMalformed(self.lua, [
+            ('failureGroups.migrate', 0, 'foo'),
+        ])
+
+    def test_migrate(self):
+        '''Jobs are moved into the sorted sets with their failure times'''
+        self.fail_legacy(list(map(str, range(10))))
+        self.assertEqual(self.lua('failureGroups.migrate', 100, 4), {
+            'migrated': 4,
+            'done': False
+        })
+        self.assertEqual(self.redis.llen('ql:f:group'), 6)
+        self.assertEqual(
+            self.lua('jobs.failedByGroup', 0, 'group', 0, 3, 2, 7), {
+                'total': 6,
+                'jobs': ['7', '6', '5']
+            })
+        self.assertEqual(self.lua('failureGroups.counts', 0), {'group': 10})
+        self.assertEqual(self.lua('failureGroups.migrate', 100, 6), {
+            'migrated': 6,
+            'done': True
+        })
+        self.assertEqual(self.redis.keys('ql:f:*'), [])
+        self.assertEqual(
+            self.lua('jobs.failedByGroup', 0, 'group', 0, 3, 2, 7)['jobs'],
+            ['7', '6', '5'])
+        self.assertEqual(self.lua('failureGroups.counts', 0), {'group': 10})
+
+    def test_migrate_groups(self):
+        '''No more jobs than the budget are moved at a time'''
+        self.fail_legacy(['1', '2', '3'], 'first')
+        self.fail_legacy(['4', '5', '6'], 'second')
+        migrated = []
+        while True:
+            result = self.lua('failureGroups.migrate', 100, 1)
+            migrated.append(result['migrated'])
+            if result['done']:
+                break
+        self.assertEqual(sum(migrated), 6)
+        self.assertEqual(set(migrated[:-1]), {1})
+        self.assertEqual(
+            self.redis.zcard('ql:failed:first') +
+            self.redis.zcard('ql:failed:second'), 6)
+
+    def test_migrate_done(self):
+        '''Once every group is moved, migrating doesn't visit them again'''
+        self.fail_legacy(['1', '2'])
+        self.lua('failureGroups.migrate', 100)
+        result, calls = self.command_calls(
+            self.lua, 'failureGroups.migrate', 100)
+        self.assertEqual(result, {'migrated': 0, 'done': True})
+        self.assertEqual(calls, 1)
+
+    def test_counts_unmigrated(self):
+        '''Groups that are not yet moved are counted from their lists'''
+        self.fail_legacy(['1', '2', '3'], 'first')
+        self.fail_legacy(['4', '5'], 'second')
+        self.lua('job.cancel', 0, '4')
+        self.assertEqual(self.lua('failureGroups.counts', 0), {
+            'first': 3,
+            'second': 1
+        })
+        self.assertEqual(
+            self.lua('failureGroups.counts', 0, 1, 1), {'second': 1})
+
+    def test_remove_unmigrated(self):
+        '''Jobs can leave a group before it is migrated'''
+        self.fail_legacy(['1', '2'])
+        self.lua('job.cancel', 10, '1')
+        self.assertEqual(self.redis.lrange('ql:f:group', 0, -1), [b'2'])
+        self.assertEqual(self.lua('failureGroups.counts', 0), {'group': 1})
+        self.lua('job.cancel', 10, '2')
+        self.assertEqual(self.redis.smembers('ql:failures'), set())
+        self.assertEqual(self.redis.zrange('ql:failures:counts', 0, -1), [])
+
+    def test_unmigrated_jobs(self):
+        '''Jobs of groups that are not yet moved can be listed and unfailed'''
+        self.fail_legacy(['1', '2', '3'])
+        self.assertEqual(
+            self.lua('jobs.failedByGroup', 0, 'group', 0, 2)['jobs'], ['3', '2'])
+        self.assertEqual(self.redis.llen('ql:f:group'), 3)
+        self.fail_legacy(['4', '5'], 'other')
+        self.assertEqual(self.lua('queue.unfail', 10, 'queue', 'other', 1), 1)
+        self.assertEqual(self.lua('job.get', 10, '4')['state'], 'waiting')
+        self.assertEqual(self.lua('failureGroups.counts', 0), {
+            'group': 3,
+            'other': 1
+        })
+
+    def test_fail_unmigrated(self):
+        '''Jobs failing in groups that are not yet moved are listed before
+        those in their lists, without moving them'''
+        self.fail_legacy(['1', '2'])
+        self.lua('queue.put', 10, 'worker', 'queue', '3', 'klass', {}, 0)
+        self.lua('queue.pop', 10, 'queue', 'worker', 10)
+        self.lua('job.fail', 10, '3', 'worker', 'group', 'message')
+        self.assertEqual(self.redis.llen('ql:f:group'), 2)
+        self.assertEqual(self.lua('jobs.failedByGroup', 0, 'group'), {
+            'total': 3,
+            'jobs': ['3', '2', '1']
+        })
+        self.assertEqual(
+            self.lua('jobs.failedByGroup', 0, 'group', 1, 1)['jobs'], ['2'])
+        self.assertEqual(
+            self.lua('jobs.failedByGroup', 0, 'group', 1, 5, 1, 10), {
+                'total': 2,
+                'jobs': ['2']
+            })
+        self.assertEqual(self.lua('failureGroups.counts', 0), {'group': 3})
+        self.assertEqual(self.lua('queue.unfail', 10, 'queue', 'group', 2), 2)
+        self.assertEqual(self.redis.exists('ql:f:group'), 0)
+        self.assertEqual(self.lua('jobs.failedByGroup', 0, 'group')['jobs'], ['3'])
+        self.assertEqual(self.lua('queue.unfail', 10, 'queue', 'group', 2), 1)
+        self.assertEqual(self.redis.smembers('ql:failures'), set())
+
+    def test_read_only_unmigrated(self):
+        '''The read-only build reads the lists of groups not yet moved'''
+        ro = ReqlessRecorder(self.redis, 'reqless-ro.lua')
+        self.fail_legacy(list(map(str, range(5))))
+        self.assertEqual(ro('jobs.failedByGroup', 0, 'group', 1, 2), {
+            'total': 5,
+            'jobs': ['3', '2']
+        })
+        self.assertEqual(
+            ro('jobs.failedByGroup', 0, 'group', 0, 2, 1, 3)['jobs'],
+            ['3', '2'])
+        self.assertEqual(ro('failureGroups.counts', 0), {'group': 5})
+        self.assertEqual(self.redis.exists('ql:f:group'), 1)
+
 
 class TestUnfailed(TestReqless):
     '''Test access to unfailed'''
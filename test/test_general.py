@@ -1,5 +1,8 @@
 '''Check some general functionality surrounding the the API'''
 
+import json
+
+import msgpack
 import redis
 
 from test.common import TestReqless
@@ -22,3 +25,60 @@ class TestGeneral(TestReqless):
     def test_malformed_time(self):
         '''If we provide a non-numeric time, it should throw an error'''
         self.assertRaises(redis.ResponseError, self.lua, 'queue.put', 'foo')
+
+
+class TestEncoding(TestReqless):
+    '''Responses may be encoded as MessagePack rather than JSON'''
+    def setUp(self):
+        TestReqless.setUp(self)
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass',
+            {'foo': 'bar'}, 0, 'tags', ['tag'])
+
+    def test_msgpack(self):
+        '''The same response is returned in either encoding'''
+        self.lua('job.track', 1, 'jid')
+        for command in (('job.get', 1, 'jid'), ('job.getMulti', 1, 'jid'),
+                ('queues.counts', 1), ('queue.peek', 1, 'queue', 0, 10),
+                ('jobs.tracked', 1), ('config.getAll', 1)):
+            expected = self.lua(*command)
+            packed = self.lua(command[0] + ':msgpack', *command[1:])
+            self.assertEqual(msgpack.unpackb(packed), expected)
+
+    def test_msgpack_data(self):
+        '''A job's data is the JSON string it was put with'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'empty', 'klass',
+            {'b': {}, 'c': []}, 0)
+        job = msgpack.unpackb(self.lua('job.get:msgpack', 1, 'empty'))
+        self.assertEqual(json.loads(job['data']), {'b': {}, 'c': []})
+        self.assertEqual(job['failure'], {})
+
+    def test_msgpack_large(self):
+        '''Arrays and maps of any size are packed'''
+        jids = ['jid-%d' % index for index in range(1000)]
+        for jid in jids[:20]:
+            self.lua('queue.put', 0, 'worker', 'queue', jid, 'klass', {}, 0)
+        packed = self.lua('job.getMulti:msgpack', 1, *jids[:20])
+        self.assertEqual(
+            [job['jid'] for job in msgpack.unpackb(packed)], jids[:20])
+        self.lua('queue.putMulti', 0, 'worker', 'other', [
+            {'jid': jid, 'klass': 'klass', 'data': {}} for jid in jids])
+        self.assertEqual(msgpack.unpackb(
+            self.lua('queue.peek:msgpack', 1, 'other', 0, 1000)),
+            self.lua('queue.peek', 1, 'other', 0, 1000))
+
+    def test_msgpack_empty(self):
+        '''Empty arrays remain arrays'''
+        packed = self.lua('job.getMulti:msgpack', 1)
+        self.assertEqual(msgpack.unpackb(packed), [])
+        packed = self.lua('queue.pop:msgpack', 1, 'other', 'worker', 10)
+        self.assertEqual(msgpack.unpackb(packed), [])
+
+    def test_json(self):
+        '''JSON may be requested explicitly'''
+        self.assertEqual(
+            self.lua('job.get:json', 1, 'jid'), self.lua('job.get', 1, 'jid'))
+
+    def test_unknown_encoding(self):
+        '''If the encoding is unknown, it should throw an error'''
+        self.assertRaisesRegexp(redis.ResponseError, r'Unknown encoding',
+            self.lua, 'job.get:foo', 1, 'jid')
@@ -1,5 +1,7 @@
 '''Test job-centric operations'''
 
+import json
+
 import redis
 
 from test.common import TestReqless
@@ -41,6 +43,180 @@ class TestJob(TestReqless):
             {'queue': 'queue', 'what': 'put', 'when': 99}])
 
 
+class TestHistoryModes(TestReqless):
+    '''Test the ways in which job history may be kept'''
+    def setUp(self):
+        TestReqless.setUp(self)
+        self.lua('config.set', 0, 'max-job-history', 3)
+
+    def log(self, count):
+        '''Log count messages for the job, putting it first if need be, and
+        return the logged times'''
+        if not self.redis.exists('ql:j:jid'):
+            self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        for index in range(1, count + 1):
+            self.lua('job.log', index, 'jid', 'message')
+        return [entry['when'] for entry in self.lua('job.get', 0, 'jid')['history']]
+
+    def test_capped(self):
+        '''Keeps the first entry, and the most recent'''
+        self.assertEqual(self.log(10), [0, 9, 10])
+
+    def test_full(self):
+        '''Keeps every entry'''
+        self.lua('config.set', 0, 'history-mode', 'full')
+        self.assertEqual(self.log(10), list(range(11)))
+
+    def test_ring(self):
+        '''Keeps only the most recent entries'''
+        self.lua('config.set', 0, 'history-mode', 'ring')
+        self.assertEqual(self.log(10), [8, 9, 10])
+
+    def test_first_last(self):
+        '''Keeps only the first and last entries'''
+        self.lua('config.set', 0, 'history-mode', 'first-last')
+        self.assertEqual(self.log(10), [0, 10])
+
+    def test_sampled(self):
+        '''Keeps put entries, and only some of the others'''
+        self.lua('config.set', 0, 'max-job-history', 100)
+        self.lua('config.set', 0, 'history-mode', 'sampled')
+        self.lua('config.set', 0, 'history-sample-rate', 5)
+        history = self.log(100)
+        self.assertEqual(history[0], 0)
+        self.assertGreater(len(history), 1)
+        self.assertLess(len(history), 50)
+
+    def test_off(self):
+        '''Keeps no entries'''
+        self.lua('config.set', 0, 'history-mode', 'off')
+        self.assertEqual(self.log(10), [])
+
+    def test_queue_mode(self):
+        '''Queues may have their own history mode'''
+        self.lua('config.set', 0, 'queue-history-mode', 'off')
+        self.lua('queue.put', 0, 'worker', 'other', 'other', 'klass', {}, 0)
+        self.assertEqual(self.log(10), [])
+        self.lua('job.log', 1, 'other', 'message')
+        self.assertEqual(
+            len(self.lua('job.get', 0, 'other')['history']), 2)
+
+    def test_capped_calls(self):
+        '''Capped history costs no more to append to than a ring'''
+        self.log(10)
+        self.assertEqual(self.redis.llen('ql:j:jid-history'), 2)
+        _, capped = self.command_calls(self.lua, 'job.log', 11, 'jid', 'message')
+        self.lua('config.set', 0, 'history-mode', 'ring')
+        self.lua('job.log', 12, 'jid', 'message')
+        _, ring = self.command_calls(self.lua, 'job.log', 13, 'jid', 'message')
+        self.assertEqual(capped, ring)
+
+    def test_capped_trimmed(self):
+        '''The first entry is kept however far over the cap the history is'''
+        self.log(10)
+        self.lua('config.set', 0, 'history-mode', 'full')
+        self.log(10)
+        self.lua('config.unset', 0, 'history-mode')
+        self.lua('job.log', 11, 'jid', 'message')
+        self.assertEqual(
+            [entry['when'] for entry in self.lua('job.get', 0, 'jid')['history']],
+            [0, 10, 11])
+
+    def test_legacy(self):
+        '''Old-style history comes before any newer entries'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.redis.hset('ql:j:jid', 'history', json.dumps([
+            {'put': -10, 'queue': 'queue', 'popped': -9, 'worker': 'worker'}]))
+        self.lua('job.log', 1, 'jid', 'message')
+        self.assertEqual(self.lua('job.get', 0, 'jid')['history'], [
+            {'queue': 'queue', 'what': 'put', 'when': -10},
+            {'what': 'popped', 'when': -9, 'worker': 'worker'},
+            {'queue': 'queue', 'what': 'put', 'when': 0},
+            {'what': 'message', 'when': 1}])
+        self.assertFalse(self.redis.hexists('ql:j:jid', 'history'))
+
+
+class TestFields(TestReqless):
+    '''Test limiting the fields of job data that are returned'''
+    LITE_FIELDS = [
+        'data', 'expires', 'failure', 'jid', 'klass', 'priority', 'queue',
+        'remaining', 'retries', 'spawned_from_jid', 'state', 'tags',
+        'throttles', 'worker',
+    ]
+
+    def test_malformed(self):
+        '''Enumerate all the ways to send malformed requests'''
+        self.assertMalformed(self.lua, [
+            ('job.getMultiFields', 0),
+            ('job.getMultiFields', 0, 'unknown-profile', 'jid'),
+            ('job.getMultiFields', 0, '["unknown-field"]', 'jid'),
+            ('job.getMultiFields', 0, '"jid"', 'jid'),
+            ('queue.pop', 0, 'queue', 'worker', 10, '["unknown-field"]'),
+            ('queue.peek', 0, 'queue', 0, 10, '["unknown-field"]'),
+        ])
+
+    def test_get_multi_fields(self):
+        '''Only the requested fields are returned'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.assertEqual(
+            self.lua('job.getMultiFields', 0, ['jid', 'state', 'history'], 'jid'),
+            [{
+                'jid': 'jid',
+                'state': 'waiting',
+                'history': [{'queue': 'queue', 'what': 'put', 'when': 0}],
+            }])
+
+    def test_get_multi_fields_missing(self):
+        '''Jobs that don't exist are omitted'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.assertEqual(
+            self.lua('job.getMultiFields', 0, ['jid'], 'foo', 'jid', 'bar'),
+            [{'jid': 'jid'}])
+
+    def test_lite_profile(self):
+        '''The lite profile includes all the fields stored in the job hash'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        full = self.lua('job.getMulti', 0, 'jid')[0]
+        lite = self.lua('job.getMultiFields', 0, 'lite', 'jid')[0]
+        self.assertEqual(sorted(lite.keys()), self.LITE_FIELDS)
+        self.assertEqual(
+            lite, {key: full[key] for key in self.LITE_FIELDS})
+
+    def test_pop_fields(self):
+        '''Pop accepts an optional field projection'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.assertEqual(
+            self.lua('queue.pop', 1, 'queue', 'worker', 10, ['jid', 'worker']),
+            [{'jid': 'jid', 'worker': 'worker'}])
+
+    def test_pop_lite(self):
+        '''Pop accepts a named field profile'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        jobs = self.lua('queue.pop', 1, 'queue', 'worker', 10, 'lite')
+        self.assertEqual(sorted(jobs[0].keys()), self.LITE_FIELDS)
+        self.assertEqual(jobs[0]['state'], 'running')
+
+    def test_peek_fields(self):
+        '''Peek accepts an optional field projection'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.assertEqual(
+            self.lua('queue.peek', 1, 'queue', 0, 10, ['jid', 'tracked']),
+            [{'jid': 'jid', 'tracked': False}])
+
+    def test_no_fields(self):
+        '''Omitting the fields peeks the listing profile, and pops all of the
+        job data'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.assertEqual(
+            self.lua('queue.peek', 1, 'queue', 0, 10),
+            self.lua('job.getMultiFields', 1, 'listing', 'jid'))
+        self.assertEqual(
+            self.lua('queue.peek', 1, 'queue', 0, 10, 'full'),
+            self.lua('job.getMulti', 1, 'jid'))
+        self.assertEqual(
+            self.lua('queue.pop', 1, 'queue', 'worker', 10)[0]['data'], '{}')
+
+
 class TestRequeue(TestReqless):
     def test_requeue_existing_job(self):
         '''Requeueing an existing job is identical to `put`'''
@@ -240,6 +416,360 @@ class TestComplete(TestReqless):
         self.assertEqual(self.lua('jobs.tagged', 10, 'abc', 0, 0)['jobs'], {})
         self.assertEqual(self.redis.zrange('ql:tags', 0, -1), [])
 
+    def test_expire_complete_budget(self):
+        '''Each completion deletes no more than jobs-history-budget jobs'''
+        self.lua('config.set', 0, 'jobs-history-budget', 2)
+        for jid in range(10):
+            self.lua('queue.put', 0, 'worker', 'queue', jid, 'klass', {}, 0)
+        self.lua('queue.pop', 1, 'queue', 'worker', 10)
+        for jid in range(9):
+            self.lua('job.complete', 2, jid, 'worker', 'queue', {})
+        # Lowering the count leaves a backlog that completions work through
+        self.lua('config.set', 2, 'jobs-history-count', 1)
+        self.lua('job.complete', 3, 9, 'worker', 'queue', {})
+        self.assertEqual(self.redis.zcard('ql:completed'), 8)
+        self.assertEqual(self.lua('job.get', 3, 0), None)
+        self.assertEqual(self.lua('job.get', 3, 2)['state'], 'complete')
+
+    def test_expire(self):
+        '''Expired completed jobs can be deleted in bounded steps'''
+        for jid in range(10):
+            self.lua('queue.put', 0, 'worker', 'queue', jid, 'klass', {}, 0,
+                'tags', ['tag'])
+        self.lua('queue.pop', 1, 'queue', 'worker', 10)
+        for jid in range(10):
+            self.lua('job.complete', jid, jid, 'worker', 'queue', {})
+        self.assertEqual(self.lua('jobs.expire', 10), {
+            'expired': 0, 'remaining': 0})
+        self.lua('config.set', 10, 'jobs-history', 5)
+        self.lua('config.set', 10, 'jobs-history-count', 8)
+        self.assertEqual(self.lua('jobs.expire', 10, 3), {
+            'expired': 3, 'remaining': 3})
+        self.assertEqual(self.lua('jobs.expire', 10, 10), {
+            'expired': 3, 'remaining': 0})
+        self.assertEqual(
+            [self.lua('job.get', 10, jid) is None for jid in range(10)],
+            [True] * 6 + [False] * 4)
+        self.assertEqual(
+            self.lua('jobs.tagged', 10, 'tag', 0, 10)['jobs'], ['6', '7', '8', '9'])
+
+    def test_expire_malformed(self):
+        '''The budget must be a number'''
+        self.assertMalformed(self.lua, [
+            ('jobs.expire', 0, 'foo'),
+        ])
+
+
+class TestPackedLayout(TestReqless):
+    '''Test storing the fields of jobs that rarely change packed together'''
+    def setUp(self):
+        TestReqless.setUp(self)
+        self.lua('config.set', 0, 'job-layout', 'packed')
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass',
+            {'foo': 'bar'}, 0, 'tags', ['tag'], 'throttles', ['tid'])
+
+    def test_packed(self):
+        '''Jobs are packed and read the same as jobs that aren't'''
+        self.assertEqual(sorted(self.redis.hkeys('ql:j:jid')), [
+            b'expires', b'first_history', b'packed', b'priority', b'queue',
+            b'remaining', b'retries', b'state', b'time', b'worker'])
+        packed = self.lua('job.get', 0, 'jid')
+        self.lua('config.set', 0, 'job-layout', 'hash')
+        self.lua('queue.put', 0, 'worker', 'queue', 'other', 'klass',
+            {'foo': 'bar'}, 0, 'tags', ['tag'], 'throttles', ['tid'])
+        self.assertNotIn(b'packed', self.redis.hkeys('ql:j:other'))
+        unpacked = self.lua('job.get', 0, 'other')
+        self.assertEqual(packed, dict(unpacked, jid='jid',
+            history=packed['history'], throttles=packed['throttles']))
+
+    def test_update(self):
+        '''Packed fields may be updated'''
+        self.lua('job.addTag', 1, 'jid', 'other')
+        self.lua('queue.pop', 2, 'queue', 'worker', 10)
+        self.lua('job.heartbeat', 3, 'jid', 'worker', {'foo': 'baz'})
+        self.lua('job.complete', 4, 'jid', 'worker', 'queue', {'foo': 'qux'})
+        job = self.lua('job.get', 5, 'jid')
+        self.assertEqual(job['tags'], ['tag', 'other'])
+        self.assertEqual(json.loads(job['data']), {'foo': 'qux'})
+        self.assertEqual(job['state'], 'complete')
+        self.assertNotIn(b'data', self.redis.hkeys('ql:j:jid'))
+
+    def test_hot_fields(self):
+        '''Reading only fields that aren't packed never reads the packed ones'''
+        self.lua('queue.pop', 1, 'queue', 'worker', 10)
+        self.redis.hset('ql:j:jid', 'packed', b'\xc1')
+        self.assertEqual(self.lua('job.getMultiFields', 2,
+            ['jid', 'state', 'worker', 'priority'], 'jid'), [
+            {'jid': 'jid', 'state': 'running', 'worker': 'worker', 'priority': 0}])
+        self.lua('job.heartbeat', 2, 'jid', 'worker')
+        self.assertRaisesRegexp(redis.ResponseError, r'Bad data format',
+            self.lua, 'job.getMultiFields', 2, ['tags'], 'jid')
+
+    def test_change_layout(self):
+        '''Jobs put again are stored in the current layout'''
+        self.lua('config.set', 0, 'job-layout', 'hash')
+        self.lua('queue.put', 1, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.assertNotIn(b'packed', self.redis.hkeys('ql:j:jid'))
+        self.assertEqual(self.lua('job.get', 1, 'jid')['tags'], ['tag'])
+        self.lua('config.set', 1, 'job-layout', 'packed')
+        self.lua('queue.put', 2, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.assertNotIn(b'data', self.redis.hkeys('ql:j:jid'))
+        self.assertEqual(self.lua('job.get', 2, 'jid')['tags'], ['tag'])
+
+    def test_recurring(self):
+        '''Jobs spawned by recurring jobs are packed'''
+        self.lua('queue.recurAtInterval', 0, 'queue', 'recur', 'klass', {},
+            60, 0)
+        job = self.lua('queue.pop', 1, 'queue', 'worker', 10)[0]
+        self.assertEqual(job['spawned_from_jid'], 'recur')
+        self.assertIn(b'packed', self.redis.hkeys('ql:j:recur-1'))
+        self.lua('queue.put', 2, 'worker', 'queue', 'recur-1', 'klass', {}, 0)
+        self.assertEqual(
+            self.lua('job.get', 2, 'recur-1')['spawned_from_jid'], 'recur')
+
+
+class TestOffloadData(TestReqless):
+    '''Test keeping large job data in its own key'''
+    def setUp(self):
+        TestReqless.setUp(self)
+        self.data = {'payload': 'x' * 100}
+        self.lua('config.set', 0, 'max-inline-data', 50)
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass',
+            self.data, 0)
+
+    def test_offloaded(self):
+        '''Large data is kept in its own key'''
+        self.assertEqual(self.redis.hget('ql:j:jid', 'data'), None)
+        size = int(self.redis.hget('ql:j:jid', 'data_size'))
+        self.assertEqual(self.redis.strlen('ql:j:jid-data'), size)
+        job = self.lua('job.get', 0, 'jid')
+        self.assertEqual(json.loads(job['data']), self.data)
+        self.assertNotIn('data_size', job)
+
+    def test_unchanged(self):
+        '''Jobs are returned the same wherever their data is kept'''
+        self.lua('job.track', 0, 'jid')
+        self.lua('config.set', 0, 'max-inline-data', 0)
+        self.lua('queue.put', 0, 'worker', 'queue', 'inline', 'klass',
+            self.data, 0)
+        self.lua('job.track', 0, 'inline')
+        for jobs in (self.lua('queue.peek', 0, 'queue', 0, 10, 'full'),
+                self.lua('jobs.tracked', 0, 'full')['jobs'],
+                self.lua('queue.pop', 1, 'queue', 'worker', 10)):
+            self.assertEqual(
+                sorted(job['jid'] for job in jobs), ['inline', 'jid'])
+            self.assertEqual(set(jobs[0]), set(jobs[1]))
+            for job in jobs:
+                self.assertEqual(json.loads(job['data']), self.data)
+                self.assertNotIn('data_size', job)
+
+    def test_listing(self):
+        '''Listings may ask for the size of the data rather than the data'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'small', 'klass', {}, 0)
+        size = int(self.redis.hget('ql:j:jid', 'data_size'))
+        jobs = self.lua('queue.peek', 0, 'queue', 0, 10, 'listing')
+        self.assertEqual(
+            sorted((job['jid'], job['data_size']) for job in jobs),
+            [('jid', size), ('small', 2)])
+        for job in jobs:
+            self.assertNotIn('data', job)
+        self.lua('job.track', 0, 'jid')
+        self.command_calls(self.lua, 'queue.peek', 0, 'queue', 0, 10)
+        self.assertNotIn('cmdstat_get', self.redis.info('commandstats'))
+        self.assertEqual(self.lua('queue.peek', 0, 'queue', 0, 10), jobs)
+        self.assertEqual(
+            self.lua('jobs.tracked', 0)['jobs'], self.lua(
+                'job.getMultiFields', 0, 'listing', 'jid'))
+
+    def test_small(self):
+        '''Updating large data to small data moves it back into the hash'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'small', 'klass', {}, 0)
+        self.assertFalse(self.redis.exists('ql:j:small-data'))
+        self.lua('queue.pop', 1, 'queue', 'worker', 10)
+        self.lua('job.complete', 2, 'jid', 'worker', 'queue', {})
+        self.assertEqual(self.redis.hget('ql:j:jid', 'data'), b'{}')
+        self.assertEqual(self.redis.hget('ql:j:jid', 'data_size'), None)
+        self.assertFalse(self.redis.exists('ql:j:jid-data'))
+        self.assertNotIn('data_size', self.lua('job.get', 2, 'jid'))
+
+    def test_packed(self):
+        '''Large data of packed jobs is kept in its own key'''
+        self.lua('config.set', 0, 'job-layout', 'packed')
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass',
+            self.data, 0)
+        self.assertTrue(self.redis.exists('ql:j:jid-data'))
+        self.assertEqual(
+            json.loads(self.lua('job.get', 0, 'jid')['data']), self.data)
+
+    def test_cancel(self):
+        '''Deleting a job deletes its data'''
+        self.lua('job.cancel', 0, 'jid')
+        self.assertFalse(self.redis.exists('ql:j:jid-data'))
+
+
+class TestRetention(TestReqless):
+    '''Test having redis expire completed jobs'''
+    def setUp(self):
+        TestReqless.setUp(self)
+        self.lua('config.set', 0, 'jobs-retention', 'ttl')
+        self.lua('config.set', 0, 'jobs-history', 100)
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0,
+            'tags', ['tag'])
+        self.lua('queue.pop', 1, 'queue', 'worker', 10)
+        self.lua('job.complete', 2, 'jid', 'worker', 'queue', {})
+
+    def test_ttl(self):
+        '''Completed jobs' keys expire after jobs-history'''
+        self.assertEqual(self.redis.ttl('ql:j:jid'), 100)
+        self.assertEqual(self.redis.ttl('ql:j:jid-history'), 100)
+        self.assertEqual(self.lua('jobs.completed', 2), ['jid'])
+        self.assertEqual(self.redis.zscore('ql:t-expires:tag', 'jid'), 102)
+
+    def test_count(self):
+        '''The count only limits which completed jobs are listed'''
+        self.lua('config.set', 2, 'jobs-history-count', 1)
+        self.lua('queue.put', 2, 'worker', 'queue', 'other', 'klass', {}, 0)
+        self.lua('queue.pop', 3, 'queue', 'worker', 10)
+        self.lua('job.complete', 4, 'other', 'worker', 'queue', {})
+        self.assertEqual(self.lua('jobs.completed', 4), ['other'])
+        self.assertEqual(self.lua('job.get', 4, 'jid')['state'], 'complete')
+
+    def test_tags(self):
+        '''Jobs that redis has expired are removed from their tags'''
+        self.assertEqual(self.lua('jobs.tagged', 50, 'tag')['jobs'], ['jid'])
+        # Stand in for redis expiring the job
+        self.redis.delete('ql:j:jid', 'ql:j:jid-history')
+        self.assertEqual(self.lua('jobs.tagged', 102, 'tag')['jobs'], {})
+        self.assertEqual(self.redis.zcard('ql:t-expires:tag'), 0)
+        self.assertEqual(self.redis.zrange('ql:tags', 0, -1), [])
+
+    def test_tags_budget(self):
+        '''No more than jobs-history-budget expired jobs are removed from a
+        tag at a time'''
+        self.lua('config.set', 2, 'jobs-history-budget', 1)
+        self.lua('queue.put', 2, 'worker', 'queue', 'other', 'klass', {}, 0,
+            'tags', ['tag'])
+        self.lua('queue.pop', 3, 'queue', 'worker', 10)
+        self.lua('job.complete', 4, 'other', 'worker', 'queue', {})
+        self.redis.delete('ql:j:jid', 'ql:j:other')
+        self.assertEqual(len(self.lua('jobs.tagged', 200, 'tag')['jobs']), 1)
+        self.assertEqual(self.lua('jobs.tagged', 200, 'tag')['jobs'], {})
+
+    def test_later_keys(self):
+        '''Keys written for a completed job later expire along with it'''
+        self.redis.delete('ql:j:jid-history')
+        self.lua('job.log', 50, 'jid', 'message')
+        self.assertGreater(self.redis.ttl('ql:j:jid-history'), 0)
+        self.redis.delete('ql:j:jid-history')
+        self.redis.hset('ql:j:jid', 'history', json.dumps([{'put': 0}]))
+        self.lua('job.get', 50, 'jid')
+        self.assertGreater(self.redis.ttl('ql:j:jid-history'), 0)
+
+    def test_put_again(self):
+        '''Completed jobs that are put again no longer expire'''
+        self.lua('queue.put', 3, 'worker', 'queue', 'jid', 'klass', {}, 0,
+            'tags', ['tag'])
+        self.assertEqual(self.redis.ttl('ql:j:jid'), -1)
+        self.assertEqual(self.redis.ttl('ql:j:jid-history'), -1)
+        self.assertEqual(self.lua('jobs.tagged', 102, 'tag')['jobs'], ['jid'])
+        self.assertEqual(self.redis.zcard('ql:t-expires:tag'), 0)
+
+
+class TestCompleteMulti(TestReqless):
+    '''Test completing many jobs at once'''
+    def setUp(self):
+        TestReqless.setUp(self)
+        for jid in 'abc':
+            self.lua('queue.put', 0, 'worker', 'queue', jid, 'klass', {}, 0)
+        self.lua('queue.pop', 1, 'queue', 'worker', 10)
+
+    def test_malformed(self):
+        '''Enumerate all the ways the batch can be malformed'''
+        self.assertMalformed(self.lua, [
+            ('job.completeMulti', 2),
+            ('job.completeMulti', 2, 'worker'),
+            ('job.completeMulti', 2, 'worker', '[}'),
+            ('job.completeMulti', 2, 'worker', 5),
+        ])
+
+    def test_basic(self):
+        '''Jobs are completed or advanced, each with its outcome'''
+        self.assertEqual(self.lua('job.completeMulti', 2, 'worker', [
+            {'jid': 'a', 'queue': 'queue', 'data': {'foo': 'bar'}},
+            {'jid': 'b', 'queue': 'queue', 'data': {}, 'next': 'other'},
+            {'jid': 'c', 'queue': 'queue', 'data': {}, 'next': 'other',
+                'delay': 10},
+        ]), [
+            {'jid': 'a', 'state': 'complete'},
+            {'jid': 'b', 'state': 'waiting'},
+            {'jid': 'c', 'state': 'scheduled'},
+        ])
+        job = self.lua('job.get', 2, 'a')
+        self.assertEqual(job['state'], 'complete')
+        self.assertEqual(json.loads(job['data']), {'foo': 'bar'})
+        self.assertEqual(self.lua('job.get', 2, 'b')['queue'], 'other')
+        self.assertEqual(self.redis.zscore('ql:q:other-scheduled', 'c'), 12)
+
+    def test_errors(self):
+        '''Jobs that can't be completed don't stop the others'''
+        self.assertEqual(self.lua('job.completeMulti', 2, 'worker', [
+            {'jid': 'a', 'queue': 'other', 'data': {}},
+            {'jid': 'b', 'queue': 'queue', 'data': {}},
+            {'jid': 'nonexistent', 'queue': 'queue', 'data': {}},
+            {'queue': 'queue', 'data': {}},
+        ]), [
+            {'jid': 'a', 'error': 'Complete(): Job running in another queue: queue'},
+            {'jid': 'b', 'state': 'complete'},
+            {'jid': 'nonexistent', 'error': 'Complete(): Job does not exist'},
+            {'error': 'CompleteMulti(): Job 4 Arg "jid" missing'},
+        ])
+        self.assertEqual(self.lua('job.get', 2, 'a')['state'], 'running')
+
+    def test_checked_before_writing(self):
+        '''Jobs are checked before anything is written for them'''
+        self.redis.hset('ql:j:b', 'state', 'waiting')
+        self.assertEqual(self.lua('job.completeMulti', 2, 'worker', [
+            {'jid': jid, 'queue': 'queue', 'data': {'foo': 'bar'}}
+            for jid in 'ab']), [
+            {'jid': 'a', 'state': 'complete'},
+            {'jid': 'b', 'error': 'Complete(): Job is not currently running: waiting'},
+        ])
+        job = self.lua('job.get', 2, 'b')
+        self.assertEqual(job['data'], '{}')
+        self.assertEqual(job['history'][-1]['what'], 'popped')
+        self.assertEqual(self.redis.zscore('ql:q:queue-locks', 'b'), 61)
+
+    def test_error_while_writing(self):
+        '''Errors raised once a job is being written raise for the batch'''
+        self.redis.hset('ql:j:b', 'retries', 'foo')
+        self.assertRaises(redis.ResponseError, self.lua, 'job.completeMulti',
+            2, 'worker', [{'jid': jid, 'queue': 'queue', 'data': {}}
+                for jid in 'ab'])
+
+    def test_deferred_after_writing(self):
+        '''Only the jobs written before such an error have their throttles
+        released'''
+        self.lua('throttle.set', 0, 'tid', 2)
+        for jid in 'de':
+            self.lua('queue.put', 0, 'worker', 'other', jid, 'klass', {}, 0,
+                'throttles', ['tid'])
+        self.lua('queue.pop', 1, 'other', 'worker', 10)
+        self.redis.set('ql:j:e-dependents', 'foo')
+        self.assertRaises(redis.ResponseError, self.lua, 'job.completeMulti',
+            2, 'worker', [{'jid': jid, 'queue': 'other', 'data': {}}
+                for jid in 'de'])
+        self.assertEqual(self.lua('throttle.locks', 2, 'tid'), ['e'])
+
+    def test_expires_once(self):
+        '''Completed jobs are expired after the whole batch'''
+        self.lua('config.set', 0, 'jobs-history-count', 1)
+        self.lua('job.completeMulti', 2, 'worker', [
+            {'jid': jid, 'queue': 'queue', 'data': {}} for jid in 'abc'])
+        self.assertEqual(self.redis.zcard('ql:completed'), 1)
+        self.assertEqual(self.lua('job.get', 2, 'a'), None)
+        self.assertEqual(self.lua('job.get', 2, 'b'), None)
+        self.assertEqual(self.lua('job.get', 2, 'c')['state'], 'complete')
+
 
 class TestTimeout(TestReqless):
     '''Basic timeout works'''
@@ -331,6 +331,47 @@ class TestRetry(TestReqless):
         })
 
 
+class TestRetryMulti(TestReqless):
+    '''Test retrying many jobs at once'''
+    def setUp(self):
+        TestReqless.setUp(self)
+        for jid in 'abc':
+            self.lua('queue.put', 0, 'worker', 'queue', jid, 'klass', {}, 0,
+                'retries', 1)
+        self.lua('queue.pop', 1, 'queue', 'worker', 10)
+
+    def test_malformed(self):
+        '''Enumerate all the malformed cases'''
+        self.assertMalformed(self.lua, [
+            ('job.retryMulti', 0),
+            ('job.retryMulti', 0, '[}'),
+            ('job.retryMulti', 0, ['a']),
+            ('job.retryMulti', 0, ['a'], 'queue'),
+            ('job.retryMulti', 0, ['a'], 'queue', 'worker', 'foo'),
+        ])
+
+    def test_basic(self):
+        '''Jobs are retried just as with retry, each with its outcome'''
+        self.assertEqual(self.lua(
+            'job.retryMulti', 2, ['a', 'b', 'd'], 'queue', 'worker', 0), [
+                {'jid': 'a', 'remaining': 0},
+                {'jid': 'b', 'remaining': 0},
+                {'jid': 'd', 'error': 'Retry(): Job does not exist'},
+            ])
+        self.assertEqual(self.lua('job.get', 2, 'a')['state'], 'waiting')
+        self.assertEqual(self.lua('job.get', 2, 'c')['state'], 'running')
+
+    def test_exhausted(self):
+        '''Jobs that exhaust their retries are failed together'''
+        for now in (2, 4):
+            self.lua('queue.pop', now, 'queue', 'worker', 10)
+            self.lua('job.retryMulti', now + 1, ['a', 'b'], 'queue', 'worker',
+                0, 'group', 'message')
+        self.assertEqual(self.lua('job.get', 5, 'a')['state'], 'failed')
+        self.assertEqual(self.lua('failureGroups.counts', 5), {'group': 2})
+        self.assertEqual(self.lua('queue.stats', 5, 'queue', 5)['failures'], 2)
+
+
 class TestGracePeriod(TestReqless):
     '''Make sure the grace period is honored'''
     # Our grace period for the tests
@@ -378,3 +419,131 @@ class TestGracePeriod(TestReqless):
         # And make sure that no job is available after the grace period
         self.assertEqual(
             self.lua('queue.pop', expires + self.grace, 'queue', 'worker', 10), [])
+
+
+class TestReap(TestReqless):
+    '''Reaping expired locks across all queues'''
+    def setUp(self):
+        TestReqless.setUp(self)
+        self.lua('config.set', 0, 'grace-period', 0)
+        self.lua('config.set', 0, 'heartbeat', 60)
+
+    def test_malformed(self):
+        '''Enumerate malformed inputs into reap'''
+        self.assertMalformed(self.lua, [
+            ('queues.reap', 0, 'foo'),
+        ])
+
+    def test_reap(self):
+        '''Expired locks in every queue are invalidated'''
+        for queue in ('a', 'b'):
+            self.lua('queue.put', 0, 'worker', queue, queue, 'klass', {}, 0)
+            self.lua('queue.pop', 0, queue, 'worker', 10)
+        self.assertEqual(self.lua('queues.reap', 30), {
+            'reaped': 0, 'remaining': 0})
+        self.assertEqual(self.lua('queues.reap', 61), {
+            'reaped': 2, 'remaining': 0})
+        for queue in ('a', 'b'):
+            job = self.lua('job.get', 61, queue)
+            self.assertEqual(job['state'], 'stalled')
+            self.assertEqual(job['worker'], '')
+            self.assertEqual(job['history'][-1], {'what': 'timed-out', 'when': 61})
+            self.assertEqual(
+                self.lua('queue.pop', 62, queue, 'another', 10)[0]['jid'], queue)
+
+    def test_budget(self):
+        '''Reports how many expired locks remain beyond the budget'''
+        for jid in range(5):
+            self.lua('queue.put', 0, 'worker', 'queue', jid, 'klass', {}, 0)
+        self.lua('queue.pop', 0, 'queue', 'worker', 10)
+        self.assertEqual(self.lua('queues.reap', 61, 2), {
+            'reaped': 2, 'remaining': 3})
+        self.assertEqual(self.lua('queues.reap', 61, 10), {
+            'reaped': 3, 'remaining': 0})
+
+    def test_grace_period(self):
+        '''The grace period is honored before jobs are handed out again'''
+        self.lua('config.set', 0, 'grace-period', 10)
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.lua('queue.pop', 0, 'queue', 'worker', 10)
+        self.assertEqual(self.lua('queues.reap', 61), {
+            'reaped': 0, 'remaining': 0})
+        self.assertEqual(self.lua('job.get', 61, 'jid')['state'], 'running')
+        self.assertEqual(self.lua('queues.reap', 71), {
+            'reaped': 1, 'remaining': 0})
+        self.assertEqual(self.lua('job.get', 71, 'jid')['state'], 'stalled')
+
+    def test_fails_exhausted_retries(self):
+        '''Jobs without retries remaining fail'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0, 'retries', 0)
+        self.lua('queue.pop', 0, 'queue', 'worker', 10)
+        self.assertEqual(self.lua('queues.reap', 61), {
+            'reaped': 0, 'remaining': 0})
+        self.assertEqual(self.lua('job.get', 61, 'jid')['state'], 'failed')
+        self.assertEqual(self.redis.zcard('ql:locks'), 0)
+
+    def test_index(self):
+        '''The index only holds jobs that are currently locked'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.lua('queue.pop', 0, 'queue', 'worker', 10)
+        self.assertEqual(self.redis.zrange('ql:locks', 0, -1, withscores=True), [
+            (b'jid', 60.0)])
+        self.lua('job.heartbeat', 10, 'jid', 'worker', {})
+        self.assertEqual(self.redis.zscore('ql:locks', 'jid'), 70.0)
+        self.lua('job.complete', 20, 'jid', 'worker', 'queue', {})
+        self.assertEqual(self.redis.zcard('ql:locks'), 0)
+
+    def test_deleted_job(self):
+        '''Locks of jobs that no longer exist are forgotten'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.lua('queue.pop', 0, 'queue', 'worker', 10)
+        self.redis.delete('ql:j:jid')
+        self.assertEqual(self.lua('queues.reap', 61), {
+            'reaped': 0, 'remaining': 0})
+        self.assertEqual(self.redis.zcard('ql:locks'), 0)
+
+    def test_unindexed(self):
+        '''Locks from before the index was kept are indexed and reaped'''
+        self.lua('config.set', 0, 'pop-invalidates-locks', 0)
+        for queue in ('a', 'b'):
+            for jid in range(3):
+                self.lua('queue.put', 0, 'worker', queue, queue + str(jid),
+                    'klass', {}, 0)
+            self.lua('queue.pop', 0, queue, 'worker', 10)
+        self.redis.delete('ql:locks')
+        reaped = 0
+        while True:
+            result = self.lua('queues.reap', 61, 1)
+            reaped += result['reaped']
+            if not result['remaining']:
+                break
+        self.assertEqual(reaped, 6)
+        self.assertEqual(self.redis.get('ql:locks:indexed'), b'1')
+        self.assertEqual(self.redis.zcard('ql:locks'), 0)
+        self.assertEqual(
+            len(self.lua('queue.pop', 62, 'a', 'another', 10)), 3)
+
+    def test_unlocked(self):
+        '''Jobs are only invalidated if they're still locked in their queue'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('queue.put', 0, 'worker', 'queue', 'b', 'klass', {}, 0)
+        self.lua('queue.pop', 0, 'queue', 'worker', 10)
+        self.lua('queues.reap', 0)
+        self.redis.zadd('ql:locks', {'a': 30, 'b': 30})
+        self.redis.zrem('ql:q:queue-locks', 'b')
+        self.assertEqual(self.lua('queues.reap', 40), {
+            'reaped': 0, 'remaining': 0})
+        self.assertEqual(self.lua('job.get', 40, 'a')['state'], 'running')
+        self.assertEqual(self.redis.zscore('ql:locks', 'a'), 60.0)
+        self.assertEqual(self.lua('job.get', 40, 'b')['state'], 'running')
+        self.assertEqual(self.redis.zscore('ql:locks', 'b'), None)
+
+    def test_pop_without_invalidation(self):
+        '''Pop can leave invalidating expired locks to reap'''
+        self.lua('config.set', 0, 'pop-invalidates-locks', 0)
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.lua('queue.pop', 0, 'queue', 'worker', 10)
+        self.assertEqual(self.lua('queue.pop', 61, 'queue', 'another', 10), [])
+        self.lua('queues.reap', 61)
+        self.assertEqual(
+            self.lua('queue.pop', 62, 'queue', 'another', 10)[0]['worker'], 'another')
@@ -1,5 +1,9 @@
 '''Test the queue functionality'''
 
+import json
+
+import redis
+
 from test.common import TestReqless
 
 class TestJobs(TestReqless):
@@ -283,6 +287,93 @@ class TestQueue(TestReqless):
         self.assertEqual(actual_queue_names, queue_names)
 
 
+class TestCachedCounts(TestReqless):
+    '''Test the counts each queue keeps of its jobs'''
+
+    def assertCached(self, now):
+        '''The cached counts agree with the counts of the sorted sets'''
+        expected = []
+        for counts in self.lua('queues.counts', now):
+            counts['running'] += counts.pop('stalled')
+            expected.append(counts)
+        self.assertEqual(self.lua('queues.counts', now, 'cached'), expected)
+
+    def test_malformed(self):
+        '''Enumerate all the malformed cases'''
+        self.assertMalformed(self.lua, [
+            ('queues.counts', 0, 'foo'),
+        ])
+
+    def test_transitions(self):
+        '''The counts follow jobs through each of their states'''
+        self.lua('config.set', 0, 'grace-period', 0)
+        self.lua('throttle.set', 0, 'tid', 1)
+        for now, jid in enumerate(('a', 'b', 'c', 'd')):
+            self.lua('queue.put', now / 10, 'worker', 'queue', jid, 'klass',
+                {}, 0, 'throttles', ['tid'])
+        self.lua('queue.put', 0, 'worker', 'queue', 'e', 'klass', {}, 0,
+            'depends', ['a'])
+        self.lua('queue.put', 0, 'worker', 'queue', 'f', 'klass', {}, 10)
+        self.lua('queue.recurAtInterval', 0, 'other', 'g', 'klass', {}, 60, 0)
+        self.assertCached(0)
+        self.lua('queue.pop', 1, 'queue', 'worker', 10)
+        self.assertCached(1)
+        self.lua('job.complete', 2, 'a', 'worker', 'queue', {})
+        self.assertCached(2)
+        self.lua('queue.pop', 3, 'queue', 'worker', 10)
+        self.lua('job.fail', 4, 'b', 'worker', 'group', 'message')
+        self.lua('job.cancel', 5, 'c')
+        self.assertCached(5)
+        self.lua('queue.pop', 20, 'queue', 'worker', 10)
+        self.lua('queue.pop', 20, 'other', 'worker', 10)
+        self.assertCached(20)
+        self.lua('queue.unfail', 30, 'queue', 'group', 10)
+        self.lua('queue.put', 30, 'worker', 'other', 'd', 'klass', {}, 0)
+        self.lua('recurringJob.update', 30, 'g', 'queue', 'other')
+        self.assertCached(30)
+        self.assertCached(1000)
+
+    def test_missing(self):
+        '''Queues whose counts were never kept have them built as needed'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('queue.put', 0, 'worker', 'queue', 'b', 'klass', {}, 10)
+        self.lua('queue.put', 0, 'worker', 'other', 'c', 'klass', {}, 0)
+        self.redis.delete('ql:q:queue-counts', 'ql:q:other-counts')
+        self.assertCached(0)
+        self.redis.delete('ql:q:queue-counts', 'ql:q:other-counts')
+        self.lua('queue.pop', 0, 'queue', 'worker', 10)
+        self.lua('queue.put', 0, 'worker', 'other', 'd', 'klass', {}, 0)
+        self.assertEqual(self.redis.exists('ql:q:queue-counts'), 1)
+        self.assertCached(0)
+
+    def test_failed_command(self):
+        '''The changes a command makes before it fails are counted'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('queue.pop', 0, 'queue', 'worker', 10)
+        # Putting a job with a malformed failure fails once it's already been
+        # taken out of the running jobs
+        self.redis.hset('ql:j:a', 'state', 'failed')
+        self.redis.hset('ql:j:a', 'failure', 'foo')
+        self.assertRaises(Exception,
+            self.lua, 'queue.put', 1, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.assertEqual(self.redis.zcard('ql:q:queue-locks'), 0)
+        self.assertCached(1)
+
+    def test_rebuild(self):
+        '''The counts can be rebuilt from the sorted sets'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('queue.put', 0, 'worker', 'queue', 'b', 'klass', {}, 10)
+        self.lua('queue.put', 0, 'worker', 'other', 'c', 'klass', {}, 0)
+        self.redis.hset('ql:q:queue-counts', 'waiting', 5)
+        self.redis.hset('ql:q:other-counts', 'waiting', 5)
+        self.assertEqual(
+            [counts['waiting'] for counts in
+                self.lua('queues.counts', 0, 'cached')], [5, 5])
+        self.assertEqual(self.lua('queues.rebuildCounts', 0, 'queue'), 1)
+        self.assertEqual(self.lua('queues.rebuildCounts', 0), 2)
+        self.assertCached(0)
+
+
 class TestPut(TestReqless):
     '''Test putting jobs into a queue'''
     # For reference:
@@ -458,6 +549,113 @@ class TestPut(TestReqless):
         self.assertEqual(self.lua('job.get', 0, 'c')['dependencies'], ['b'])
 
 
+class TestPutMulti(TestReqless):
+    '''Test putting many jobs into a queue at once'''
+    def test_malformed(self):
+        '''Enumerate all the ways in which the input can be messed up'''
+        self.assertMalformed(self.lua, [
+            ('queue.putMulti', 0, 'worker', 'queue'),
+            ('queue.putMulti', 0, 'worker', 'queue', '[}'),
+            ('queue.putMulti', 0, 'worker', 'queue', 5),
+        ])
+
+    def test_errors(self):
+        '''Jobs that are malformed don't stop the others'''
+        job = {'jid': 'jid', 'klass': 'klass', 'data': {}}
+        self.assertEqual(self.lua('queue.putMulti', 0, 'worker', 'queue', [
+            5,
+            {'klass': 'klass', 'data': {}},
+            {'jid': 'jid', 'data': {}},
+            {'jid': 'jid', 'klass': 'klass'},
+            dict(job, data='[}'),
+            dict(job, delay='foo'),
+            dict(job, priority='foo'),
+            dict(job, retries='foo'),
+            dict(job, tags='foo'),
+            dict(job, depends='foo'),
+            {'jid': 'a', 'klass': 'klass', 'data': {}},
+        ]), [
+            {'jid': 5, 'error': 'PutMulti(): Job 1 not a JSON object'},
+            {'error': 'PutMulti(): Job 2 Arg "jid" missing'},
+            {'jid': 'jid', 'error': 'PutMulti(): Job 3 Arg "klass" missing'},
+            {'jid': 'jid',
+                'error': 'PutMulti(): Job 4 Arg "data" missing or not JSON: nil'},
+            {'jid': 'jid',
+                'error': 'PutMulti(): Job 5 Arg "data" missing or not JSON: [}'},
+            {'jid': 'jid',
+                'error': 'PutMulti(): Job 6 Arg "delay" not a number: foo'},
+            {'jid': 'jid',
+                'error': 'PutMulti(): Job 7 Arg "priority" not a number: foo'},
+            {'jid': 'jid',
+                'error': 'PutMulti(): Job 8 Arg "retries" not a number: foo'},
+            {'jid': 'jid',
+                'error': 'PutMulti(): Job 9 Arg "tags" not a JSON array: foo'},
+            {'jid': 'jid',
+                'error': 'PutMulti(): Job 10 Arg "depends" not a JSON array: foo'},
+            {'jid': 'a', 'put': 'a'},
+        ])
+        self.assertEqual(self.lua('job.get', 0, 'jid'), None)
+        self.assertEqual(self.lua('job.get', 0, 'a')['state'], 'waiting')
+
+    def test_basic(self):
+        '''Jobs are put just as with put'''
+        self.assertEqual(self.lua('queue.putMulti', 0, 'worker', 'queue', [
+            {'jid': 'a', 'klass': 'klass', 'data': {'foo': 'bar'},
+                'priority': 1, 'tags': ['tag'], 'retries': 2,
+                'throttles': ['tid']},
+            {'jid': 'b', 'klass': 'klass', 'data': '{}', 'delay': 10},
+            {'jid': 'c', 'klass': 'klass', 'data': {}, 'depends': ['a']},
+        ]), [{'jid': jid, 'put': jid} for jid in 'abc'])
+        self.lua('queue.put', 0, 'worker', 'queue', 'd', 'klass', {'foo': 'bar'}, 0,
+            'priority', 1, 'tags', ['tag'], 'retries', 2, 'throttles', ['tid'])
+        a = self.lua('job.get', 0, 'a')
+        d = self.lua('job.get', 0, 'd')
+        self.assertEqual(json.loads(a.pop('data')), json.loads(d.pop('data')))
+        self.assertEqual(a.pop('dependents'), ['c'])
+        self.assertEqual(a.pop('jid'), 'a')
+        self.assertEqual(d.pop('dependents'), {})
+        self.assertEqual(d.pop('jid'), 'd')
+        self.assertEqual(a, d)
+        self.assertEqual(self.lua('job.get', 0, 'b')['state'], 'scheduled')
+        self.assertEqual(self.lua('job.get', 0, 'c')['state'], 'depends')
+        self.assertEqual(self.lua('queues.names', 0), ['queue'])
+
+    def test_existing(self):
+        '''Jobs that already exist keep their priority, tags and retries'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0,
+            'priority', 5, 'tags', ['tag'], 'retries', 2)
+        self.lua('queue.putMulti', 1, 'worker', 'other', [
+            {'jid': 'jid', 'klass': 'klass', 'data': {}}])
+        job = self.lua('job.get', 1, 'jid')
+        self.assertEqual(job['queue'], 'other')
+        self.assertEqual(job['priority'], 5)
+        self.assertEqual(job['tags'], ['tag'])
+        self.assertEqual(job['retries'], 2)
+        self.assertEqual(self.lua('queue.length', 1, 'queue'), 0)
+
+    def test_max(self):
+        '''Puts no more than max-put-multi jobs'''
+        self.lua('config.set', 0, 'max-put-multi', 2)
+        self.assertEqual(self.lua('queue.putMulti', 0, 'worker', 'queue', [
+            {'jid': jid, 'klass': 'klass', 'data': {}} for jid in 'abc']),
+            [{'jid': 'a', 'put': 'a'}, {'jid': 'b', 'put': 'b'}])
+        self.assertEqual(self.lua('job.get', 0, 'c'), None)
+
+    def test_many(self):
+        '''More jobs can be put at once than lua can unpack'''
+        self.lua('config.set', 0, 'max-put-multi', 10000)
+        outcomes = self.lua('queue.putMulti', 0, 'worker', 'queue', [
+            {'jid': str(jid), 'klass': 'klass', 'data': {}}
+            for jid in range(8001)])
+        self.assertEqual(len(outcomes), 8001)
+        self.assertEqual(self.lua('queue.length', 0, 'queue'), 8001)
+
+    def test_empty(self):
+        '''Putting no jobs is a no-op'''
+        self.assertEqual(self.lua('queue.putMulti', 0, 'worker', 'queue', []), [])
+        self.assertEqual(self.lua('queues.names', 0), [])
+
+
 class TestPeek(TestReqless):
     '''Test peeking jobs'''
     # For reference:
@@ -481,12 +679,9 @@ class TestPeek(TestReqless):
         self.lua('queue.put', 0, 'worker', 'foo', 'jid', 'klass', {}, 0)
         # And now we should see a single job
         self.assertEqual(self.lua('queue.peek', 1, 'foo', 0, 10), [{
-            'data': '{}',
-            'dependencies': {},
-            'dependents': {},
+            'data_size': 2,
             'expires': 0,
             'failure': {},
-            'history': [{'queue': 'foo', 'what': 'put', 'when': 0}],
             'jid': 'jid',
             'klass': 'klass',
             'priority': 0,
@@ -495,7 +690,6 @@ class TestPeek(TestReqless):
             'retries': 5,
             'state': 'waiting',
             'tags': {},
-            'tracked': False,
             'throttles': ['ql:q:foo'],
             'worker': u'',
             'spawned_from_jid': False
@@ -219,3 +219,105 @@ class TestQueuePatterns(TestReqless):
             actual_patterns,
             [*serialized_patterns],
         )
+
+
+class TestQueuesPop(TestReqless):
+    '''Test popping from multiple queues using queue patterns'''
+
+    def put(self, queue, jid, now=0):
+        '''Put a job into the provided queue'''
+        self.lua('queue.put', now, 'worker', queue, jid, 'klass', {}, 0)
+
+    def test_malformed(self):
+        '''Enumerate all the ways to send malformed requests'''
+        self.assertMalformed(self.lua, [
+            ('queues.pop', 0),
+            ('queues.pop', 0, 'worker', 'default'),
+            ('queues.pop', 0, 'worker', 'default', 'foo'),
+        ])
+
+    def test_pop_from_all_queues_by_default(self):
+        '''The default identifier pattern matches every known queue'''
+        self.put('a', 'jid-a')
+        self.put('b', 'jid-b')
+        jobs = self.lua('queues.pop', 1, 'worker', 'default', 10)
+        self.assertEqual([job['jid'] for job in jobs], ['jid-a', 'jid-b'])
+        self.assertEqual([job['state'] for job in jobs], ['running'] * 2)
+
+    def test_respects_limit(self):
+        '''Stops popping once the limit has been reached'''
+        for jid in range(5):
+            self.put('a', 'jid-a-%s' % jid)
+            self.put('b', 'jid-b-%s' % jid)
+        jobs = self.lua('queues.pop', 1, 'worker', 'default', 7)
+        self.assertEqual(len(jobs), 7)
+        self.assertEqual(
+            [job['queue'] for job in jobs], ['a'] * 5 + ['b'] * 2)
+
+    def test_identifier_patterns(self):
+        '''Only queues matching the identifier patterns are popped'''
+        self.lua('queueIdentifierPatterns.setAll', 0,
+            'shipping', json.dumps(['ship*', '!shipping-slow']))
+        self.put('shipping-fast', 'fast')
+        self.put('shipping-slow', 'slow')
+        self.put('billing', 'billing')
+        jobs = self.lua('queues.pop', 1, 'worker', 'shipping', 10)
+        self.assertEqual([job['jid'] for job in jobs], ['fast'])
+
+    def test_unknown_identifier_uses_default(self):
+        '''Unknown identifiers fall back to the default identifier patterns'''
+        self.lua('queueIdentifierPatterns.setAll', 0,
+            'default', json.dumps(['billing']))
+        self.put('shipping', 'shipping')
+        self.put('billing', 'billing')
+        jobs = self.lua('queues.pop', 1, 'worker', 'unknown', 10)
+        self.assertEqual([job['jid'] for job in jobs], ['billing'])
+
+    def test_nested_identifier_patterns(self):
+        '''Identifier patterns may reference other identifiers'''
+        self.lua('queueIdentifierPatterns.setAll', 0,
+            'all', json.dumps(['@shipping', '@billing', '!@legacy']),
+            'shipping', json.dumps(['shipping-*']),
+            'billing', json.dumps(['billing']),
+            'legacy', json.dumps(['*-legacy']))
+        self.put('shipping-fast', 'fast')
+        self.put('shipping-legacy', 'legacy')
+        self.put('billing', 'billing')
+        self.put('other', 'other')
+        jobs = self.lua('queues.pop', 1, 'worker', 'all', 10)
+        self.assertEqual(
+            sorted(job['jid'] for job in jobs), ['billing', 'fast'])
+
+    def test_priority_patterns(self):
+        '''Queues are popped in the order of the priority patterns'''
+        self.lua('queuePriorityPatterns.setAll', 0,
+            json.dumps({'fairly': False, 'pattern': ['c*']}),
+            json.dumps({'fairly': False, 'pattern': ['default']}),
+            json.dumps({'fairly': False, 'pattern': ['a']}))
+        for queue in ['a', 'b', 'c1', 'c2', 'd']:
+            self.put(queue, queue)
+        jobs = self.lua('queues.pop', 1, 'worker', 'default', 10)
+        self.assertEqual(
+            [job['jid'] for job in jobs], ['c1', 'c2', 'b', 'd', 'a'])
+
+    def test_priority_patterns_fairly(self):
+        '''Queues in a fair priority pattern are all still popped'''
+        self.lua('queuePriorityPatterns.setAll', 0,
+            json.dumps({'fairly': True, 'pattern': ['*']}))
+        queues = ['q%s' % index for index in range(10)]
+        for queue in queues:
+            self.put(queue, queue)
+        jobs = self.lua('queues.pop', 1, 'worker', 'default', 10)
+        self.assertEqual(sorted(job['jid'] for job in jobs), sorted(queues))
+
+    def test_skips_paused_queues(self):
+        '''Paused queues are skipped'''
+        self.put('a', 'jid-a')
+        self.put('b', 'jid-b')
+        self.lua('queue.pause', 0, 'a')
+        jobs = self.lua('queues.pop', 1, 'worker', 'default', 10)
+        self.assertEqual([job['jid'] for job in jobs], ['jid-b'])
+
+    def test_no_queues(self):
+        '''Returns an empty list when there are no matching queues'''
+        self.assertEqual(self.lua('queues.pop', 0, 'worker', 'default', 10), [])
@@ -0,0 +1,99 @@
+'''Test the read-only build of the script'''
+
+import json
+import re
+
+from test.common import TestReqless
+from test.reqless import ReqlessRecorder
+
+
+class TestReadOnly(TestReqless):
+    '''The read-only build runs only the commands that never write'''
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.ro = ReqlessRecorder(cls.redis, 'reqless-ro.lua')
+
+    def writes(self, function, *args):
+        '''Invoke the function and return its result along with the names of
+        the redis commands it ran that write'''
+        self.redis.config_resetstat()
+        result = function(*args)
+        names = [
+            name[len('cmdstat_'):] for name in self.redis.info('commandstats')
+            if name.startswith('cmdstat_')]
+        info = self.redis.execute_command('COMMAND', 'INFO', *names)
+        return result, sorted(
+            name for name, details in info.items()
+            if 'write' in details['flags'])
+
+    def test_manifest(self):
+        '''The manifest lists every command, and which are read-only'''
+        with open('api.lua') as fin:
+            commands = re.findall(
+                r'''^ReqlessAPI\[['"]([^'"]+)['"]\]''', fin.read(), re.M)
+        with open('manifest.json') as fin:
+            manifest = json.load(fin)
+        self.assertEqual(sorted(manifest['commands']), sorted(commands))
+        for command, details in manifest['commands'].items():
+            try:
+                self.ro(command, 0)
+                allowed = True
+            except Exception as exc:
+                allowed = 'is not read-only' not in str(exc)
+            self.assertEqual(allowed, details['readOnly'], command)
+
+    def put_stale(self):
+        '''Leave behind some of everything the read commands tidy up'''
+        self.lua('config.set', 0, 'max-worker-age', 10)
+        self.lua('config.set', 0, 'jobs-retention', 'ttl')
+        self.lua('queue.put', 0, 'worker', 'queue', 'a', 'klass', {}, 0,
+            'tags', ['tag'])
+        self.lua('queue.pop', 0, 'queue', 'worker', 1)
+        self.lua('job.complete', 0, 'a', 'worker', 'queue', {})
+        self.lua('queue.put', 0, 'worker', 'queue', 'b', 'klass', {}, 10)
+        self.lua('queue.recurAtInterval', 0, 'queue', 'c', 'klass', {}, 10, 0)
+        self.redis.delete('ql:j:a')
+        self.redis.hset('ql:j:b', 'history', json.dumps([{'put': -10}]))
+
+    def test_no_writes(self):
+        '''Read-only commands don't do any upkeep along the way'''
+        now = 10 ** 8
+        for args in (
+                ('queue.peek', now, 'queue', 0, 10),
+                ('queue.counts', now, 'queue'),
+                ('queues.counts', now),
+                ('queue.jobsByState', now, 'scheduled', 'queue'),
+                ('jobs.tagged', now, 'tag'),
+                ('job.get', now, 'b'),
+                ('job.getMulti', now, 'b'),
+                ('worker.jobs', now, 'worker'),
+                ('workers.counts', now)):
+            self.lua.flush()
+            self.put_stale()
+            _, writes = self.writes(self.ro, *args)
+            self.assertEqual(writes, [], args[0])
+            _, writes = self.writes(self.lua, *args)
+            self.assertNotEqual(writes, [], args[0])
+
+    def test_results(self):
+        '''Read-only commands report what they would have left in place'''
+        self.lua('config.set', 0, 'max-worker-age', 10)
+        self.lua('queue.put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('queue.pop', 0, 'queue', 'worker', 1)
+        self.redis.hset('ql:j:a', 'history', json.dumps([{'put': -10}]))
+        self.assertEqual(
+            self.ro('job.get', 0, 'a')['history'],
+            self.lua('job.get', 0, 'a')['history'])
+        self.assertEqual(
+            self.ro('workers.counts', 100), self.lua('workers.counts', 100))
+        self.assertEqual(
+            self.ro('worker.jobs', 100, 'worker'),
+            self.lua('worker.jobs', 100, 'worker'))
+
+    def test_rejects_writes(self):
+        '''Commands that write are refused'''
+        self.assertRaisesRegexp(Exception, r'queue.pop is not read-only',
+            self.ro, 'queue.pop', 0, 'queue', 'worker', 10)
+        self.assertEqual(self.redis.keys('*'), [])
@@ -0,0 +1,101 @@
+'''Tests about promoting scheduled and recurring jobs across queues'''
+
+from test.common import TestReqless
+
+
+class TestTick(TestReqless):
+    '''Test promoting due jobs with scheduler.tick'''
+    def test_malformed(self):
+        '''Enumerate malformed inputs into tick'''
+        self.assertMalformed(self.lua, [
+            ('scheduler.tick', 0, 'foo'),
+        ])
+
+    def test_scheduled(self):
+        '''Due scheduled jobs in every queue are moved to work'''
+        self.lua('queue.put', 0, 'worker', 'a', 'a', 'klass', {}, 10)
+        self.lua('queue.put', 0, 'worker', 'b', 'b', 'klass', {}, 20)
+        self.assertEqual(self.lua('scheduler.tick', 5), {
+            'promoted': 0, 'remaining': 0})
+        self.assertEqual(self.lua('scheduler.tick', 15), {
+            'promoted': 1, 'remaining': 0})
+        self.assertEqual(self.lua('job.get', 15, 'a')['state'], 'waiting')
+        self.assertEqual(self.lua('job.get', 15, 'b')['state'], 'scheduled')
+        self.assertEqual(self.redis.zrange('ql:q:a-work', 0, -1), [b'a'])
+        self.assertEqual(self.lua('scheduler.tick', 25), {
+            'promoted': 1, 'remaining': 0})
+        self.assertEqual(self.redis.zrange('ql:q:b-work', 0, -1), [b'b'])
+        self.assertEqual(self.redis.zcard('ql:due'), 0)
+
+    def test_recurring(self):
+        '''Due recurring jobs spawn their children'''
+        self.lua('queue.recurAtInterval', 0, 'queue', 'jid', 'klass', {}, 60, 0)
+        self.assertEqual(self.lua('scheduler.tick', 0), {
+            'promoted': 1, 'remaining': 0})
+        self.assertEqual(self.lua('job.get', 0, 'jid-1')['state'], 'waiting')
+        self.assertEqual(self.redis.zscore('ql:due', 'queue'), 60)
+        self.assertEqual(self.lua('scheduler.tick', 121), {
+            'promoted': 2, 'remaining': 0})
+        self.assertEqual(self.redis.zscore('ql:due', 'queue'), 180)
+
+    def test_budget(self):
+        '''Reports how many queues remain due beyond the budget'''
+        for queue in ('a', 'b', 'c'):
+            for jid in range(2):
+                self.lua('queue.put', 0, 'worker', queue, queue + str(jid),
+                    'klass', {}, 10)
+        self.assertEqual(self.lua('scheduler.tick', 10, 3), {
+            'promoted': 3, 'remaining': 2})
+        self.assertEqual(self.lua('scheduler.tick', 10, 3), {
+            'promoted': 3, 'remaining': 0})
+
+    def test_popped_queue(self):
+        '''Queues whose due jobs were already promoted are forgotten'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 10)
+        self.lua('queue.pop', 10, 'queue', 'worker', 10)
+        self.assertEqual(self.lua('scheduler.tick', 10), {
+            'promoted': 0, 'remaining': 0})
+        self.assertEqual(self.redis.zcard('ql:due'), 0)
+
+    def test_earliest(self):
+        '''The index holds the earliest due time of each queue'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'a', 'klass', {}, 20)
+        self.lua('queue.put', 0, 'worker', 'queue', 'b', 'klass', {}, 10)
+        self.lua('queue.put', 0, 'worker', 'queue', 'c', 'klass', {}, 30)
+        self.assertEqual(self.redis.zscore('ql:due', 'queue'), 10)
+        self.lua('scheduler.tick', 15)
+        self.assertEqual(self.redis.zscore('ql:due', 'queue'), 20)
+
+    def test_without_inline_promotion(self):
+        '''Pop, peek and counts can leave promotion to tick'''
+        self.lua('config.set', 0, 'inline-promotion', 0)
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 10)
+        self.lua('queue.recurAtInterval', 0, 'queue', 'r', 'klass', {}, 60, 0)
+        self.assertEqual(self.lua('queue.peek', 10, 'queue', 0, 10), [])
+        self.assertEqual(self.lua('queue.pop', 10, 'queue', 'worker', 10), [])
+        self.assertEqual(self.lua('queue.counts', 10, 'queue')['scheduled'], 1)
+        self.lua('scheduler.tick', 10)
+        self.assertEqual(
+            [job['jid'] for job in self.lua('queue.pop', 10, 'queue', 'worker', 10)],
+            ['r-1', 'jid'])
+
+    def test_unindexed(self):
+        '''Queues due from before the index was kept are indexed and ticked'''
+        self.lua('config.set', 0, 'inline-promotion', 0)
+        for index in range(3):
+            queue = 'queue-%d' % index
+            self.lua('queue.put', 0, 'worker', queue, queue, 'klass', {}, 10)
+        self.lua('queue.recurAtInterval', 0, 'recur', 'r', 'klass', {}, 60, 0)
+        self.redis.delete('ql:due')
+        promoted = 0
+        while True:
+            result = self.lua('scheduler.tick', 10, 1)
+            promoted += result['promoted']
+            if not result['remaining']:
+                break
+        self.assertEqual(promoted, 4)
+        self.assertEqual(self.redis.get('ql:due:indexed'), b'1')
+        self.assertEqual(self.redis.zscore('ql:due', 'recur'), 60)
+        self.assertEqual(
+            self.lua('queue.pop', 10, 'queue-0', 'worker', 10)[0]['jid'],
+            'queue-0')
@@ -118,3 +118,167 @@ class TestStats(TestReqless):
         self.lua('queue.pop', 2, 'queue', 'worker', 10)
         self.assertEqual(self.lua('queue.stats', 0, 'queue', 0)['failed'], 1)
         self.assertEqual(self.lua('queue.stats', 0, 'queue', 0)['failures'], 1)
+
+    def test_batched(self):
+        '''Jobs popped together have their wait times written together'''
+        for jid in range(20):
+            self.lua('queue.put', jid, 'worker', 'queue', jid, 'klass', {}, 0)
+        self.lua('queue.pop', 20, 'queue', 'worker', 20)
+        stats = self.lua('queue.stats', 0, 'queue', 0)
+        self.assertEqual(stats['wait']['count'], 20)
+        self.assertAlmostEqual(stats['wait']['mean'], 10.5)
+        self.assertAlmostEqual(stats['wait']['std'], 5.916079783099)
+        self.assertEqual(stats['wait']['histogram'][0:22], [0] + [1] * 20 + [0])
+        self.assertEqual(
+            sorted(self.redis.hkeys('ql:s:wait:0:queue'))[-2:],
+            [b'sum', b'sumsq'])
+
+    def test_legacy(self):
+        '''Stats kept as a mean and vk are combined with new data points'''
+        # The stats of wait times of 1, 2 and 3
+        self.redis.hset('ql:s:wait:0:queue', mapping={
+            'total': 3, 'mean': 2, 'vk': 2, 's1': 1, 's2': 1, 's3': 1})
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.lua('queue.pop', 4, 'queue', 'worker', 1)
+        stats = self.lua('queue.stats', 0, 'queue', 0)
+        self.assertEqual(stats['wait']['count'], 4)
+        self.assertAlmostEqual(stats['wait']['mean'], 2.5)
+        self.assertAlmostEqual(stats['wait']['std'], 1.290994448735)
+
+
+class TestStatsRange(TestReqless):
+    '''Tests the stats of many queues over many days'''
+    def setUp(self):
+        TestReqless.setUp(self)
+        # Jobs that wait 1 and 3 seconds in 'one' on the first day, and 5
+        # seconds in 'two' on the second day
+        for jid, queue, put, wait in (
+                ('a', 'one', 0, 1), ('b', 'one', 0, 3), ('c', 'two', 86400, 5)):
+            self.lua('queue.put', put, 'worker', queue, jid, 'klass', {}, 0)
+            self.lua('queue.pop', put + wait, queue, 'worker', 1)
+            self.lua('job.complete', put + wait, jid, 'worker', queue, {})
+
+    def test_malformed(self):
+        '''Enumerate all the ways to send malformed requests'''
+        self.assertMalformed(self.lua, [
+            ('queues.statsRange', 0),
+            ('queues.statsRange', 0, '"one"', 0, 0),
+            ('queues.statsRange', 0, ['one']),
+            ('queues.statsRange', 0, ['one'], 'foo', 0),
+            ('queues.statsRange', 0, ['one'], 0, 'foo'),
+            ('queues.statsRange', 0, ['one'], 86400, 0),
+            ('queues.statsRange', 0, ['one'], 0, 0, 'foo'),
+            ('queues.statsRange', 0, ['one'], 0, 0, 3600),
+        ])
+
+    def test_merged(self):
+        '''All the days are merged without a resolution'''
+        stats = self.lua('queues.statsRange', 0, ['one', 'two'], 0, 86400)
+        self.assertEqual(sorted(stats['queues'].keys()), ['one', 'two'])
+        one = stats['queues']['one']
+        self.assertEqual(len(one), 1)
+        self.assertEqual(one[0]['time'], 0)
+        self.assertEqual(one[0]['wait']['count'], 2)
+        self.assertAlmostEqual(one[0]['wait']['mean'], 2)
+        self.assertAlmostEqual(one[0]['wait']['std'], 1.414213562373)
+        total = stats['total'][0]
+        self.assertEqual(total['wait']['count'], 3)
+        self.assertAlmostEqual(total['wait']['mean'], 3)
+        self.assertAlmostEqual(total['wait']['std'], 2)
+        self.assertEqual(total['wait']['histogram'][0:6], [0, 1, 0, 1, 0, 1])
+        self.assertEqual(total['run']['count'], 3)
+
+    def test_resolution(self):
+        '''Days are merged into periods of the resolution'''
+        stats = self.lua(
+            'queues.statsRange', 0, ['one', 'two'], 0, 86400, 86400)
+        self.assertEqual([period['time'] for period in stats['total']],
+            [0, 86400])
+        self.assertEqual(
+            [period['wait']['count'] for period in stats['queues']['two']],
+            [0, 1])
+        self.assertEqual(
+            [period['wait']['count'] for period in stats['total']], [2, 1])
+
+    def test_patterns(self):
+        '''Queues may be matched by patterns'''
+        stats = self.lua('queues.statsRange', 0, ['*', '!t*'], 0, 86400)
+        self.assertEqual(list(stats['queues'].keys()), ['one'])
+        self.assertEqual(stats['total'][0]['wait']['count'], 2)
+
+    def test_failures(self):
+        '''Failures are summed across queues and days'''
+        for queue in ('one', 'two'):
+            self.lua('queue.put', 0, 'worker', queue, 'f', 'klass', {}, 0)
+            self.lua('queue.pop', 0, queue, 'worker', 1)
+            self.lua('job.fail', 0, 'f', 'worker', 'group', 'message', {})
+        stats = self.lua('queues.statsRange', 0, ['one', 'two'], 0, 0)
+        self.assertEqual(stats['total'][0]['failures'], 2)
+        self.assertEqual(stats['total'][0]['failed'], 1)
+
+
+class TestPercentiles(TestReqless):
+    '''Tests the log-scale histograms of wait and run times'''
+    def setUp(self):
+        TestReqless.setUp(self)
+        self.lua('config.set', 0, 'stats-precision', 5)
+
+    def test_malformed(self):
+        '''Enumerate all the ways to send malformed requests'''
+        self.assertMalformed(self.lua, [
+            ('queue.percentiles', 0, 'queue'),
+            ('queue.percentiles', 0, 'queue', 'foo'),
+            ('queue.percentiles', 0, 'queue', 0, '[foo]'),
+            ('queue.percentiles', 0, 'queue', 0, [2]),
+            ('queue.percentiles', 0, 'queue', 0, [0.5], 'foo'),
+            ('queue.percentiles', 0, 'queue', 0, [0.5], 60),
+        ])
+
+    def test_wait(self):
+        '''Quantiles of wait times are within the histogram's precision'''
+        for index in range(100):
+            self.lua('queue.put', 0, 'worker', 'queue', index, 'klass', {}, 0)
+            self.lua('queue.pop', index * 0.1, 'queue', 'worker', 1)
+
+        result = self.lua('queue.percentiles', 10, 'queue', 0, [0.5, 0.99, 0])
+        self.assertEqual(result['quantiles'], [0.5, 0.99, 0])
+        self.assertEqual(result['wait']['count'], 100)
+        for value, expected in zip(result['wait']['values'], [4.9, 9.8, 0]):
+            self.assertAlmostEqual(value, expected, delta=expected / 32 + 0.001)
+        self.assertEqual(result['run'], {'count': 0, 'values': [0, 0, 0]})
+
+    def test_run(self):
+        '''Quantiles of run times are within the histogram's precision'''
+        for index in range(10):
+            self.lua('queue.put', 0, 'worker', 'queue', index, 'klass', {}, 0)
+            self.lua('queue.pop', 0, 'queue', 'worker', 1)
+            self.lua('job.complete', 2 ** index, index, 'worker', 'queue', {})
+
+        result = self.lua('queue.percentiles', 10, 'queue', 0)
+        self.assertEqual(result['quantiles'], [0.5, 0.95, 0.99])
+        self.assertEqual(result['run']['count'], 10)
+        for value, expected in zip(result['run']['values'], [16, 512, 512]):
+            self.assertAlmostEqual(value, expected, delta=expected / 32)
+
+    def test_span(self):
+        '''Histograms are kept hourly and merged over the requested span'''
+        for index in range(4):
+            self.lua('queue.put', index * 3600, 'worker', 'queue', index,
+                'klass', {}, 0)
+            self.lua('queue.pop', index * 3600 + index + 1, 'queue', 'worker', 1)
+            self.lua('job.complete', index * 3600 + index + 1, index, 'worker',
+                'queue', {})
+
+        result = self.lua('queue.percentiles', 0, 'queue', 7300, [1], 3600)
+        self.assertEqual(result['wait']['count'], 1)
+        self.assertAlmostEqual(result['wait']['values'][0], 3, delta=0.1)
+        result = self.lua('queue.percentiles', 0, 'queue', 7300, [1])
+        self.assertEqual(result['wait']['count'], 4)
+        self.assertAlmostEqual(result['wait']['values'][0], 4, delta=0.2)
+
+    def test_disabled(self):
+        '''No histograms are kept without a precision'''
+        self.lua('config.set', 0, 'stats-precision', 0)
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.lua('queue.pop', 1, 'queue', 'worker', 1)
+        self.assertEqual(self.redis.keys('ql:s:wait-log:*'), [])
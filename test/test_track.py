@@ -22,7 +22,6 @@ class TestTrack(TestReqless):
             'jobs': [{
                 'retries': 5,
                 'jid': 'jid',
-                'tracked': True,
                 'tags': {},
                 'worker': u'',
                 'expires': 0,
@@ -30,18 +29,24 @@ class TestTrack(TestReqless):
                 'queue': 'queue',
                 'failure': {},
                 'state': 'waiting',
-                'dependencies': {},
                 'klass': 'klass',
-                'dependents': {},
                 'throttles': ['ql:q:queue'],
-                'data': '{}',
+                'data_size': 2,
                 'remaining': 5,
                 'spawned_from_jid': False,
-                'history': [{
-                    'queue': 'queue', 'what': 'put', 'when': 0
-                }]
             }], 'expired': {}})
 
+    def test_track_fields(self):
+        '''Tracked jobs may be listed with other fields'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.lua('job.track', 0, 'jid')
+        self.assertEqual(
+            self.lua('jobs.tracked', 0, 'full')['jobs'],
+            [self.lua('job.get', 0, 'jid')])
+        self.assertEqual(
+            self.lua('jobs.tracked', 0, ['jid', 'tracked'])['jobs'],
+            [{'jid': 'jid', 'tracked': True}])
+
     def test_untrack(self):
         '''We can stop tracking a job'''
         self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
@@ -0,0 +1,124 @@
+'''Test the wake-up tokens used by workers blocking on queues'''
+
+import threading
+import time
+
+from test.common import TestReqless
+from test.reqless import ReqlessWaiter
+
+
+class TestWake(TestReqless):
+    '''Test that making jobs available wakes blocked workers'''
+    def setUp(self):
+        self.lua('config.set', 0, 'max-wake-tokens', 10)
+
+    def tokens(self, queue='queue'):
+        '''The number of wake-up tokens for the queue'''
+        return self.redis.llen('ql:q:%s-wake' % queue)
+
+    def test_disabled_by_default(self):
+        '''No tokens are pushed unless max-wake-tokens is positive'''
+        self.lua('config.unset', 0, 'max-wake-tokens')
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.assertEqual(self.tokens(), 0)
+
+    def test_put(self):
+        '''Putting a job pushes a token'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.assertEqual(self.tokens(), 1)
+
+    def test_put_scheduled(self):
+        '''Scheduled jobs push a token once they're ready'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 10)
+        self.assertEqual(self.tokens(), 0)
+        self.lua('queue.peek', 5, 'queue', 0, 10)
+        self.assertEqual(self.tokens(), 0)
+        self.lua('queue.peek', 10, 'queue', 0, 10)
+        self.assertEqual(self.tokens(), 1)
+
+    def test_priority_update(self):
+        '''Re-prioritizing a waiting job doesn't push another token'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'jid', 'klass', {}, 0)
+        self.lua('job.setPriority', 0, 'jid', 10)
+        self.assertEqual(self.tokens(), 1)
+
+    def test_capped(self):
+        '''The number of tokens is capped at max-wake-tokens'''
+        for jid in range(20):
+            self.lua('queue.put', 0, 'worker', 'queue', jid, 'klass', {}, 0)
+        self.assertEqual(self.tokens(), 10)
+
+    def test_dependency_completed(self):
+        '''Completing a dependency pushes a token for the dependent job'''
+        self.lua('queue.put', 0, 'worker', 'queue', 'a', 'klass', {}, 0)
+        self.lua('queue.put', 0, 'worker', 'other', 'b', 'klass', {}, 0,
+            'depends', ['a'])
+        self.assertEqual(self.tokens('other'), 0)
+        self.lua('queue.pop', 0, 'queue', 'worker', 10)
+        self.lua('job.complete', 0, 'a', 'worker', 'queue', {})
+        self.assertEqual(self.tokens('other'), 1)
+
+    def test_throttle_released(self):
+        '''Releasing a throttle pushes a token for the released job'''
+        self.lua('throttle.set', 0, 'tid', 1)
+        self.lua('queue.put', 0, 'worker', 'queue', 'a', 'klass', {}, 0,
+            'throttles', ['tid'])
+        self.lua('queue.put', 0, 'worker', 'queue', 'b', 'klass', {}, 0,
+            'throttles', ['tid'])
+        jid = self.lua('queue.pop', 0, 'queue', 'worker', 10)[0]['jid']
+        self.redis.delete('ql:q:queue-wake')
+        self.lua('job.complete', 0, jid, 'worker', 'queue', {})
+        self.assertEqual(self.tokens(), 1)
+
+    def blocked(self):
+        '''Wait for a client to block'''
+        for _ in range(100):
+            if self.redis.info('clients')['blocked_clients']:
+                return
+            time.sleep(0.01)
+        self.fail('No client blocked')
+
+    def test_wake_not_lost(self):
+        '''A job put between a woken waiter's empty pop and blocking again
+        isn't missed'''
+        lua = self.lua
+
+        class RacedWaiter(ReqlessWaiter):
+            '''Another client puts a job just after the waiter finds its
+            queue empty for the second time'''
+            pops = 0
+
+            def pop(self, now):
+                jobs = ReqlessWaiter.pop(self, now)
+                self.pops += 1
+                if self.pops == 2:
+                    lua('queue.put', 0, 'other', 'queue', 'jid', 'klass', {}, 0)
+                return jobs
+
+        waiter = RacedWaiter(self.redis, self.lua, ['queue'], 'worker')
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(waiter.wait(lambda: 1, timeout=5)))
+        thread.start()
+        # Wake the blocked waiter with a token for a job it won't find
+        self.blocked()
+        started = time.time()
+        self.redis.rpush('ql:q:queue-wake', 1)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(waiter.pops, 3)
+        self.assertEqual([job['jid'] for job in results[0]], ['jid'])
+        self.assertLess(time.time() - started, 1)
+
+    def test_waiter_woken(self):
+        '''A blocked waiter is woken up by a put from another client'''
+        waiter = ReqlessWaiter(self.redis, self.lua, ['a', 'b'], 'worker')
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(waiter.wait(lambda: 1, timeout=5)))
+        thread.start()
+        time.sleep(0.1)
+        self.lua('queue.put', 0, 'worker', 'b', 'jid', 'klass', {}, 0)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([job['jid'] for job in results[0]], ['jid'])
@@ -177,3 +177,51 @@ class TestWorker(TestReqless):
             'jobs': {},
             'stalled': {}
         })
+
+
+class TestWorkerHeartbeat(TestReqless):
+    '''Test renewing all of a worker's locks at once'''
+    def setUp(self):
+        TestReqless.setUp(self)
+        self.lua('config.set', 0, 'grace-period', 0)
+        self.lua('config.set', 0, 'heartbeat', 60)
+        self.lua('config.set', 0, 'other-heartbeat', 30)
+        for jid in 'ab':
+            self.lua('queue.put', 0, 'worker', 'queue', jid, 'klass', {}, 0)
+        self.lua('queue.put', 0, 'worker', 'other', 'c', 'klass', {}, 0)
+        self.lua('queue.pop', 0, 'queue', 'worker', 10)
+        self.lua('queue.pop', 0, 'other', 'worker', 10)
+
+    def test_malformed(self):
+        '''Enumerate all the ways the input can be malformed'''
+        self.assertMalformed(self.lua, [
+            ('worker.heartbeat', 0),
+        ])
+
+    def test_all(self):
+        '''Renews every lock the worker holds'''
+        self.assertEqual(self.lua('worker.heartbeat', 10, 'worker'), [])
+        for jid, expires in (('a', 70), ('b', 70), ('c', 40)):
+            self.assertEqual(self.lua('job.get', 10, jid)['expires'], expires)
+            self.assertEqual(self.redis.zscore('ql:w:worker:jobs', jid), expires)
+        self.assertEqual(self.redis.zscore('ql:q:queue-locks', 'a'), 70)
+        self.assertEqual(self.redis.zscore('ql:q:other-locks', 'c'), 40)
+        self.assertEqual(self.redis.zscore('ql:workers', 'worker'), 10)
+
+    def test_jids(self):
+        '''Renews only the provided jobs'''
+        self.assertEqual(self.lua('worker.heartbeat', 10, 'worker', 'a'), [])
+        self.assertEqual(self.lua('job.get', 10, 'a')['expires'], 70)
+        self.assertEqual(self.lua('job.get', 10, 'b')['expires'], 60)
+
+    def test_lost(self):
+        '''Returns the jobs whose locks were lost'''
+        self.lua('job.complete', 5, 'a', 'worker', 'queue', {})
+        self.lua('queue.pop', 61, 'queue', 'another', 10)
+        self.assertEqual(
+            self.lua('worker.heartbeat', 62, 'worker', 'a', 'b', 'c', 'd'),
+            ['a', 'b', 'd'])
+        self.assertEqual(self.lua('job.get', 62, 'c')['expires'], 92)
+        self.assertEqual(self.lua('job.get', 62, 'b')['worker'], 'another')
+        self.assertEqual(self.lua('worker.jobs', 62, 'worker'), {
+            'jobs': ['c'], 'stalled': {}})
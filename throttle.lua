@@ -1,3 +1,112 @@
+-------------------------------------------------------------------------------
+-- Throttle class
+-------------------------------------------------------------------------------
+
+-- Access to the sorted set of jids which have acquired a lock on a throttle.
+-- The number of locks is read once and then kept current as locks are added
+-- and removed.
+local ReqlessThrottleLocks = {}
+ReqlessThrottleLocks.__index = ReqlessThrottleLocks
+
+function ReqlessThrottleLocks:length()
+  if self.count == nil then
+    self.count = (redis.call('zcard', self.key) or 0)
+  end
+  return self.count
+end
+
+function ReqlessThrottleLocks:members()
+  return redis.call('zrange', self.key, 0, -1)
+end
+
+function ReqlessThrottleLocks:add(...)
+  if #arg > 0 then
+    local added = redis.call('zadd', self.key, unpack(arg))
+    if self.count ~= nil then
+      self.count = self.count + added
+    end
+  end
+end
+
+function ReqlessThrottleLocks:remove(...)
+  if #arg > 0 then
+    local removed = redis.call('zrem', self.key, unpack(arg))
+    if self.count ~= nil then
+      self.count = self.count - removed
+    end
+    return removed
+  end
+end
+
+function ReqlessThrottleLocks:pop(min, max)
+  local removed = redis.call('zremrangebyrank', self.key, min, max)
+  if self.count ~= nil then
+    self.count = self.count - removed
+  end
+  return removed
+end
+
+function ReqlessThrottleLocks:peek(min, max)
+  return redis.call('zrange', self.key, min, max)
+end
+
+-- Access to the sorted set of jids which are waiting for a throttle to become
+-- available.
+local ReqlessThrottlePending = {}
+ReqlessThrottlePending.__index = ReqlessThrottlePending
+
+function ReqlessThrottlePending:length()
+  return (redis.call('zcard', self.key) or 0)
+end
+
+function ReqlessThrottlePending:members()
+  return redis.call('zrange', self.key, 0, -1)
+end
+
+function ReqlessThrottlePending:add(now, jid)
+  redis.call('zadd', self.key, now, jid)
+end
+
+function ReqlessThrottlePending:remove(...)
+  if #arg > 0 then
+    return redis.call('zrem', self.key, unpack(arg))
+  end
+end
+
+function ReqlessThrottlePending:pop(min, max)
+  return redis.call('zremrangebyrank', self.key, min, max)
+end
+
+function ReqlessThrottlePending:peek(min, max)
+  return redis.call('zrange', self.key, min, max)
+end
+
+-- Throttle objects, memoized for the rest of the invocation so that a throttle's
+-- definition and lock count are only read once
+Reqless.throttle_cache = {}
+
+-- Return a throttle object
+-- throttle objects are used for arbitrary throttling of jobs.
+function Reqless.throttle(tid)
+  assert(tid, 'Throttle(): no tid provided')
+  if Reqless.throttle_cache[tid] then
+    return Reqless.throttle_cache[tid]
+  end
+
+  local throttle = ReqlessThrottle.data({id = tid})
+  setmetatable(throttle, ReqlessThrottle)
+  Reqless.throttle_cache[tid] = throttle
+
+  local key = ReqlessThrottle.ns .. tid
+  -- set of jids which have acquired a lock on this throttle.
+  throttle.locks = setmetatable({key = key .. '-locks'}, ReqlessThrottleLocks)
+  -- set of jids which are waiting for the throttle to become available.
+  throttle.pending = setmetatable(
+    {key = key .. '-pending'}, ReqlessThrottlePending)
+
+  return throttle
+end
+
 -- Retrieve the data for a throttled resource
 function ReqlessThrottle:data()
   -- Default values for the data
@@ -29,11 +138,13 @@ function ReqlessThrottle:set(data, expiration)
   if expiration > 0 then
     redis.call('expire', ReqlessThrottle.ns .. self.id, expiration)
   end
+  self.maximum = tonumber(data.maximum) or 0
 end
 
 -- Delete a throttled resource
 function ReqlessThrottle:unset()
   redis.call('del', ReqlessThrottle.ns .. self.id)
+  self.maximum = 0
 end
 
 -- Acquire a throttled resource for a job.
@@ -43,47 +154,47 @@ function ReqlessThrottle:acquire(jid)
     return false
   end
 
-  self.locks.add(1, jid)
+  self.locks:add(1, jid)
   return true
 end
 
 function ReqlessThrottle:pend(now, jid)
-  self.pending.add(now, jid)
+  self.pending:add(now, jid)
 end
 
 -- Releases the lock taken by the specified jid.
 -- number of jobs released back into the queues is determined by the locks_available method.
-function ReqlessThrottle:release(now, jid)
-  -- Only attempt to remove from the pending set if the job wasn't found in the
-  -- locks set
-  if self.locks.remove(jid) == 0 then
-    self.pending.remove(jid)
+function ReqlessThrottle:release(now, ...)
+  -- Only attempt to remove from the pending set if some of the jobs weren't
+  -- found in the locks set
+  if self.locks:remove(unpack(arg)) < #arg then
+    self.pending:remove(unpack(arg))
   end
 
   local available_locks = self:locks_available()
-  if self.pending.length() == 0 or available_locks < 1 then
+  if self.pending:length() == 0 or available_locks < 1 then
     return
   end
 
   -- subtract one to ensure we pop the correct amount. peek(0, 0) returns the first element
   -- peek(0,1) return the first two.
-  for _, jid in ipairs(self.pending.peek(0, available_locks - 1)) do
+  for _, jid in ipairs(self.pending:peek(0, available_locks - 1)) do
     local job = Reqless.job(jid)
     local data = job:data()
     local queue = Reqless.queue(data['queue'])
 
-    queue.throttled.remove(jid)
-    queue.work.add(now, data.priority, jid)
+    queue.throttled:remove(jid)
+    queue.work:add(now, data.priority, jid)
   end
 
   -- subtract one to ensure we pop the correct amount. pop(0, 0) pops the first element
   -- pop(0,1) pops the first two.
-  local popped = self.pending.pop(0, available_locks - 1)
+  local popped = self.pending:pop(0, available_locks - 1)
 end
 
 -- Returns true if the throttle has locks available, false otherwise.
 function ReqlessThrottle:available()
-  return self.maximum == 0 or self.locks.length() < self.maximum
+  return self.maximum == 0 or self.locks:length() < self.maximum
 end
 
 -- Returns the TTL of the throttle
@@ -100,5 +211,5 @@ function ReqlessThrottle:locks_available()
     return 10
   end
 
-  return self.maximum - self.locks.length()
+  return self.maximum - self.locks:length()
 end
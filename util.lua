@@ -6,3 +6,62 @@ local function cjsonArrayDegenerationWorkaround(array)
   end
   return cjson.encode(array)
 end
+
+-- The header of a MessagePack map or array of `count` entries, given the type
+-- bytes of its fix, 16-bit and 32-bit forms
+local function msgpackHeader(count, fix, short, long)
+  if count < 16 then
+    return string.char(fix + count)
+  elseif count < 65536 then
+    return string.char(short, math.floor(count / 256), count % 256)
+  end
+  return string.char(long,
+    math.floor(count / 16777216) % 256, math.floor(count / 65536) % 256,
+    math.floor(count / 256) % 256, count % 256)
+end
+
+-- Add the MessagePack encoding of the value to the list of parts. cmsgpack
+-- can't tell an empty array from an empty object either, and packs every
+-- empty table as an array, so tables are packed here and only the values
+-- within them by cmsgpack. Empty tables are packed as maps, just as cjson
+-- encodes them as objects, so a response has the same structure either way.
+local function msgpackParts(value, parts)
+  if type(value) ~= 'table' then
+    if value == cjson.null then
+      table.insert(parts, string.char(0xc0))
+    else
+      table.insert(parts, cmsgpack.pack(value))
+    end
+    return parts
+  end
+
+  local count = 0
+  for _ in pairs(value) do
+    count = count + 1
+  end
+  if count > 0 and #value == count then
+    table.insert(parts, msgpackHeader(count, 0x90, 0xdc, 0xdd))
+    for _, item in ipairs(value) do
+      msgpackParts(item, parts)
+    end
+  else
+    table.insert(parts, msgpackHeader(count, 0x80, 0xde, 0xdf))
+    for key, item in pairs(value) do
+      msgpackParts(key, parts)
+      msgpackParts(item, parts)
+    end
+  end
+  return parts
+end
+
+local function msgpackEncode(value)
+  return table.concat(msgpackParts(value, {}))
+end
+
+-- Like cjsonArrayDegenerationWorkaround, but for MessagePack
+local function msgpackEncodeArray(array)
+  if #array == 0 then
+    return string.char(0x90)
+  end
+  return msgpackEncode(array)
+end
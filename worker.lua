@@ -1,6 +1,6 @@
 -- Deregisters these workers from the list of known workers
 function ReqlessWorker.deregister(...)
-  redis.call('zrem', 'ql:workers', unpack(arg))
+  redis.call('zrem', Reqless.ns .. 'workers', unpack(arg))
 end
 
 -- Provide data about all the workers, or if a specific worker is provided,
@@ -37,29 +37,89 @@ function ReqlessWorker.counts(now, worker)
   -- last day. Seems like a 'reasonable' default
   local interval = tonumber(Reqless.config.get('max-worker-age', 86400))
 
-  local workers  = redis.call('zrangebyscore', 'ql:workers', 0, now - interval)
-  for _, worker in ipairs(workers) do
-    redis.call('del', 'ql:w:' .. worker .. ':jobs')
-  end
+  if Reqless.read_only then
+    -- Leave them in place, but don't report them
+    if worker then
+      local seen = redis.call('zscore', Reqless.ns .. 'workers', worker)
+      if not seen or tonumber(seen) <= now - interval then
+        return {jobs = {}, stalled = {}}
+      end
+    end
+  else
+    local workers = redis.call(
+      'zrangebyscore', Reqless.ns .. 'workers', 0, now - interval)
+    for _, worker in ipairs(workers) do
+      redis.call('del', Reqless.ns .. 'w:' .. worker .. ':jobs')
+    end
 
-  -- And now remove them from the list of known workers
-  redis.call('zremrangebyscore', 'ql:workers', 0, now - interval)
+    -- And now remove them from the list of known workers
+    redis.call('zremrangebyscore', Reqless.ns .. 'workers', 0, now - interval)
+  end
 
   if worker then
     return {
-      jobs    = redis.call('zrevrangebyscore', 'ql:w:' .. worker .. ':jobs', now + 8640000, now),
-      stalled = redis.call('zrevrangebyscore', 'ql:w:' .. worker .. ':jobs', now, 0)
+      jobs    = redis.call('zrevrangebyscore', Reqless.ns .. 'w:' .. worker .. ':jobs', now + 8640000, now),
+      stalled = redis.call('zrevrangebyscore', Reqless.ns .. 'w:' .. worker .. ':jobs', now, 0)
     }
   end
 
   local response = {}
-  local workers = redis.call('zrevrange', 'ql:workers', 0, -1)
+  local workers = redis.call(
+    'zrevrangebyscore', Reqless.ns .. 'workers', '+inf', '(' .. (now - interval))
   for _, worker in ipairs(workers) do
     table.insert(response, {
       name    = worker,
-      jobs    = redis.call('zcount', 'ql:w:' .. worker .. ':jobs', now, now + 8640000),
-      stalled = redis.call('zcount', 'ql:w:' .. worker .. ':jobs', 0, now)
+      jobs    = redis.call('zcount', Reqless.ns .. 'w:' .. worker .. ':jobs', now, now + 8640000),
+      stalled = redis.call('zcount', Reqless.ns .. 'w:' .. worker .. ':jobs', 0, now)
     })
   end
   return response
 end
+
+-- Heartbeat(now, worker, [jid, ...])
+-- ----------------------------------
+-- Renew the worker's locks on all of the provided jobs, or on all the jobs
+-- the worker holds in `ql:w:<worker>:jobs` if none are provided. Returns the
+-- jids of the jobs whose locks the worker has lost, because they have been
+-- given to another worker, or are no longer running:
+--
+--  [jid1, jid2, ...]
+function ReqlessWorker.heartbeat(now, worker, ...)
+  assert(worker, 'Heartbeat(): Arg "worker" missing')
+  local key = Reqless.ns .. 'w:' .. worker .. ':jobs'
+
+  local jids = arg
+  if #jids == 0 then
+    jids = redis.call('zrange', key, 0, -1)
+  end
+
+  local held = {}
+  local lost = {}
+  for _, jid in ipairs(jids) do
+    local queue_name, job_worker, state = unpack(redis.call('hmget',
+      ReqlessJob.ns .. jid, 'queue', 'worker', 'state'))
+    if job_worker == worker and state == 'running' then
+      local expires = now + tonumber(
+        Reqless.config.get(queue_name .. '-heartbeat') or
+        Reqless.config.get('heartbeat', 60))
+      redis.call('hset', ReqlessJob.ns .. jid, 'expires', expires)
+      Reqless.queue(queue_name).locks:add(expires, jid)
+      table.insert(held, expires)
+      table.insert(held, jid)
+    else
+      table.insert(lost, jid)
+    end
+  end
+
+  -- Renew all the held jobs for this worker at once, and forget the others
+  if #held > 0 then
+    redis.call('zadd', key, unpack(held))
+  end
+  if #lost > 0 then
+    redis.call('zrem', key, unpack(lost))
+  end
+
+  -- This worker is still around
+  redis.call('zadd', Reqless.ns .. 'workers', now, worker)
+  return lost
+end